@@ -0,0 +1,121 @@
+# Copyright (C) 2014 William M. Jacobs
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or (at
+# your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import numpy as np
+
+def autocorrelation(series):
+    '''Normalized autocorrelation function of one or more independent series of equal spacing
+
+    The autocovariances of the series are averaged, lag by lag, over the series that are long
+    enough to contribute, and divided by the average variance.'''
+    if isinstance(series, np.ndarray) and series.ndim == 1:
+        series = [series]
+    n = max(len(x) for x in series)
+    acov, nterms = np.zeros(n), np.zeros(n)
+    for x in series:
+        x = np.asarray(x, dtype=float)
+        if len(x) < 2:
+            continue
+        x = x - x.mean()
+        f = np.fft.rfft(x, 2 * len(x))
+        acov[:len(x)] += np.fft.irfft(f * np.conj(f))[:len(x)]
+        nterms[:len(x)] += np.arange(len(x), 0, -1)
+    valid = nterms > 0
+    if not valid.any() or acov[0] <= 0.:
+        return np.ones(1)
+    acov = acov[valid] / nterms[valid]
+    return acov / acov[0]
+
+def integrated_autocorrelation_time(series, c=5.):
+    '''Integrated autocorrelation time of one or more series, in units of their spacing
+
+    tau = 1/2 + sum_t rho(t), summed up to the smallest window W with W >= c tau (Sokal's
+    automatic windowing), so that tau = 1/2 for uncorrelated samples, and the variance of
+    the mean of n samples is 2 tau / n times the variance of one sample.'''
+    rho = autocorrelation(series)
+    tau = np.cumsum(rho) - 0.5
+    window = np.flatnonzero(np.arange(len(rho)) >= c * tau)
+    return max(float(tau[window[0] if len(window) > 0 else -1]), 0.5)
+
+def bin_residuals(bins, values, nbins):
+    '''Deviations of the values from the mean of the values in the same bin, in units of the
+    standard deviation of that bin, or 0 in bins where all of the values are equal'''
+    bins = np.asarray(bins)
+    counts = np.bincount(bins, minlength=nbins)
+    occupied = counts > 0
+    means, sqmeans = np.zeros(nbins), np.zeros(nbins)
+    means[occupied] = np.bincount(bins, weights=values, minlength=nbins)[occupied] / counts[occupied]
+    sqmeans[occupied] = np.bincount(bins, weights=values**2, minlength=nbins)[occupied] / counts[occupied]
+    stddevs = np.sqrt(np.maximum(sqmeans - means**2, 0.))
+    scale = np.where(stddevs > 1.e-12 * np.maximum(np.abs(means), 1.), stddevs, np.inf)
+    return (values - means[bins]) / scale[bins]
+
+class BatchMeans:
+    '''Standard errors of the means of observables in each bin, by the method of batch means
+
+    Each call to add() records a batch of samples: the number of samples in each bin and the
+    sums of one or more observables over them.  The standard error of the mean S / N of each
+    observable in each bin is estimated from the scatter of the batch sums s_i about their
+    expected values (S / N) n_i, which allows for the autocorrelation of the samples as long
+    as the batches are long compared with the autocorrelation time.  merge() combines
+    neighbouring batches, so that their number stays bounded as they get longer.'''
+    def __init__(self):
+        self.counts = []
+        self.sums = []
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, counts, sums):
+        '''Record a batch of counts, of any shape, and sums, with the same shape plus a trailing
+        dimension with one entry per observable'''
+        self.counts.append(np.asarray(counts, dtype=float))
+        self.sums.append(np.asarray(sums, dtype=float))
+
+    def merge(self):
+        '''Add the batches together in pairs, with any odd batch left last'''
+        pairs = range(0, len(self.counts) - 1, 2)
+        odd = [len(self.counts) - 1] if len(self.counts) % 2 == 1 else []
+        self.counts = [self.counts[i] + self.counts[i + 1] for i in pairs] + [self.counts[i] for i in odd]
+        self.sums = [self.sums[i] + self.sums[i + 1] for i in pairs] + [self.sums[i] for i in odd]
+
+    def means(self):
+        '''The total counts, and the means of the observables, which are 0 in bins with no samples'''
+        counts, sums = sum(self.counts), sum(self.sums)
+        sampled = counts > 0
+        means = np.zeros(sums.shape)
+        means[sampled] = sums[sampled] / counts[sampled][...,None]
+        return counts, means
+
+    def errors(self, weights=None):
+        '''The total counts, and the means and standard errors of the observables
+
+        If weights are given, with the shape of the means, the standard error of the weighted
+        sum of the means over the observables in each bin is returned instead, in a trailing
+        dimension of length 1.  The standard errors are infinite in bins that were sampled in
+        fewer than two batches.'''
+        counts, means = self.means()
+        nbatches = len(self.counts)
+        deviations = 0.
+        for n, s in zip(self.counts, self.sums):
+            d = s - means * n[...,None]
+            if weights is not None:
+                d = np.sum(d * weights, axis=-1, keepdims=True)
+            deviations = deviations + d**2
+        errors = np.full(np.shape(deviations), np.inf)
+        reliable = sum((n > 0).astype(int) for n in self.counts) >= 2
+        errors[reliable] = np.sqrt(deviations[reliable] * nbatches / (nbatches - 1.)) / counts[reliable][...,None]
+        return counts, means, errors
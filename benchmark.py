@@ -0,0 +1,322 @@
+# Copyright (C) 2014 William M. Jacobs
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or (at
+# your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import argparse, json, math, os, platform, tempfile, time
+import numpy as np
+from pygtsa.structure import Assembly
+from pygtsa.histogram import EVHistogram, EVLayout, load_histogram
+from pygtsa.calc_yield import load_dihedrals, find_target_indices, lnhzEV, yield_from_lnhz, DFG_from_lnhz
+from pygtsa.calc_fe_profile import free_energy_profile_V
+from pygtsa.calc_barrier import nucleation_barrier
+from pygtsa.calc_incidental import incidental_VV, on_off_pathway_ratio
+from pygtsa.cgraph import SamplerStats, mc_sample_EV, wl_simulate_EV, mc_simulate_dihedrals_adjacents_EV, \
+    enumerate_EV, wl_error_estimate, move_set, MOVE_MAX_PATCH
+
+# Conditions for the analysis benchmarks
+RHO = 1.e-3
+EPSILON = np.linspace(0., 20., 201)
+INCIDENTAL_EPSILON = 4.
+INCIDENTAL_W = 1.
+
+def timed(f, *args, repeat=1, **kwargs):
+    '''Call f repeatedly and return the shortest time taken and the result of the last call'''
+    best = math.inf
+    for r in range(repeat):
+        start = time.perf_counter()
+        result = f(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def find_examples(path, select=None):
+    '''Directories in path with an edge list and reference lnhEV, dihedrals and adjacents files'''
+    examples = []
+    for name in sorted(os.listdir(path)):
+        directory = os.path.join(path, name)
+        if not all(os.path.exists(os.path.join(directory, f + '.dat')) for f in ('lnhEV', 'dihedrals', 'adjacents')):
+            continue
+        if select != None and not any(s in name for s in select):
+            continue
+        examples.append((name, directory))
+    return examples
+
+def bench_load(path, repeat=1):
+    '''Time parsing an edge list, and reading it with and without the cached parsed structure
+
+    The parsed structure is cached in a temporary directory, so that the user's cache is not used.'''
+    with tempfile.TemporaryDirectory() as tmp:
+        times = {}
+        times['parse'], target = timed(Assembly.read, path, cache=False, repeat=repeat)
+        times['write_cache'], cached = timed(Assembly.read, path, cache_dir=tmp)
+        times['read_cache'], cached = timed(Assembly.read, path, cache_dir=tmp, repeat=repeat)
+    return times, target
+
+def compare_references(hists, references):
+    '''Compare histograms with reference histograms of the same layout, over the bins filled in both
+
+    Returns the rms and maximum absolute differences for each histogram.'''
+    checks = {}
+    for name in hists:
+        h, ref = hists[name], references[name]
+        common = (h >= 0.) & (ref >= 0.)
+        diff = h[common] - ref[common]
+        checks[name] = {'bins' : int(np.count_nonzero(common)), \
+                        'rms' : float(np.sqrt(np.mean(diff**2))) if diff.size > 0 else None, \
+                        'max' : float(np.max(np.fabs(diff))) if diff.size > 0 else None}
+    return checks
+
+def bench_mc(target, lnhEV, nsteps, seed, incremental=True, moves=None):
+    '''Number of Monte Carlo steps per second of mc_sample_subgraphs_EV'''
+    stats = SamplerStats(per_bin=False, timing=False)
+    mc_sample_EV(target, target, lnhEV, nsteps, incremental=incremental, seed=seed, sampler_stats=stats, moves=moves)
+    return stats.summary()['steps_per_second']
+
+def bench_wl(target, fmin, ncheck, seed, moves=None):
+    '''Time each stage of a short Wang--Landau calculation, from f = 1 down to fmin
+
+    Besides the times, the acceptance rate of each type of move that was made, and the mean
+    number of steps taken to tunnel between the smallest and largest fragments, are returned.'''
+    with tempfile.TemporaryDirectory() as tmp:
+        log = os.path.join(tmp, 'stats.jsonl')
+        start = time.time()
+        wl_simulate_EV(target, fmin=fmin, ncheck=ncheck, output=os.path.join(tmp, 'lnhEV.dat'), verbose=False, \
+                       seed=seed, stats_log=log, stats_interval=math.inf, moves=moves)
+        with open(log, 'r') as f:
+            records = [json.loads(line) for line in f]
+    stages, last = [], start
+    for record in records:
+        if record['event'] == 'stage':
+            stages.append({'f' : record['fdone'], 'time' : record['time'] - last, 'steps' : record['steps']})
+            last = record['time']
+    stats = records[-1]['stats']
+    return {'stages' : stages, 'total' : last - start, 'steps_per_second' : stats['steps_per_second'], \
+            'acceptance' : {move : counts['acceptance'] for move, counts in stats['moves'].items() \
+                            if counts['proposed'] > 0}, \
+            'tunnel_steps' : {direction : tunnels['mean_steps'] for direction, tunnels in stats['tunnels'].items()}}
+
+def bench_analyses(lnhEV, dihedrals, dihedrals_meta, adjacents, layout, repeat=1):
+    '''Time the calculations of the calc_yield, calc_fe_profile, calc_barrier and calc_incidental scripts
+
+    Returns the times and a checksum of the results of each calculation.'''
+    times, checksums = {}, {}
+    target_indices = find_target_indices(dihedrals)
+    qdih, qcoord = dihedrals_meta['qdih'], dihedrals_meta['qcoord']
+    epsilon_expmean = np.zeros(dihedrals.shape)
+
+    def lnhz(epsilon):
+        return lnhzEV(lnhEV, dihedrals, math.log(RHO), epsilon, epsilon_expmean, qcoord=qcoord, layout=layout)
+
+    def calc_yield():
+        h = lnhz(EPSILON)
+        return yield_from_lnhz(h, target_indices, layout), DFG_from_lnhz(h, target_indices, layout)
+    times['yield'], (eta, DFG) = timed(calc_yield, repeat=repeat)
+    checksums['yield'] = float(np.sum(eta))
+
+    times['fe_profile'], profiles = timed(lambda: free_energy_profile_V(lnhz(EPSILON), layout), repeat=repeat)
+    checksums['fe_profile'] = float(np.sum(profiles[np.isfinite(profiles)]))
+
+    def calc_barrier():
+        return [nucleation_barrier(F) for F in free_energy_profile_V(lnhz(EPSILON), layout)]
+    times['barrier'], barriers = timed(calc_barrier, repeat=repeat)
+    checksums['barrier'] = float(sum(barrier[1] for barrier in barriers if barrier[1] != None))
+
+    def calc_incidental():
+        h = lnhz(INCIDENTAL_EPSILON)
+        incidental = incidental_VV(h, adjacents, RHO, INCIDENTAL_W, qdih, qcoord, layout=layout)
+        return on_off_pathway_ratio(h, incidental, layout)
+    times['incidental'], ratio = timed(calc_incidental, repeat=repeat)
+    checksums['incidental'] = float(ratio)
+    return times, {key : (value if math.isfinite(value) else None) for key, value in checksums.items()}
+
+def bench_example(name, directory, clargs):
+    result = {'name' : name}
+    print("%s:" % name)
+    path = os.path.join(directory, 'edges.dat')
+    if os.path.exists(path):
+        result['load'], target = bench_load(path, repeat=clargs.repeat)
+        result['nedges'], result['nvertices'] = target.number_of_edges(), target.number_of_nodes()
+        print("  %d edges, %d vertices; parsed in %.3g s" % (result['nedges'], result['nvertices'], \
+                                                              result['load']['parse']))
+    else:
+        target = None
+
+    times = {}
+    def load_references():
+        return [EVHistogram.load(os.path.join(directory, f + '.dat'))[0] for f in ('lnhEV', 'dihedrals', 'adjacents')]
+    times['load_histograms'], (lnhEV, dihedrals_hist, adjacents_hist) = timed(load_references)
+    layout = lnhEV.storage_layout()
+    dihedrals, dihedrals_meta = load_dihedrals(os.path.join(directory, 'dihedrals.dat'), layout)
+    adjacents = load_histogram(os.path.join(directory, 'adjacents.dat'), layout=layout)[0]
+    result['checksums'] = {}
+    if layout.nvertices >= 1:
+        analysis_times, result['checksums'] = bench_analyses(lnhEV.h, dihedrals, dihedrals_meta, adjacents, layout, \
+                                                             repeat=clargs.repeat)
+        times.update(analysis_times)
+        print("  analyses: " + ", ".join("%s %.3g s" % item for item in analysis_times.items()))
+    else:
+        print("  analyses: skipped; the reference histograms do not have rows E and columns E - V + 1")
+
+    # The sampling benchmarks need a reference lnhEV for this target, and are only run for
+    # targets with at most max_edges (or, for Wang--Landau, wl_max_edges) edges.
+    if target != None and layout.nrows == target.number_of_edges() + 1 \
+       and layout.ncols >= target.number_of_edges() - target.number_of_nodes() + 2 \
+       and (clargs.max_edges == None or target.number_of_edges() <= clargs.max_edges):
+        rates = {}
+        moves = move_set(clargs.vertex_moves, clargs.patch_moves, clargs.max_patch)
+        rates['mc'] = bench_mc(target, lnhEV, clargs.mc_steps, clargs.seed, moves=moves)
+        if clargs.full_engine:
+            rates['mc_full'] = bench_mc(target, lnhEV, clargs.mc_steps, clargs.seed, incremental=False, moves=moves)
+        print("  MC: %s" % ", ".join("%s %.3g steps/s" % item for item in rates.items()))
+        result['mc_steps_per_second'] = rates
+
+        if target.number_of_edges() <= clargs.wl_max_edges:
+            result['wl'] = bench_wl(target, clargs.wl_fmin, clargs.wl_ncheck, clargs.seed, moves=moves)
+            print("  WL: %s" % ", ".join("f = %g %.3g s" % (stage['f'], stage['time']) \
+                                         for stage in result['wl']['stages']))
+            print("  WL acceptance: %s; tunnelling: %s" \
+                  % (", ".join("%s %.3g" % item for item in result['wl']['acceptance'].items()), \
+                     ", ".join("%s %.3g steps" % item for item in result['wl']['tunnel_steps'].items() \
+                               if item[1] != None)))
+
+        nsamples = clargs.samples
+        times['mc_collect'], (mc_dihedrals, mc_adjacents, visits) = \
+            timed(mc_simulate_dihedrals_adjacents_EV, target, lnhEV, dihedrals_meta['qdih'], \
+                  2 * target.number_of_edges(), nsamples, seed=clargs.seed, moves=moves)
+        ncols = EVLayout.from_graph(target, banded=False).ncols
+        references = {'dihedrals' : dihedrals_hist.h[:,:ncols], 'adjacents' : adjacents_hist.h[:,:ncols]}
+        checks = {'sampled' : compare_references({'dihedrals' : mc_dihedrals.h, 'adjacents' : mc_adjacents.h}, \
+                                                 references)}
+
+        if target.number_of_edges() <= clargs.exact_max_edges:
+            times['exact'], (exact_lnhEV, exact_dihedrals, exact_adjacents, counts, bridges) = \
+                timed(enumerate_EV, target, dihedrals_meta['qdih'])
+            checks['exact'] = compare_references({'dihedrals' : exact_dihedrals.h, 'adjacents' : exact_adjacents.h}, \
+                                                 references)
+            checks['exact']['lnhEV'] = {'error' : wl_error_estimate(exact_lnhEV.h, lnhEV.h[:,:ncols]), \
+                                        'same_bins' : bool(np.array_equal(exact_lnhEV.h >= 0, lnhEV.h[:,:ncols] >= 0))}
+        result['checks'] = checks
+        for kind in checks:
+            print("  %s vs reference: " % kind + ", ".join("%s rms %.3g" % (key, check['rms']) \
+                                                          for key, check in checks[kind].items() if 'rms' in check))
+        if 'exact' in checks:
+            print("  exact vs reference: lnhEV error %.3g" % checks['exact']['lnhEV']['error'])
+    result['times'] = times
+    return result
+
+def scaling(results, metric):
+    '''Exponent of a power-law fit of metric(result) against the number of edges'''
+    points = [(result['nedges'], metric(result)) for result in results if 'nedges' in result]
+    points = [(x, y) for x, y in points if y != None and y > 0]
+    if len(set(x for x, y in points)) < 3:
+        return None
+    x, y = np.log(np.array(points, dtype=float)).T
+    return float(np.polyfit(x, y, 1)[0])
+
+def compare_baseline(results, baseline, threshold):
+    '''List the timings that are slower than in baseline by more than the fraction threshold,
+    and the checksums that have changed'''
+    regressions = []
+    previous = {result['name'] : result for result in baseline['examples']}
+    for result in results:
+        old = previous.get(result['name'])
+        if old == None:
+            continue
+        for key, t in result['times'].items():
+            if key in old['times'] and t > (1. + threshold) * old['times'][key]:
+                regressions.append("%s: %s took %.3g s (was %.3g s)" % (result['name'], key, t, old['times'][key]))
+        for key, rate in result.get('mc_steps_per_second', {}).items():
+            old_rate = old.get('mc_steps_per_second', {}).get(key)
+            if old_rate != None and rate * (1. + threshold) < old_rate:
+                regressions.append("%s: %s ran %.3g steps/s (was %.3g steps/s)" % (result['name'], key, rate, old_rate))
+        for key, value in result['checksums'].items():
+            if key in old['checksums'] and value != old['checksums'][key] \
+               and (value == None or old['checksums'][key] == None \
+                    or not math.isclose(value, old['checksums'][key], rel_tol=1.e-9)):
+                regressions.append("%s: %s result changed from %r to %r" \
+                                   % (result['name'], key, old['checksums'][key], value))
+    return regressions
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('examples', type=str, nargs='?', default='examples', \
+                        help="path to examples directory [examples]")
+    parser.add_argument('--select', metavar='NAME', type=str, nargs='+', default=None, \
+                        help="only run the examples whose names contain one of these strings")
+    parser.add_argument('--output', type=str, default='benchmark.json', help="path to output file [benchmark.json]")
+    parser.add_argument('--baseline', metavar='PATH', type=str, default=None, \
+                        help="previous output file to check for regressions")
+    parser.add_argument('--threshold', type=float, default=0.25, \
+                        help="fractional slowdown relative to the baseline that counts as a regression [0.25]")
+    parser.add_argument('--max-edges', metavar='N', type=int, default=200, \
+                        help="only run the sampling benchmarks for targets with at most N edges [200]")
+    parser.add_argument('--exact-max-edges', metavar='N', type=int, default=32, \
+                        help="check the reference files against exact enumeration for targets with at most " \
+                        "N edges [32]")
+    parser.add_argument('--mc-steps', metavar='N', type=int, default=1000000, help="number of timed MC steps [1000000]")
+    parser.add_argument('--full-engine', action='store_true', help="also time the MC steps of the full engine")
+    parser.add_argument('--wl-max-edges', metavar='N', type=int, default=64, \
+                        help="only time Wang--Landau calculations for targets with at most N edges [64]")
+    parser.add_argument('--wl-fmin', metavar='F', type=float, default=0.5, \
+                        help="convergence target fmin of the timed Wang--Landau calculation [0.5]")
+    parser.add_argument('--wl-ncheck', metavar='N', type=int, default=10000, \
+                        help="number of Wang--Landau steps between flatness checks [10000]")
+    parser.add_argument('--vertex-moves', metavar='P', type=float, default=0., \
+                        help="probability of Monte Carlo moves that add or remove a vertex with all of its edges [0]")
+    parser.add_argument('--patch-moves', metavar='P', type=float, default=0., \
+                        help="probability of Monte Carlo moves that add or remove a patch of several edges [0]")
+    parser.add_argument('--max-patch', metavar='N', type=int, default=MOVE_MAX_PATCH, \
+                        help="largest number of edges in a patch move [%d]" % MOVE_MAX_PATCH)
+    parser.add_argument('--samples', metavar='N', type=int, default=20000, \
+                        help="number of MC samples for checking the reference dihedrals and adjacents [20000]")
+    parser.add_argument('--repeat', metavar='N', type=int, default=3, \
+                        help="number of repetitions of the fast benchmarks, of which the best is kept [3]")
+    parser.add_argument('--seed', type=int, default=1, help="random number generator seed [1]")
+    clargs = parser.parse_args()
+
+    if clargs.vertex_moves < 0. or clargs.patch_moves < 0. or clargs.vertex_moves + clargs.patch_moves >= 1. \
+       or clargs.max_patch < 2:
+        print("ERROR: --vertex-moves and --patch-moves must not be negative, and their sum must be below 1; " \
+              "--max-patch must be at least 2")
+        raise SystemExit
+    examples = find_examples(clargs.examples, clargs.select)
+    if len(examples) == 0:
+        print("ERROR: no examples found in", clargs.examples)
+        raise SystemExit
+
+    results = [bench_example(name, directory, clargs) for name, directory in examples]
+    output = {'meta' : {'time' : time.time(), 'python' : platform.python_version(), 'numpy' : np.__version__, \
+                        'platform' : platform.platform(), 'cpu_count' : os.cpu_count(), 'args' : vars(clargs)}, \
+              'examples' : results, \
+              'scaling' : {'parse' : scaling(results, lambda r: r['load']['parse']), \
+                           'mc_step' : scaling(results, lambda r: 1. / r['mc_steps_per_second']['mc'] \
+                                               if 'mc_steps_per_second' in r else None), \
+                           'wl' : scaling(results, lambda r: r['wl']['total'] if 'wl' in r else None), \
+                           'yield' : scaling(results, lambda r: r['times'].get('yield'))}}
+    fits = ["%s ~ E^%.2f" % (key, value) for key, value in output['scaling'].items() if value != None]
+    if len(fits) > 0:
+        print("Scaling with the number of edges: " + ", ".join(fits))
+    print("Writing results to", clargs.output)
+    with open(clargs.output, 'w') as f:
+        json.dump(output, f, indent=1)
+
+    if clargs.baseline != None:
+        with open(clargs.baseline, 'r') as f:
+            regressions = compare_baseline(results, json.load(f), clargs.threshold)
+        for regression in regressions:
+            print("REGRESSION:", regression)
+        if len(regressions) > 0:
+            raise SystemExit(1)
+        print("No regressions relative to", clargs.baseline)
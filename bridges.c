@@ -19,72 +19,92 @@
 
 #include "graph.h"
 
-static void find_bridges_within (graph_t * graph, unsigned short u)
-{
-
-  graph->_dfs_visited[u] = 1;
-  graph->_dfs_discovery[u] = graph->_dfs_low[u] = ++(graph->_dfs_iter);
-
-  size_t i;
-  for (i = 0; i < graph->nvedges[u]; i++)
-    {
-      unsigned short v = graph->edges[u][i];
+#define DFS_NONE ((vertex_t) -1)
 
-      //      printf ("touch %zu %zu, parent %zu\n", u, v, graph->_dfs_parent[u]);
+static void add_removable (graph_t * graph, vertex_t u, vertex_t v)
+{
+  if (u < v)
+    set_edge (graph->removable[graph->nremovable], u, v);
+  else
+    set_edge (graph->removable[graph->nremovable], v, u);
+  graph->nremovable++;
+}
 
-      if (!graph->_dfs_visited[v])
-        {
-	  graph->_dfs_parent[v] = u;
-	  find_bridges_within (graph, v);
+static void discover (graph_t * graph, vertex_t v, vertex_t parent, unsigned long gen, size_t * sp)
+{
+  graph->_dfs_visited[v] = gen;
+  graph->_dfs_discovery[v] = graph->_dfs_low[v] = ++(graph->_dfs_iter);
+  graph->_dfs_parent[v] = parent;
+  graph->_dfs_next[v] = 0;
+  graph->_dfs_stack[(*sp)++] = v;
+}
 
-	  graph->_dfs_low[u] = (graph->_dfs_low[u] < graph->_dfs_low[v]) ? graph->_dfs_low[u] : graph->_dfs_low[v];
+/* Tarjan's algorithm with an explicit stack.  Edges are examined in
+ * the same order as by a recursive depth-first search, so the bridges
+ * and removable edges are listed in the same order.  Vertices count as
+ * visited if they are marked with the current generation, so the
+ * workspace never needs to be cleared. */
+static void find_bridges_within (graph_t * graph, vertex_t root)
+{
+  const unsigned long gen = ++(graph->_dfs_gen);
+  size_t sp = 0;
+  vertex_t u, v, p;
 
-	  if (graph->_dfs_low[v] > graph->_dfs_discovery[u])
+  discover (graph, root, DFS_NONE, gen, &sp);
+  while (sp > 0)
+    {
+      u = graph->_dfs_stack[sp - 1];
+      if (graph->_dfs_next[u] < graph->nvedges[u])
+	{
+	  v = graph->edges[u][graph->_dfs_next[u]];
+	  if (graph->_dfs_visited[v] != gen)
+	    {
+	      /* The edge (u, v) is finished when v is popped. */
+	      discover (graph, v, u, gen, &sp);
+	      continue;
+	    }
+	  graph->_dfs_next[u]++;
+	  if (v != graph->_dfs_parent[u] && graph->_dfs_discovery[v] < graph->_dfs_low[u])
+	    {
+	      graph->_dfs_low[u] = graph->_dfs_discovery[v];
+	    }
+	  if (graph->_dfs_discovery[u] < graph->_dfs_discovery[v])
 	    {
-	      set_edge (graph->bridges[graph->nbridges], u, v);
+	      add_removable (graph, u, v);
+	    }
+	}
+      else if (--sp > 0)
+	{
+	  /* Finish the tree edge (p, u). */
+	  p = graph->_dfs_stack[sp - 1];
+	  graph->_dfs_next[p]++;
+	  if (graph->_dfs_low[u] < graph->_dfs_low[p])
+	    {
+	      graph->_dfs_low[p] = graph->_dfs_low[u];
+	    }
+	  if (graph->_dfs_low[u] > graph->_dfs_discovery[p])
+	    {
+	      set_edge (graph->bridges[graph->nbridges], p, u);
 	      graph->nbridges++;
-	      //	      printf ("found bridge: %zu -- %zu; nvedges %zu %zu\n", u, v, graph->nvedges[u], graph->nvedges[v]);
-	      if (graph->nvedges[u] > 1 && graph->nvedges[v] > 1)
+	      if (graph->nvedges[p] > 1 && graph->nvedges[u] > 1)
 		{
 		  continue;
 		}
 	    }
-        }
-      else if (v != graph->_dfs_parent[u])
-	{
-	  graph->_dfs_low[u] = (graph->_dfs_low[u] < graph->_dfs_discovery[v]) ? graph->_dfs_low[u] : graph->_dfs_discovery[v];
-	}
-
-      if (graph->_dfs_discovery[u] < graph->_dfs_discovery[v])
-	{
-	  //	  printf ("removable: %zu -- %zu\n", u, v);
-	  if (u < v)
-	    set_edge (graph->removable[graph->nremovable], u, v);
-	  else
-	    set_edge (graph->removable[graph->nremovable], v, u);
-	  graph->nremovable++;
+	  add_removable (graph, p, u);
 	}
     }
 }
- 
+
 void graph_find_bridges (graph_t * graph)
 {
   graph->nbridges = 0;
   graph->nremovable = 0;
   graph->_dfs_iter = 0;
 
-  //  printf ("bridges calculation...\n");
-  //  print_graph (graph);
-
-  size_t i;
-  for (i = 0; i < graph->max_nvertices; i++)
-    {
-      graph->_dfs_visited[i] = 0;
-      graph->_dfs_parent[i] = -1;
-    }
- 
   /* Assume only one connected component. */
 
+  size_t i;
   for (i = 0; i < graph->max_nvertices; i++)
     {
       if (graph->nvedges[i] > 0)
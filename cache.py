@@ -0,0 +1,227 @@
+# Copyright (C) 2014 William M. Jacobs
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or (at
+# your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import fcntl, hashlib, json, os, shutil, tempfile, time
+from contextlib import contextmanager
+import numpy as np
+import networkx as nx
+
+# Results are cached in directories named by the hash of the structure and the parameters
+# that produced them (see ResultCache).  The structure hash is computed here rather than with
+# networkx, whose graph hashes are not stable between versions.
+DEFAULT_CACHE_SIZE = 1 << 30
+ENTRY_FILE = 'entry.json'
+LOCK_FILE = '.lock'
+TMP_PREFIX = '.tmp-'
+TMP_MAX_AGE = 86400.
+
+def default_cache_dir():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser(os.path.join('~', '.cache'))), 'pygtsa')
+
+def _vertex_edges(graph):
+    '''The number of vertices and an (nedges, 2) array of the edges, with the vertices numbered in graph order'''
+    index = {v : i for i, v in enumerate(graph.nodes())}
+    edges = np.array([(index[u], index[v]) for u, v in graph.edges()], dtype=np.int64).reshape(-1, 2)
+    return len(index), edges
+
+def _mix(x):
+    '''The splitmix64 finalizer, applied elementwise to a uint64 array'''
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xbf58476d1ce4e5b9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+def structure_hash(graph):
+    '''Hash of a graph that does not depend on the labels or the order of its vertices and edges
+
+    The vertices are coloured by colour refinement (as in the Weisfeiler--Lehman test), starting
+    from their degrees and combining each colour with the sum of the mixed colours of the
+    neighbours, until the number of colours stops growing; the hash is a digest of the sorted
+    colours.  Isomorphic graphs have the same hash, but some non-isomorphic graphs do too.'''
+    nvertices, edges = _vertex_edges(graph)
+    source = np.concatenate((edges[:,0], edges[:,1]))
+    target = np.concatenate((edges[:,1], edges[:,0]))
+    order = np.argsort(source, kind='stable')
+    target = target[order]
+    degrees = np.bincount(source, minlength=nvertices)
+    starts = np.concatenate(([0], np.cumsum(degrees)[:-1]))
+    has_edges = degrees > 0
+    colors = _mix(degrees.astype(np.uint64))
+    ncolors = len(np.unique(colors))
+    with np.errstate(over='ignore'):
+        for iteration in range(nvertices):
+            sums = np.zeros(nvertices, dtype=np.uint64)
+            if len(target) > 0:
+                sums[has_edges] = np.add.reduceat(_mix(colors[target]), starts[has_edges])
+            refined = _mix(colors ^ _mix(sums + np.uint64(iteration + 1)))
+            nrefined = len(np.unique(refined))
+            colors = refined
+            if nrefined <= ncolors:
+                break
+            ncolors = nrefined
+    h = hashlib.sha1()
+    h.update(np.array([nvertices, len(edges)], dtype='<i8').tobytes())
+    h.update(np.sort(colors).astype('<u8').tobytes())
+    return h.hexdigest()
+
+class ResultCache(object):
+    '''Size-bounded on-disk cache of result files, keyed by a structure and a dict of parameters
+
+    Structures that differ only in the labels or order of their vertices and edges share
+    entries; a match of the structure hash is confirmed with an isomorphism test, and structures
+    whose hashes collide are stored in separate slots of the same key.  Each entry is a
+    directory of files, which is written under a temporary name and renamed into place when it
+    is complete, and is never modified after that, so that several processes can use the same
+    cache.  Entries in use (see lookup) are protected
+    from eviction by a shared lock on the cache directory; when the total size exceeds max_bytes,
+    the least recently used entries are removed under an exclusive lock.'''
+    def __init__(self, directory=None, max_bytes=DEFAULT_CACHE_SIZE):
+        self.directory = directory if directory != None else default_cache_dir()
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, graph, params):
+        return hashlib.sha1(json.dumps({'structure' : structure_hash(graph), 'params' : params}, \
+                                       sort_keys=True).encode('utf-8')).hexdigest()
+
+    @contextmanager
+    def _lock(self, exclusive):
+        with open(os.path.join(self.directory, LOCK_FILE), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _slots(self, key):
+        '''The paths of the existing entries for key, which are named key-0, key-1, ...
+
+        Structures with the same hash that are not isomorphic are stored in different slots.'''
+        prefix = key + '-'
+        slots = []
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                slots.append((int(name[len(prefix):]), os.path.join(self.directory, name)))
+        return [entry for n, entry in sorted(slots)]
+
+    def _find(self, key, graph):
+        '''The path and record of the entry for key that holds a structure isomorphic to graph, or None'''
+        for entry in self._slots(key):
+            record = self._matches(entry, graph)
+            if record != None:
+                return entry, record
+        return None
+
+    @staticmethod
+    def _matches(entry, graph):
+        '''The record of entry if it holds the results for a structure isomorphic to graph, or None'''
+        try:
+            with open(os.path.join(entry, ENTRY_FILE), 'r') as f:
+                record = json.load(f)
+            stored = nx.Graph()
+            stored.add_nodes_from(range(record['nvertices']))
+            stored.add_edges_from(np.load(os.path.join(entry, 'edges.npy')).tolist())
+        except (OSError, ValueError, KeyError):
+            return None
+        return record if nx.vf2pp_is_isomorphic(nx.Graph(graph), stored) else None
+
+    @contextmanager
+    def lookup(self, graph, params):
+        '''Context giving a dict of the paths of the cached files for graph and params, or None
+
+        The files cannot be evicted until the context exits.'''
+        key = self.key(graph, params)
+        with self._lock(False):
+            found = self._find(key, graph)
+            if found == None:
+                yield None
+                return
+            entry, record = found
+            os.utime(os.path.join(entry, ENTRY_FILE))
+            yield {name : os.path.join(entry, filename) for name, filename in record['files'].items()}
+
+    def store(self, graph, params, files):
+        '''Copy files, a dict mapping names to paths, into the entry for graph and params
+
+        An existing entry for an isomorphic structure is kept, and a structure with the same
+        hash that is not isomorphic is stored in the next free slot.  Returns True if the files
+        were stored.'''
+        key = self.key(graph, params)
+        if self._find(key, graph) != None:
+            return False
+        tmp = tempfile.mkdtemp(prefix=TMP_PREFIX, dir=self.directory)
+        try:
+            nvertices, edges = _vertex_edges(graph)
+            np.save(os.path.join(tmp, 'edges.npy'), edges)
+            record = {'nvertices' : nvertices, 'params' : params, 'time' : time.time(), 'files' : {}}
+            for name, path in files.items():
+                record['files'][name] = name + os.path.splitext(path)[1]
+                shutil.copyfile(path, os.path.join(tmp, record['files'][name]))
+            with open(os.path.join(tmp, ENTRY_FILE), 'w') as f:
+                json.dump(record, f, sort_keys=True)
+            # Another process may fill the free slot first, in which case the rename fails.
+            while True:
+                slots = self._slots(key)
+                if any(self._matches(entry, graph) != None for entry in slots):
+                    shutil.rmtree(tmp, ignore_errors=True)
+                    return False
+                used = set(os.path.basename(entry) for entry in slots)
+                n = next(n for n in range(len(slots) + 1) if '%s-%d' % (key, n) not in used)
+                entry = os.path.join(self.directory, '%s-%d' % (key, n))
+                try:
+                    os.rename(tmp, entry)
+                    break
+                except OSError:
+                    if not os.path.exists(entry):
+                        raise
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            return False
+        self.evict()
+        return True
+
+    def entries(self):
+        '''The entries, as (last used time, size in bytes, path), from the least recently used'''
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                entries.append((os.path.getmtime(os.path.join(path, ENTRY_FILE)), size, path))
+            except OSError:
+                continue
+        return sorted(entries)
+
+    def evict(self):
+        '''Remove the least recently used entries until the cache fits in max_bytes, and stale temporary files'''
+        with self._lock(True):
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                try:
+                    if name.startswith(TMP_PREFIX) and time.time() - os.path.getmtime(path) > TMP_MAX_AGE:
+                        shutil.rmtree(path, ignore_errors=True)
+                except OSError:
+                    continue
+            entries = self.entries()
+            total = sum(size for used, size, path in entries)
+            for used, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
@@ -16,8 +16,8 @@
 
 import argparse, math
 import numpy as np
-from pygtsa.histogram import EVHistogram, read_histogram, read_meta
-from pygtsa.calc_yield import load_dihedrals, find_target_indices, lnhzEV
+from pygtsa.histogram import EVHistogram, load_histogram
+from pygtsa.calc_yield import load_dihedrals, find_target_indices, epsilon_range, rho_range, lnhzEV
 from pygtsa.calc_fe_profile import free_energy_profile_V
 
 def barrier_peak(F):
@@ -56,6 +56,19 @@ def nucleation_barrier(F):
                 Vmax = Fb.argmax() + minima[0][-1]
         return Vmax, Fmax
 
+def write_barrier(stream, lnhEV, dihedrals, dihedrals_meta, epsilon, rho, epsilon_expmean, layout=None):
+    '''Write the nucleation barrier for each density in rho and each epsilon, as text'''
+    stream.write("# epsilon rho nucleation_barrier_V nucleation_barrier_fe\n")
+    for r in rho:
+        lnhz = lnhzEV(lnhEV, dihedrals, math.log(r), epsilon, epsilon_expmean, qcoord=dihedrals_meta['qcoord'], \
+                      layout=layout)
+        profiles = free_energy_profile_V(lnhz, layout)
+        for k in range(len(epsilon)):
+            barrier = nucleation_barrier(profiles[k])
+            if barrier[0] == None:
+                barrier = (0, 0.)
+            stream.write("%g %g %d %g\n" % (epsilon[k], r, barrier[0], barrier[1]))
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
@@ -63,6 +76,9 @@ if __name__ == '__main__':
     parser.add_argument('dihedrals', type=str, help="path to dihedrals file")
     parser.add_argument('rho', type=float, help="dimensionless number density")
     parser.add_argument('--output', type=str, default='barrier.dat', help="path to output file [barrier.dat]")
+    parser.add_argument('--rho-max', metavar='RHO', type=float, default=None, \
+                        help="maximum density, for a logarithmically spaced sweep starting at rho [None]")
+    parser.add_argument('--nrho', metavar='N', type=int, default=1, help="number of densities in the sweep [1]")
     subparsers = parser.add_subparsers(dest='variance')
     parser_zero = subparsers.add_parser('zero-var')
     parser_const = subparsers.add_parser('const-var')
@@ -78,32 +94,21 @@ if __name__ == '__main__':
         print("error: variance mode not specified")
         raise SystemExit
 
-    with open(clargs.lnhEV, 'r') as f:
-        lnhEV = read_histogram(f)
-    with open(clargs.dihedrals, 'r') as f:
-        dihedrals, dihedrals_meta = load_dihedrals(f)
+    lnhEV = EVHistogram.load(clargs.lnhEV)[0]
+    layout = lnhEV.storage_layout()
+    lnhEV = lnhEV.h
+    dihedrals, dihedrals_meta = load_dihedrals(clargs.dihedrals, layout)
     target_indices = find_target_indices(dihedrals)
 
     if clargs.variance == 'const-var':
-        with open(clargs.distribution, 'r') as f:
-            epsilon_expmean = read_histogram(f)
+        epsilon_expmean = load_histogram(clargs.distribution, layout=layout)[0]
         epsilon_expmean -= epsilon_expmean[max(target_indices)]
     else:
         epsilon_expmean = np.zeros(dihedrals.shape)
 
-    mu = math.log(clargs.rho)
-    epsilon = clargs.Emin
-    barrier = {}
-    while epsilon < clargs.Emax + clargs.dE:
-        lnhz = lnhzEV(lnhEV, dihedrals, mu, epsilon, epsilon_expmean, qcoord=dihedrals_meta['qcoord'])
-        profile = free_energy_profile_V(lnhz)
-        barrier[epsilon] = nucleation_barrier(profile)
-        if barrier[epsilon][0] == None:
-            barrier[epsilon] = (0, 0.)
-        epsilon += clargs.dE
+    epsilon = epsilon_range(clargs.Emin, clargs.Emax, clargs.dE)
+    rho = rho_range(clargs.rho, clargs.rho_max, clargs.nrho)
 
     print("Writing output to %s" % clargs.output)
     with open(clargs.output, 'w') as f:
-        f.write("# epsilon rho nucleation_barrier_V nucleation_barrier_fe\n")
-        for epsilon in sorted(barrier.keys()):
-            f.write("%g %g %d %g\n" % (epsilon, clargs.rho, barrier[epsilon][0], barrier[epsilon][1]))
+        write_barrier(f, lnhEV, dihedrals, dihedrals_meta, epsilon, rho, epsilon_expmean, layout)
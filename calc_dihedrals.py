@@ -0,0 +1,46 @@
+# Copyright (C) 2014 William M. Jacobs
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or (at
+# your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import argparse
+from pygtsa.histogram import EVHistogram, EVBHistogram, BINARY_EXTENSION
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Calculate dihedrals files for one or more values of qdih "
+                                     "from the dihedral counts written by calc_subgraphs.")
+    parser.add_argument('counts', type=str, help="path to dihedral counts file")
+    parser.add_argument('qdih', type=float, nargs='+', help="dihedral angle connective constant(s)")
+    parser.add_argument('--qcoord', metavar='Q', type=float, default=None, \
+                        help="monomer rotation constant [taken from the counts file]")
+    parser.add_argument('--output-prefix', metavar='PATH', type=str, default='./', help="path to output files [./]")
+    parser.add_argument('--format', choices=('text', 'binary'), default='text', \
+                        help="histogram file format: text (.dat) or binary (%s) [text]" % BINARY_EXTENSION)
+    clargs = parser.parse_args()
+
+    if clargs.output_prefix != '' and clargs.output_prefix[-1] != '/':
+        clargs.output_prefix = clargs.output_prefix + '_'
+    ext = '.dat' if clargs.format == 'text' else BINARY_EXTENSION
+
+    counts, meta = EVBHistogram.load(clargs.counts)
+    qcoord = clargs.qcoord if clargs.qcoord != None else float(meta['qcoord'][-1])
+
+    dihedrals = counts.dihedrals(clargs.qdih)
+    for qdih, h in zip(clargs.qdih, dihedrals):
+        path = clargs.output_prefix + ('dihedrals' if len(clargs.qdih) == 1 else 'dihedrals_qdih%g' % qdih) + ext
+        print("Writing average dihedral entropy loss for qdih = %g to %s" % (qdih, path))
+        hist = EVHistogram(None)
+        hist.h = h
+        hist.save(path, {'qcoord' : "%g" % qcoord, 'qdih' : "%g" % qdih})
@@ -14,10 +14,21 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
-import argparse, random
+import argparse
+import numpy as np
 from pygtsa.structure import Assembly
-from pygtsa.histogram import EVHistogram
-from pygtsa.cgraph import mc_simulate_energies_EV
+from pygtsa.histogram import EVHistogram, BINARY_EXTENSION
+from pygtsa.cgraph import Graph, mc_simulate_energies_EV, move_set, MOVE_MAX_PATCH
+from pygtsa.samples import SampleReader, SAMPLES_EXTENSION
+from pygtsa.calc_subgraphs import MC_STEPS_PER_EDGE, MC_SAMPLES_PER_BIN, MC_MAX_SAMPLES_PER_BIN
+
+def write_bond_energies(stream, edges, bond_energies):
+    '''Write the nsamples x nedges array of bond energies, one line per edge, as text'''
+    for j in range(len(edges)):
+        stream.write("%d -- %d:" % edges[j])
+        for i in range(bond_energies.shape[0]):
+            stream.write(" %g" % bond_energies[i,j])
+        stream.write("\n")
 
 if __name__ == '__main__':
 
@@ -33,46 +44,100 @@ if __name__ == '__main__':
                                  help="number of independent energy samples [100]")
     parser_gaussian.add_argument('--output-prefix', metavar='PATH', type=str, default='./', \
                                  help="path to output files [./]")
+    parser_gaussian.add_argument('--format', choices=('text', 'binary'), default='text', \
+                                 help="histogram file format: text (.dat) or binary (%s) [text]" % BINARY_EXTENSION)
+    parser_gaussian.add_argument('--seed', type=int, default=None, help="random number generator seed [None]")
+    parser_gaussian.add_argument('--chains', metavar='N', type=int, default=1, \
+                                 help="number of independent Monte Carlo chains, run on parallel threads [1]")
+    parser_gaussian.add_argument('--samples', metavar='PATH', type=str, default=None, \
+                                 help="average over the fragments in this sample file (written with --record, "
+                                 "here or by calc_subgraphs) instead of sampling [None]")
+    parser_gaussian.add_argument('--record', action='store_true', \
+                                 help="append every sampled fragment to fragments%s" % SAMPLES_EXTENSION)
+    parser_gaussian.add_argument('--error-tolerance', metavar='TOL', type=float, default=0., \
+                                 help="sample until the standard error of the average energy is at most TOL in " \
+                                 "every bin, or with 0, collect %d samples per bin [0]" % MC_SAMPLES_PER_BIN)
+    parser_gaussian.add_argument('--max-samples-per-bin', metavar='N', type=int, default=MC_MAX_SAMPLES_PER_BIN, \
+                                 help="largest number of samples per bin with --error-tolerance [%d]" \
+                                 % MC_MAX_SAMPLES_PER_BIN)
+    parser_gaussian.add_argument('--vertex-moves', metavar='P', type=float, default=0., \
+                                 help="probability of moves that add or remove a vertex with all of its edges [0]")
+    parser_gaussian.add_argument('--patch-moves', metavar='P', type=float, default=0., \
+                                 help="probability of moves that add or remove a patch of several edges [0]")
+    parser_gaussian.add_argument('--max-patch', metavar='N', type=int, default=MOVE_MAX_PATCH, \
+                                 help="largest number of edges in a patch move [%d]" % MOVE_MAX_PATCH)
     clargs = parser.parse_args()
 
     if clargs.distribution == None:
         raise Exception("please select a distribution")
+    if clargs.error_tolerance < 0. or clargs.max_samples_per_bin < 1:
+        print("ERROR: --error-tolerance must not be negative, and --max-samples-per-bin must be positive")
+        raise SystemExit
+    if clargs.vertex_moves < 0. or clargs.patch_moves < 0. or clargs.vertex_moves + clargs.patch_moves >= 1. \
+       or clargs.max_patch < 2:
+        print("ERROR: --vertex-moves and --patch-moves must not be negative, and their sum must be below 1; " \
+              "--max-patch must be at least 2")
+        raise SystemExit
 
     # Initialize
 
     target = Assembly.read(clargs.structure)
-    with open(clargs.lnhEV, 'r') as f:
-        lnhEV = EVHistogram.read(f)
+    lnhEV = EVHistogram.load(clargs.lnhEV)[0]
 
     if clargs.output_prefix != '' and clargs.output_prefix[-1] != '/':
         clargs.output_prefix = clargs.output_prefix + '_'
+    ext = '.dat' if clargs.format == 'text' else BINARY_EXTENSION
 
     # Sample energies
 
+    # Bond energies are stored as an nsamples x nedges array, in the edge order of the C graph.
+    edges = list(Graph(target).edges_iter())
+    rng = np.random.default_rng(clargs.seed)
     if clargs.distribution == 'gaussian':
-        energy_dicts = [{E : random.normalvariate(clargs.mean, clargs.stddev) for E in target.edges()} \
-                        for i in range(clargs.nsamples)]
+        bond_energies = rng.normal(clargs.mean, clargs.stddev, size=(clargs.nsamples, len(edges)))
     print("Writing energy samples to", clargs.output_prefix + 'bonds.dat')
     with open(clargs.output_prefix + 'bonds.dat', 'w') as f:
-        for E in target.edges():
-            f.write("%d -- %d:" % E)
-            for i in range(len(energy_dicts)):
-                f.write(" %g" % energy_dicts[i][E])
-            f.write("\n")
+        write_bond_energies(f, edges, bond_energies)
 
     # Calculate dihedrals and adjacents
 
     print("Calculating energy averages...")
-    nsteps = 2 * target.number_of_edges()
-    nsamples = 4000 * sum(sum(1 for j in range(lnhEV.h.shape[1]) if lnhEV.h[i,j] >= 0.) \
-                          for i in range(lnhEV.h.shape[0]))
-    print("Collecting %d samples with %d steps between samples." % (nsamples, nsteps))
-    energies, visits = mc_simulate_energies_EV(target, lnhEV, energy_dicts, nsteps, nsamples)
-
-    print("Writing average energies to", clargs.output_prefix + 'energies.dat')
-    with open(clargs.output_prefix + 'energies.dat', 'w') as f:
-        f.write("# average energies (%s distribution)\n" % clargs.distribution)
-        energies.write(f)
-    print("Writing sampling histogram to", clargs.output_prefix + 'sampling_visits.dat')
-    with open(clargs.output_prefix + 'sampling_visits.dat', 'w') as f:
-        visits.write(f)
+    errors = None
+    if clargs.samples != None:
+        reader = SampleReader(clargs.samples)
+        reader.check(edges)
+        print("Reading %d samples from %s." % (reader.nsamples, clargs.samples))
+        energies, visits = reader.mean_energies(bond_energies, layout=(lnhEV.layout if lnhEV.banded() else None))
+    else:
+        nsteps = MC_STEPS_PER_EDGE * target.number_of_edges()
+        nbins = int(np.count_nonzero(lnhEV.h >= 0.))
+        adaptive = clargs.error_tolerance > 0.
+        samples = clargs.output_prefix + 'fragments' + SAMPLES_EXTENSION if clargs.record else None
+        if adaptive:
+            nsamples = clargs.max_samples_per_bin * nbins
+            print("Collecting samples until the standard errors are at most %g in every bin, up to %d samples, " \
+                  "starting with %d steps between samples." % (clargs.error_tolerance, nsamples, nsteps))
+        else:
+            nsamples = MC_SAMPLES_PER_BIN * nbins
+            print("Collecting %d samples with %d steps between samples." % (nsamples, nsteps))
+        if clargs.record:
+            print("Appending sampled fragments to", samples)
+        results = mc_simulate_energies_EV(target, lnhEV, bond_energies, nsteps, nsamples, seed=clargs.seed, \
+                                          nchains=clargs.chains, samples=samples, \
+                                          tolerance=clargs.error_tolerance if adaptive else None, verbose=True, \
+                                          moves=move_set(clargs.vertex_moves, clargs.patch_moves, clargs.max_patch))
+        energies, visits = results[:2]
+        if adaptive:
+            errors = results[2]
+            print("Collected %d samples; the integrated autocorrelation time is %.3g steps." \
+                  % (errors['nsamples'], errors['tau']))
+
+    print("Writing average energies to", clargs.output_prefix + 'energies' + ext)
+    energies.save(clargs.output_prefix + 'energies' + ext, \
+                  {'average' : ['energies', "(%s" % clargs.distribution, 'distribution)']})
+    if errors != None:
+        print("Writing standard errors of the average energies to", clargs.output_prefix + 'energies_error' + ext)
+        errors['energies'].save(clargs.output_prefix + 'energies_error' + ext, \
+                                {'tolerance' : "%g" % clargs.error_tolerance})
+    print("Writing sampling histogram to", clargs.output_prefix + 'sampling_visits' + ext)
+    visits.save(clargs.output_prefix + 'sampling_visits' + ext)
@@ -16,26 +16,29 @@
 
 import argparse, math
 import numpy as np
-from pygtsa.histogram import EVHistogram, read_histogram, read_meta
-from pygtsa.calc_yield import load_dihedrals, find_target_indices, lnhzEV
+from pygtsa.histogram import EVHistogram, EVLayout, load_histogram
+from pygtsa.calc_yield import load_dihedrals, find_target_indices, logsumexp, lnhzEV
 
-def free_energy_profile_V(lnhz):
-    F = np.zeros(lnhz.shape[0] - lnhz.shape[1] + 3)
-    lnhzmax_V = np.zeros(lnhz.shape[0] - lnhz.shape[1] + 3)
-    for i in range(lnhz.shape[0]):
-        for j in range(lnhz.shape[1]):
-            V = i - j + 1
-            if np.isfinite(lnhz[i,j]) and lnhz[i,j] > lnhzmax_V[V]:
-                lnhzmax_V[V] = lnhz[i,j]
-    for i in range(lnhz.shape[0]):
-        for j in range(lnhz.shape[1]):
-            V = i - j + 1
-            if np.isfinite(lnhz[i,j]):
-                F[V] += math.exp(lnhz[i,j] - lnhzmax_V[V])
-    for V in range(1, len(F)):
-        F[V] = -math.log(F[V]) - lnhzmax_V[V]
+def free_energy_profile_V(lnhz, layout=None):
+    '''Calculate F(V) for each lnhz in the (leading dimensions of the) array'''
+    if layout == None:
+        layout = EVLayout.of_array(lnhz)
+    V = layout.V
+    F = np.zeros(lnhz.shape[:lnhz.ndim - V.ndim] + (layout.nvertices + 1,))
+    for v in range(1, F.shape[-1]):
+        F[...,v] = -logsumexp(lnhz[...,V == v], axis=-1)
     return F
 
+def write_fe_profile(stream, lnhEV, dihedrals, dihedrals_meta, epsilon, rho, epsilon_expmean, layout=None):
+    '''Write F(V) at a single epsilon and density rho, as text'''
+    lnhz = lnhzEV(lnhEV, dihedrals, math.log(rho), epsilon, epsilon_expmean, qcoord=dihedrals_meta['qcoord'], \
+                  layout=layout)
+    profile = free_energy_profile_V(lnhz, layout)
+    stream.write("# epsilon = %g\n" % epsilon)
+    stream.write("# V F(V)\n")
+    for i in range(1, len(profile)):
+        stream.write("%g %g\n" % (i, profile[i]))
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
@@ -56,26 +59,18 @@ if __name__ == '__main__':
         print("error: variance mode not specified")
         raise SystemExit
 
-    with open(clargs.lnhEV, 'r') as f:
-        lnhEV = read_histogram(f)
-    with open(clargs.dihedrals, 'r') as f:
-        dihedrals, dihedrals_meta = load_dihedrals(f)
+    lnhEV = EVHistogram.load(clargs.lnhEV)[0]
+    layout = lnhEV.storage_layout()
+    lnhEV = lnhEV.h
+    dihedrals, dihedrals_meta = load_dihedrals(clargs.dihedrals, layout)
     target_indices = find_target_indices(dihedrals)
 
     if clargs.variance == 'const-var':
-        with open(clargs.distribution, 'r') as f:
-            epsilon_expmean = read_histogram(f)
+        epsilon_expmean = load_histogram(clargs.distribution, layout=layout)[0]
         epsilon_expmean -= epsilon_expmean[max(target_indices)]
     else:
         epsilon_expmean = np.zeros(dihedrals.shape)
 
-    mu = math.log(clargs.rho)
-    lnhz = lnhzEV(lnhEV, dihedrals, mu, clargs.E, epsilon_expmean, qcoord=dihedrals_meta['qcoord'])
-    profile = free_energy_profile_V(lnhz)
-
     print("Writing output to %s" % clargs.output)
     with open(clargs.output, 'w') as f:
-        f.write("# epsilon = %g\n" % clargs.E)
-        f.write("# V F(V)\n")
-        for i in range(1, len(profile)):
-            f.write("%g %g\n" % (i, profile[i]))
+        write_fe_profile(f, lnhEV, dihedrals, dihedrals_meta, clargs.E, clargs.rho, epsilon_expmean, layout)
@@ -16,8 +16,8 @@
 
 import argparse, math
 import numpy as np
-from pygtsa.histogram import EVHistogram, read_histogram, read_meta
-from pygtsa.calc_yield import load_dihedrals, find_target_indices, lnhzEV
+from pygtsa.histogram import EVHistogram, EVLayout, load_histogram
+from pygtsa.calc_yield import load_dihedrals, find_target_indices, logsumexp, lnhzEV
 
 def multivalentQ(n1, n2, w, qdih, qcoord, frac_attractive=1., maxk=None):
     n1 = int(n1 * frac_attractive)
@@ -38,39 +38,85 @@ def multivalentQ(n1, n2, w, qdih, qcoord, frac_attractive=1., maxk=None):
         Q += (prod * k * w) / (qdih**(2 * k - 1) * qcoord)
     return Q
 
-def incidental_VV(lnhz, adjacents, rho, w, qdih, qcoord, frac_attractive=1.):
-    N = lnhz.shape[0] - lnhz.shape[1] + 2
-    Zin = np.zeros((N + 1, N + 1))
-    for i in range(lnhz.shape[0]):
-        for j in range(lnhz.shape[1]):
-            E1 = i
-            V1 = E1 - j + 1
-            for ii in range(lnhz.shape[0]):
-                for jj in range(lnhz.shape[1]):
-                    E2 = ii
-                    V2 = E2 - jj + 1
-                    if np.isfinite(lnhz[i,j]) and np.isfinite(lnhz[ii,jj]) and adjacents[i,j] > 0 and adjacents[ii,jj] > 0:
-                        lnhzz = lnhz[i,j] + lnhz[ii,jj]
-                        Q = multivalentQ(adjacents[i,j], adjacents[ii,jj], w, qdih, qcoord, frac_attractive=frac_attractive)
-                        if i == j and ii == jj:
-                            Zin[V1,V2] += Q * rho * math.exp(lnhzz) / 2.
-                        else:
-                            Zin[V1,V2] += Q * rho * math.exp(lnhzz)
-    return Zin
-
-def on_off_pathway_ratio(lnhz, incidental):
-    Zid = 0.
-    for i in range(lnhz.shape[0]):
-        for j in range(lnhz.shape[1]):
-            if np.isfinite(lnhz[i,j]):
-                V = i - j + 1
-                Zid += math.exp(lnhz[i,j])
-    Zin = 0.
-    for i in range(incidental.shape[0]):
-        for j in range(incidental.shape[1]):
-            Zin += incidental[i,j]
+def multivalent_lnQ(n1, n2, qdih, qcoord):
+    '''Calculate ln(Q / w) for every pair of adjacent-edge counts in n1 and n2; see multivalentQ'''
+    n1 = np.asarray(n1, dtype=int)[:,None]
+    n2 = np.asarray(n2, dtype=int)[None,:]
+    nmax = max(n1.max(initial=0), n2.max(initial=0))
+    lnfact = np.concatenate(([0.], np.cumsum(np.log(np.arange(1, nmax + 1)))))
+    lnQ = np.full((n1.shape[0], n2.shape[1]), -np.inf)
+    for k in range(1, nmax + 1):
+        valid = (n1 >= k) & (n2 >= k)
+        lnterm = (lnfact[n1] - lnfact[k] - lnfact[np.maximum(n1 - k, 0)] + lnfact[n2] - lnfact[np.maximum(n2 - k, 0)] \
+                  + math.log(k) - (2 * k - 1) * math.log(qdih) - math.log(qcoord))
+        lnQ = np.logaddexp(lnQ, np.where(valid, lnterm, -np.inf))
+    return lnQ
+
+def incidental_VV(lnhz, adjacents, rho, w, qdih, qcoord, frac_attractive=1., layout=None):
+    '''Calculate the incidental-dimer partition function Zin[V1,V2]
+
+    The sum over pairs of (E, V) bins is reduced to sums over the bins with each V and
+    number of adjacent edges, which are combined with a table of multivalentQ.  lnhz may
+    have leading dimensions (e.g. from lnhzEV with an array of epsilon values), and w
+    broadcasts against them.'''
+    if layout == None:
+        layout = EVLayout.of_array(lnhz)
+    N = layout.nvertices
+    E, V = layout.E, layout.V
+    j = E - V + 1
+    lead = lnhz.shape[:lnhz.ndim - E.ndim]
+    cells = (adjacents > 0) & (V >= 1) & (V <= N)
+    nadjacents, a = np.unique((adjacents[cells] * frac_attractive).astype(int), return_inverse=True)
+    lnQ = multivalent_lnQ(nadjacents, nadjacents, qdih, qcoord)
+    if not np.isfinite(lnQ).any():
+        return np.zeros(np.broadcast_shapes(np.shape(w), lead) + (N + 1, N + 1))
+
+    # ln sum exp(lnhz) over the bins with each V and number of adjacents, keeping the
+    # single-vertex bins separate, since each pair of them is only counted once.
+    half = (E == j)[cells].astype(int)
+    groups = (half * (N + 1) + V[cells]) * len(nadjacents) + a.ravel()
+    lnhz_cells = np.moveaxis(lnhz[...,cells], -1, 0)
+    lnA_max = np.full((2 * (N + 1) * len(nadjacents),) + lead, -np.inf)
+    np.maximum.at(lnA_max, groups, lnhz_cells)
+    lnA_max = np.where(np.isfinite(lnA_max), lnA_max, 0.)
+    A = np.zeros(lnA_max.shape)
+    np.add.at(A, groups, np.exp(lnhz_cells - lnA_max[groups]))
+    with np.errstate(divide='ignore'):
+        lnA = np.moveaxis(np.log(A) + lnA_max, 0, -1).reshape(lead + (2, N + 1, len(nadjacents)))
+
+    shift = np.max(lnA, axis=(-3,-2,-1), keepdims=True, initial=-np.inf)
+    shift = np.where(np.isfinite(shift), shift, 0.)
+    X = np.exp(lnA - shift)
+    Qmax = lnQ[np.isfinite(lnQ)].max()
+    XQ = X @ np.exp(lnQ - Qmax)
+    X0, X1, XQ0, XQ1 = X[...,0,:,:], X[...,1,:,:], XQ[...,0,:,:], XQ[...,1,:,:]
+    XT = lambda Y: np.swapaxes(Y, -1, -2)
+    Zin = XQ0 @ XT(X0) + XQ0 @ XT(X1) + XQ1 @ XT(X0) + 0.5 * (XQ1 @ XT(X1))
+    with np.errstate(over='ignore'):
+        return Zin * (rho * np.asarray(w)[...,None,None] * np.exp(2. * shift[...,0,:,:] + Qmax))
+
+def on_off_pathway_ratio(lnhz, incidental, layout=None):
+    Zid = np.exp(logsumexp(lnhz, axis=(layout.axes if layout != None else (-2,-1))))
+    Zin = np.sum(incidental, axis=(-2,-1))
     return Zid / Zin
 
+def write_incidental(stream, lnhEV, dihedrals, dihedrals_meta, adjacents, epsilon, rho, w, epsilon_expmean, \
+                     layout=None):
+    '''Write Zin(V1,V2) at a single epsilon and density rho, as text, and return the on/off pathway ratio'''
+    lnhz = lnhzEV(lnhEV, dihedrals, math.log(rho), epsilon, epsilon_expmean, qcoord=dihedrals_meta['qcoord'], \
+                  layout=layout)
+    incidental = incidental_VV(lnhz, adjacents, rho, w, dihedrals_meta['qdih'], dihedrals_meta['qcoord'], \
+                               layout=layout)
+    on_off_ratio = on_off_pathway_ratio(lnhz, incidental, layout)
+    stream.write("# epsilon = %g\n" % epsilon)
+    stream.write("# on/off pathway ratio = %g\n" % on_off_ratio)
+    stream.write("# V1 V2 Zin(V1,V2)\n")
+    for i in range(1, incidental.shape[0]):
+        for j in range(1, incidental.shape[1]):
+            stream.write("%g %g %g\n" % (i, j, incidental[i,j]))
+        stream.write("\n")
+    return on_off_ratio
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
@@ -93,34 +139,21 @@ if __name__ == '__main__':
         print("error: variance mode not specified")
         raise SystemExit
 
-    with open(clargs.lnhEV, 'r') as f:
-        lnhEV = read_histogram(f)
-    with open(clargs.dihedrals, 'r') as f:
-        dihedrals, dihedrals_meta = load_dihedrals(f)
+    lnhEV = EVHistogram.load(clargs.lnhEV)[0]
+    layout = lnhEV.storage_layout()
+    lnhEV = lnhEV.h
+    dihedrals, dihedrals_meta = load_dihedrals(clargs.dihedrals, layout)
     target_indices = find_target_indices(dihedrals)
-    with open(clargs.adjacents, 'r') as f:
-        adjacents = read_histogram(f)
+    adjacents = load_histogram(clargs.adjacents, layout=layout)[0]
 
     if clargs.variance == 'const-var':
-        with open(clargs.distribution, 'r') as f:
-            epsilon_expmean = read_histogram(f)
+        epsilon_expmean = load_histogram(clargs.distribution, layout=layout)[0]
         epsilon_expmean -= epsilon_expmean[max(target_indices)]
     else:
         epsilon_expmean = np.zeros(dihedrals.shape)
 
-    mu = math.log(clargs.rho)
-    lnhz = lnhzEV(lnhEV, dihedrals, mu, clargs.E, epsilon_expmean, qcoord=dihedrals_meta['qcoord'])
-    incidental = incidental_VV(lnhz, adjacents, clargs.rho, clargs.w, dihedrals_meta['qdih'], dihedrals_meta['qcoord'])
-
-    on_off_ratio = on_off_pathway_ratio(lnhz, incidental)
-    print("On/off pathway ratio (Zid/Zin): %g" % on_off_ratio)
-
     print("Writing output to %s" % clargs.output)
     with open(clargs.output, 'w') as f:
-        f.write("# epsilon = %g\n" % clargs.E)
-        f.write("# on/off pathway ratio = %g\n" % on_off_ratio)
-        f.write("# V1 V2 Zin(V1,V2)\n")
-        for i in range(1, incidental.shape[0]):
-            for j in range(1, incidental.shape[1]):
-                f.write("%g %g %g\n" % (i, j, incidental[i,j]))
-            f.write("\n")
+        on_off_ratio = write_incidental(f, lnhEV, dihedrals, dihedrals_meta, adjacents, clargs.E, clargs.rho, clargs.w, \
+                                        epsilon_expmean, layout)
+    print("On/off pathway ratio (Zid/Zin): %g" % on_off_ratio)
@@ -14,10 +14,50 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
-import argparse
+import argparse, os, time
 import networkx as nx
+import numpy as np
 from pygtsa.structure import Assembly
-from pygtsa.cgraph import wl_simulate_EV, mc_simulate_dihedrals_adjacents_EV
+from pygtsa.histogram import BINARY_EXTENSION, EVLayout, EVHistogram, EVBHistogram
+from pygtsa.samples import SAMPLES_EXTENSION
+from pygtsa.cache import ResultCache, default_cache_dir
+from pygtsa.cgraph import wl_simulate_EV, mc_simulate_dihedrals_adjacents_EV, enumerate_EV, \
+    SamplerStats, write_stats_log, move_set, MOVES, MOVE_MAX_PATCH, WL_FMIN, WL_FLATNESS, WL_NCHECK
+
+# Monte Carlo steps between samples, per edge of the target, and samples per sampled (E, V) bin, or
+# with --error-tolerance, the initial number of steps between samples and the default largest
+# number of samples per bin
+MC_STEPS_PER_EDGE = 2
+MC_SAMPLES_PER_BIN = 4000
+MC_MAX_SAMPLES_PER_BIN = 40000
+
+def cache_params(clargs, nedges):
+    '''The options and settings that determine the results, as the key of the result cache
+
+    The seed, and the options that only affect how the calculation is run, are left out.'''
+    if clargs.exact:
+        return {'method' : 'exact', 'qdih' : clargs.qdih, 'banded' : clargs.banded}
+    return {'method' : 'wang-landau', 'fmin' : WL_FMIN, 'flatness' : WL_FLATNESS, 'ncheck' : WL_NCHECK, \
+            'schedule' : clargs.schedule, 'tolerance' : clargs.tolerance, 'windows' : clargs.windows, \
+            'banded' : clargs.banded, 'qdih' : clargs.qdih, 'nsteps' : MC_STEPS_PER_EDGE * nedges, \
+            'samples_per_bin' : MC_SAMPLES_PER_BIN, 'error_tolerance' : clargs.error_tolerance, \
+            'max_samples_per_bin' : clargs.max_samples_per_bin, 'vertex_moves' : clargs.vertex_moves, \
+            'patch_moves' : clargs.patch_moves, 'max_patch' : clargs.max_patch}
+
+def write_cached(files, output_prefix, ext, qcoord):
+    '''Write the cached output files, in the requested format and with the requested qcoord'''
+    for name, path in files.items():
+        if name == 'dihedral_counts':
+            counts, meta = EVBHistogram.load(path)
+            print("Writing dihedral counts for other values of qdih to", output_prefix + name + '.dat')
+            counts.save(output_prefix + name + '.dat', {'qcoord' : "%g" % qcoord})
+            continue
+        hist, meta = EVHistogram.load(path)
+        meta = {key : value for key, value in meta.items() if key not in ('nedges', 'nvertices')}
+        if name == 'dihedrals':
+            meta['qcoord'] = "%g" % qcoord
+        print("Writing", name, "to", output_prefix + name + ext)
+        hist.save(output_prefix + name + ext, meta)
 
 if __name__ == '__main__':
 
@@ -26,20 +66,85 @@ if __name__ == '__main__':
     parser.add_argument('--qcoord', metavar='Q', type=float, default=4., help="monomer rotation constant [4.]")
     parser.add_argument('--qdih', metavar='Q', type=float, default=3., help="dihedral angle connective constant [3.]")
     parser.add_argument('--output-prefix', metavar='PATH', type=str, default='./', help="path to output files [./]")
+    parser.add_argument('--format', choices=('text', 'binary'), default='text', \
+                        help="histogram file format: text (.dat) or binary (%s) [text]" % BINARY_EXTENSION)
+    parser.add_argument('--windows', metavar='N', type=int, default=1, \
+                        help="number of overlapping Wang--Landau windows in the number of edges [1]")
+    parser.add_argument('--workers', metavar='N', type=int, default=None, \
+                        help="number of worker processes for windowed Wang--Landau sampling, or of threads for " \
+                        "exact enumeration [None]")
+    parser.add_argument('--seed', type=int, default=None, help="random number generator seed [None]")
+    parser.add_argument('--chains', metavar='N', type=int, default=1, \
+                        help="number of independent Monte Carlo chains, run on parallel threads [1]")
+    parser.add_argument('--schedule', choices=('halving', '1/t'), default='halving', \
+                        help="Wang--Landau modification factor schedule [halving]")
+    parser.add_argument('--tolerance', metavar='TOL', type=float, default=None, \
+                        help="stop Wang--Landau sampling once the estimated error in lnhEV is below TOL [None]")
+    parser.add_argument('--checkpoint-interval', metavar='SECONDS', type=float, default=600., \
+                        help="time between Wang--Landau checkpoints [600]")
+    parser.add_argument('--resume', action='store_true', \
+                        help="resume the Wang--Landau calculation from the checkpoint in the output directory")
+    parser.add_argument('--banded', action='store_true', \
+                        help="store only the reachable band of (E, V) bins; written in full to text files")
+    parser.add_argument('--stats', action='store_true', \
+                        help="log sampler statistics to sampler_stats.jsonl and write per-bin acceptance rates")
+    parser.add_argument('--stats-interval', metavar='SECONDS', type=float, default=60., \
+                        help="time between sampler statistics records [60]")
+    parser.add_argument('--stats-timing', action='store_true', \
+                        help="also record the time spent updating bridges and adjacent edges (slower)")
+    parser.add_argument('--exact', action='store_true', \
+                        help="count every connected subgraph instead of sampling (at most 64 edges)")
+    parser.add_argument('--error-tolerance', metavar='TOL', type=float, default=0., \
+                        help="sample the dihedrals and adjacents until the standard errors of the dihedrals and of " \
+                        "ln(adjacents) are at most TOL in every bin, or with 0, collect %d samples per bin [0]" \
+                        % MC_SAMPLES_PER_BIN)
+    parser.add_argument('--max-samples-per-bin', metavar='N', type=int, default=MC_MAX_SAMPLES_PER_BIN, \
+                        help="largest number of samples per bin with --error-tolerance [%d]" % MC_MAX_SAMPLES_PER_BIN)
+    parser.add_argument('--vertex-moves', metavar='P', type=float, default=0., \
+                        help="probability of moves that add or remove a vertex with all of its edges [0]")
+    parser.add_argument('--patch-moves', metavar='P', type=float, default=0., \
+                        help="probability of moves that add or remove a patch of several edges [0]")
+    parser.add_argument('--max-patch', metavar='N', type=int, default=MOVE_MAX_PATCH, \
+                        help="largest number of edges in a patch move [%d]" % MOVE_MAX_PATCH)
+    parser.add_argument('--record', action='store_true', \
+                        help="append every sampled fragment to fragments%s, for calc_energies --samples" \
+                        % SAMPLES_EXTENSION)
+    parser.add_argument('--cache-dir', metavar='PATH', type=str, default=default_cache_dir(), \
+                        help="directory of the cache of results for previously calculated structures [%(default)s]")
+    parser.add_argument('--cache-size', metavar='MB', type=float, default=1024., \
+                        help="maximum size of the result cache, in MB [1024]")
+    parser.add_argument('--no-cache', action='store_true', \
+                        help="neither read nor write the result cache or the parsed structure")
     clargs = parser.parse_args()
 
     # Initialize
 
-    target = Assembly.read(clargs.structure)
+    target = Assembly.read(clargs.structure, cache=not clargs.no_cache, cache_dir=clargs.cache_dir)
 
     if clargs.output_prefix != '' and clargs.output_prefix[-1] != '/':
         clargs.output_prefix = clargs.output_prefix + '_'
+    ext = '.dat' if clargs.format == 'text' else BINARY_EXTENSION
+    checkpoint = clargs.output_prefix + 'wl_checkpoint.pkl'
+    stats_log = clargs.output_prefix + 'sampler_stats.jsonl' if clargs.stats else None
+    samples = clargs.output_prefix + 'fragments' + SAMPLES_EXTENSION if clargs.record else None
 
     # Sanity checks
 
     if not nx.is_connected(target):
         print("ERROR: target assembly is disconnected")
         raise SystemExit
+    if clargs.error_tolerance < 0. or clargs.max_samples_per_bin < 1:
+        print("ERROR: --error-tolerance must not be negative, and --max-samples-per-bin must be positive")
+        raise SystemExit
+    if clargs.vertex_moves < 0. or clargs.patch_moves < 0. or clargs.vertex_moves + clargs.patch_moves >= 1. \
+       or clargs.max_patch < 2:
+        print("ERROR: --vertex-moves and --patch-moves must not be negative, and their sum must be below 1; " \
+              "--max-patch must be at least 2")
+        raise SystemExit
+    moves = move_set(clargs.vertex_moves, clargs.patch_moves, clargs.max_patch)
+    if clargs.stats_timing and not clargs.stats:
+        print("ERROR: --stats-timing requires --stats")
+        raise SystemExit
     if len(target.leaves()) != 0:
         print("WARNING: target assembly contains at least one leaf")
     if len(target.bridges()) != 0:
@@ -48,28 +153,130 @@ if __name__ == '__main__':
         print("WARNING: target assemblies with more than 200 edges may require an "
               "unreasonable amount of computing time (with the current implementation).")
 
+    # Look for the results of an identical calculation on this structure, up to relabelling
+
+    cache = None
+    if not clargs.no_cache:
+        cache = ResultCache(clargs.cache_dir, int(clargs.cache_size * (1 << 20)))
+        params = cache_params(clargs, target.number_of_edges())
+        if clargs.resume or clargs.stats or clargs.record:
+            print("Not reading cached results with --resume, --stats or --record.")
+        else:
+            with cache.lookup(target, params) as files:
+                if files != None:
+                    print("Found cached results in", cache.directory)
+                    write_cached(files, clargs.output_prefix, ext, clargs.qcoord)
+                    raise SystemExit
+    outputs = {name : clargs.output_prefix + name + ext for name in ('lnhEV', 'dihedrals', 'adjacents')}
+    outputs['dihedral_counts'] = clargs.output_prefix + 'dihedral_counts.dat'
+    if not clargs.exact and clargs.error_tolerance > 0.:
+        outputs.update({name : clargs.output_prefix + name + ext for name in ('dihedrals_error', 'adjacents_error')})
+
+    if clargs.exact:
+        if target.number_of_edges() > 64 or target.number_of_nodes() > 64:
+            print("ERROR: exact enumeration is limited to target assemblies with at most 64 edges and vertices")
+            raise SystemExit
+        if clargs.record:
+            print("ERROR: --record requires sampling and cannot be used with --exact")
+            raise SystemExit
+        print("Enumerating connected subgraphs...")
+        lnhEV, dihedrals, adjacents, counts, bridges = \
+            enumerate_EV(target, clargs.qdih, nthreads=clargs.workers, banded=clargs.banded)
+        print("Found %d connected subgraphs." % counts.h.sum())
+        print("Writing density of states to", clargs.output_prefix + 'lnhEV' + ext)
+        lnhEV.save(clargs.output_prefix + 'lnhEV' + ext, {'method' : 'exact'})
+        print("Writing dihedral entropy loss to", clargs.output_prefix + 'dihedrals' + ext)
+        dihedrals.save(clargs.output_prefix + 'dihedrals' + ext, \
+                       {'qcoord' : "%g" % clargs.qcoord, 'qdih' : "%g" % clargs.qdih})
+        print("Writing dihedral counts for other values of qdih to", clargs.output_prefix + 'dihedral_counts.dat')
+        bridges.save(clargs.output_prefix + 'dihedral_counts.dat', {'qcoord' : "%g" % clargs.qcoord})
+        print("Writing average number of adjacent edges to", clargs.output_prefix + 'adjacents' + ext)
+        adjacents.save(clargs.output_prefix + 'adjacents' + ext)
+        print("Writing number of subgraphs to", clargs.output_prefix + 'subgraph_counts' + ext)
+        counts.save(clargs.output_prefix + 'subgraph_counts' + ext)
+        if cache != None:
+            outputs['subgraph_counts'] = clargs.output_prefix + 'subgraph_counts' + ext
+            if cache.store(target, params, outputs):
+                print("Stored the results in the cache in", cache.directory)
+        raise SystemExit
+
     # Run subgraphs calculation
 
     print("Calculating subgraph density of states...")
-    print("Writing density of states to", clargs.output_prefix + 'lnhEV.dat')
-    lnhEV = wl_simulate_EV(target, output=clargs.output_prefix + 'lnhEV.dat')
+    if clargs.resume:
+        if not os.path.exists(checkpoint):
+            print("ERROR: checkpoint file %s not found" % checkpoint)
+            raise SystemExit
+        print("Resuming from checkpoint", checkpoint)
+    print("Writing density of states to", clargs.output_prefix + 'lnhEV' + ext)
+    print("Writing checkpoints to", checkpoint)
+    wl_stats = None
+    if clargs.stats:
+        print("Writing sampler statistics to", stats_log)
+        wl_stats = SamplerStats(target, layout=EVLayout.from_graph(target) if clargs.banded else None, \
+                                timing=clargs.stats_timing)
+    lnhEV = wl_simulate_EV(target, output=clargs.output_prefix + 'lnhEV' + ext, \
+                           nwindows=clargs.windows, nworkers=clargs.workers, seed=clargs.seed, \
+                           checkpoint=checkpoint, checkpoint_interval=clargs.checkpoint_interval, \
+                           resume=checkpoint if clargs.resume else None, \
+                           schedule=clargs.schedule, tolerance=clargs.tolerance, banded=clargs.banded, \
+                           sampler_stats=wl_stats, stats_log=stats_log, stats_interval=clargs.stats_interval, \
+                           moves=moves)
 
     # Calculate dihedrals and adjacents
 
     print("Calculating dihedrals and adjacents averages...")
-    nsteps = 2 * target.number_of_edges()
-    nsamples = 4000 * sum(sum(1 for j in range(lnhEV.h.shape[1]) if lnhEV.h[i,j] >= 0.) for i in range(lnhEV.h.shape[0]))
-    print("Collecting %d samples with %d steps between samples." % (nsamples, nsteps))
-    dihedrals, adjacents, visits = mc_simulate_dihedrals_adjacents_EV(target, lnhEV, clargs.qdih, nsteps, nsamples)
-
-    print("Writing average dihedral entropy loss to", clargs.output_prefix + 'dihedrals.dat')
-    with open(clargs.output_prefix + 'dihedrals.dat', 'w') as f:
-        f.write("# qcoord = %g\n" % clargs.qcoord)
-        f.write("# qdih = %g\n\n" % clargs.qdih)
-        dihedrals.write(f)
-    print("Writing average number of adjacent edges to", clargs.output_prefix + 'adjacents.dat')
-    with open(clargs.output_prefix + 'adjacents.dat', 'w') as f:
-        adjacents.write(f)
-    print("Writing sampling histogram to", clargs.output_prefix + 'sampling_visits.dat')
-    with open(clargs.output_prefix + 'sampling_visits.dat', 'w') as f:
-        visits.write(f)
+    nsteps = MC_STEPS_PER_EDGE * target.number_of_edges()
+    nbins = int(np.count_nonzero(lnhEV.h >= 0.))
+    adaptive = clargs.error_tolerance > 0.
+    if adaptive:
+        nsamples = clargs.max_samples_per_bin * nbins
+        print("Collecting samples until the standard errors are at most %g in every bin, up to %d samples, " \
+              "starting with %d steps between samples." % (clargs.error_tolerance, nsamples, nsteps))
+    else:
+        nsamples = MC_SAMPLES_PER_BIN * nbins
+        print("Collecting %d samples with %d steps between samples." % (nsamples, nsteps))
+    mc_stats = SamplerStats(target, per_bin=False, timing=clargs.stats_timing) if clargs.stats else None
+    if clargs.record:
+        print("Appending sampled fragments to", samples)
+    results = mc_simulate_dihedrals_adjacents_EV(target, lnhEV, clargs.qdih, nsteps, nsamples, seed=clargs.seed, \
+                                                 stream=clargs.windows + 1, nchains=clargs.chains, bridges=True, \
+                                                 sampler_stats=mc_stats, samples=samples, \
+                                                 tolerance=clargs.error_tolerance if adaptive else None, verbose=True, \
+                                                 moves=moves)
+    dihedrals, adjacents, visits, bridges = results[:4]
+    errors = results[4] if adaptive else None
+    if adaptive:
+        nsamples = errors['nsamples']
+        print("Collected %d samples; the integrated autocorrelation time is %.3g steps." % (nsamples, errors['tau']))
+    if clargs.stats:
+        record = {'event' : 'mc', 'time' : time.time(), 'nsamples' : nsamples, 'stats' : mc_stats.summary()}
+        if adaptive:
+            record.update({key : errors[key] for key in ('nsteps', 'tau', 'max_error', 'converged')})
+        with open(stats_log, 'a') as f:
+            write_stats_log(f, record)
+
+    print("Writing average dihedral entropy loss to", clargs.output_prefix + 'dihedrals' + ext)
+    dihedrals.save(clargs.output_prefix + 'dihedrals' + ext, \
+                   {'qcoord' : "%g" % clargs.qcoord, 'qdih' : "%g" % clargs.qdih})
+    print("Writing dihedral counts for other values of qdih to", clargs.output_prefix + 'dihedral_counts.dat')
+    bridges.save(clargs.output_prefix + 'dihedral_counts.dat', {'qcoord' : "%g" % clargs.qcoord})
+    print("Writing average number of adjacent edges to", clargs.output_prefix + 'adjacents' + ext)
+    adjacents.save(clargs.output_prefix + 'adjacents' + ext)
+    if adaptive:
+        for name in ('dihedrals', 'adjacents'):
+            print("Writing standard errors of the %s to" % name, clargs.output_prefix + name + '_error' + ext)
+            errors[name].save(clargs.output_prefix + name + '_error' + ext, \
+                              {'tolerance' : "%g" % clargs.error_tolerance})
+    print("Writing sampling histogram to", clargs.output_prefix + 'sampling_visits' + ext)
+    visits.save(clargs.output_prefix + 'sampling_visits' + ext)
+    if cache != None:
+        outputs['sampling_visits'] = clargs.output_prefix + 'sampling_visits' + ext
+        if cache.store(target, params, outputs):
+            print("Stored the results in the cache in", cache.directory)
+    if clargs.stats:
+        counts = wl_stats.summary()['moves']
+        for move in [move for move in MOVES if counts[move]['proposed'] > 0]:
+            path = clargs.output_prefix + 'wl_acceptance_' + move + ext
+            print("Writing Wang--Landau acceptance rates of %s moves to" % move, path)
+            wl_stats.acceptance(move).save(path)
@@ -16,67 +16,90 @@
 
 import argparse, math
 import numpy as np
-from pygtsa.histogram import EVHistogram, read_histogram, read_meta
+from pygtsa.histogram import EVHistogram, EVLayout, load_histogram
 
-def load_dihedrals(stream):
-    dihedrals = read_histogram(stream)
-    stream.seek(0, 0)
-    dihedrals_meta = read_meta(stream)
+def load_dihedrals(path, layout=None):
+    dihedrals, dihedrals_meta = load_histogram(path, layout=layout)
     dihedrals_meta['qdih'] = float(dihedrals_meta['qdih'][-1])
     dihedrals_meta['qcoord'] = float(dihedrals_meta['qcoord'][-1])
     return dihedrals, dihedrals_meta
 
 def find_target_indices(dihedrals, tol=1.e-5):
+    '''Indices of the bins with the largest dihedral entropy loss, in the layout of dihedrals'''
     dih_max = np.max(dihedrals)
-    target_indices = []
-    for i in range(dihedrals.shape[0]):
-        for j in range(dihedrals.shape[1]):
-            if math.fabs(dihedrals[i,j] - dih_max) < tol:
-                target_indices.append((i,j))
-    return target_indices
-
-def lnhzEV(lndos, dihedrals, mu, epsilon_mean, epsilon_expmean, qcoord=4):
+    return [tuple(int(i) for i in index) for index in np.argwhere(np.fabs(dihedrals - dih_max) < tol)]
+
+def logsumexp(a, axis=-1):
+    '''Compute log(sum(exp(a))) over the given axes without overflow; empty sums give -inf'''
+    amax = np.max(a, axis=axis, keepdims=True, initial=-np.inf)
+    amax = np.where(np.isfinite(amax), amax, 0.)
+    with np.errstate(divide='ignore'):
+        return np.log(np.sum(np.exp(a - amax), axis=axis)) + np.squeeze(amax, axis=axis)
+
+def epsilon_range(Emin, Emax, dE):
+    epsilon = Emin
+    values = []
+    while epsilon < Emax + dE:
+        values.append(epsilon)
+        epsilon += dE
+    return np.array(values)
+
+def rho_range(rho, rho_max=None, nrho=1):
+    '''Logarithmically spaced densities from rho to rho_max'''
+    if rho_max == None or nrho <= 1:
+        return np.array([rho])
+    return np.exp(np.linspace(math.log(rho), math.log(rho_max), nrho))
+
+def _layout(lnhz, layout):
+    return layout if layout != None else EVLayout.of_array(lnhz)
+
+def lnhzEV(lndos, dihedrals, mu, epsilon_mean, epsilon_expmean, qcoord=4, layout=None):
+    '''Calculate ln(h(E,V) z^V) for every (E, V) bin
+
+    mu and epsilon_mean may be arrays, in which case the result has shape
+    np.broadcast(mu, epsilon_mean).shape + lndos.shape.  All of the histograms are
+    stored in the given layout (by default, the dense layout of lndos; see EVLayout).'''
+    layout = _layout(lndos, layout)
     lnqcoord = math.log(qcoord)
-    VG = lndos.shape[0] - lndos.shape[1] + 2
-    EG = lndos.shape[0] - 1
-    lnhz = np.zeros(lndos.shape)
-    for i in range(lndos.shape[0]):
-        for j in range(lndos.shape[1]):
-            E = i
-            V = E - j + 1
-            if E == 0 and V == 1:
-                # Monomer (trivial subgraph)
-                lnhz[i,j] = math.log(VG) + mu
-            elif lndos[i,j] >= 0:
-                # Connected subgraph
-                epsilon = epsilon_mean + epsilon_expmean[i,j]
-                lnhz[i,j] = (lndos[i,j]          # Number of subgraphs
-                            + V * mu             # Translational entropy
-                            - (V - 1) * lnqcoord # Rotational entropy loss (due to association)
-                            - dihedrals[i,j]     # Dihedral entropy loss (due to bridge elimination)
-                            + E * epsilon)       # Association energy
-            else:
-                # Impossible structure
-                lnhz[i,j] = -np.inf
+    VG = layout.nvertices
+    bins = (None,) * len(layout.shape)
+    mu = np.asarray(mu, dtype=float)[(Ellipsis,) + bins]
+    epsilon_mean = np.asarray(epsilon_mean, dtype=float)[(Ellipsis,) + bins]
+    E, V = layout.E, layout.V
+    # Connected subgraphs; impossible structures are given -inf.
+    lnhz0 = np.where(lndos >= 0, lndos                    # Number of subgraphs
+                     - (V - 1) * lnqcoord                 # Rotational entropy loss (due to association)
+                     - dihedrals                          # Dihedral entropy loss (due to bridge elimination)
+                     + E * epsilon_expmean, -np.inf)      # Association energy (variance contribution)
+    lnhz = lnhz0 + V * mu + E * epsilon_mean              # Translational entropy and association energy
+    # Monomer (trivial subgraph)
+    lnhz[(Ellipsis,) + layout.index(0, 1)] = math.log(VG) + mu[(Ellipsis,) + (0,) * len(bins)]
     return lnhz
 
-def yield_from_lnhz(lnhz, target_indices):
-    lnhzmax = max(max(lnhz[i,j] if np.isfinite(lnhz[i,j]) else 1.e-300 \
-                      for j in range(lnhz.shape[1])) for i in range(lnhz.shape[0]))
-    zG = sum(math.exp(lnhz[target_index] - lnhzmax) for target_index in target_indices)
-    Zid = 0.
-    for i in range(lnhz.shape[0]):
-        for j in range(lnhz.shape[1]):
-            if np.isfinite(lnhz[i,j]):
-                arg = lnhz[i,j] - lnhzmax
-                if arg > 300.:
-                    return 0.
-                else:
-                    Zid += math.exp(arg)
-    if Zid > 0.:
-        return zG / Zid
-    else:
-        return 0.
+def _lnzG(lnhz, target_indices):
+    return logsumexp(np.stack([lnhz[(Ellipsis,) + tuple(index)] for index in target_indices], axis=-1), axis=-1)
+
+def yield_from_lnhz(lnhz, target_indices, layout=None):
+    '''Calculate the yield of the target for each lnhz in the (leading dimensions of the) array'''
+    lnZid = logsumexp(lnhz, axis=_layout(lnhz, layout).axes)
+    with np.errstate(invalid='ignore'):
+        return np.where(np.isfinite(lnZid), np.exp(_lnzG(lnhz, target_indices) - lnZid), 0.)
+
+def DFG_from_lnhz(lnhz, target_indices, layout=None):
+    '''Calculate the free-energy difference between the target and a monomer'''
+    return lnhz[(Ellipsis,) + _layout(lnhz, layout).index(0, 1)] - _lnzG(lnhz, target_indices)
+
+def write_yield(stream, lnhEV, dihedrals, dihedrals_meta, epsilon, rho, epsilon_expmean, layout=None):
+    '''Write the yield and DeltaF_G for each density in rho and each epsilon, as text'''
+    target_indices = find_target_indices(dihedrals)
+    stream.write("# epsilon rho yield DeltaF_G\n")
+    for r in rho:
+        lnhz = lnhzEV(lnhEV, dihedrals, math.log(r), epsilon, epsilon_expmean, qcoord=dihedrals_meta['qcoord'], \
+                      layout=layout)
+        eta = yield_from_lnhz(lnhz, target_indices, layout)
+        DFG = DFG_from_lnhz(lnhz, target_indices, layout)
+        for k in range(len(epsilon)):
+            stream.write("%g %g %g %g\n" % (epsilon[k], r, eta[k], DFG[k]))
 
 if __name__ == '__main__':
 
@@ -85,6 +108,9 @@ if __name__ == '__main__':
     parser.add_argument('dihedrals', type=str, help="path to dihedrals file")
     parser.add_argument('rho', type=float, help="dimensionless number density")
     parser.add_argument('--output', type=str, default='yield.dat', help="path to output file [yield.dat]")
+    parser.add_argument('--rho-max', metavar='RHO', type=float, default=None, \
+                        help="maximum density, for a logarithmically spaced sweep starting at rho [None]")
+    parser.add_argument('--nrho', metavar='N', type=int, default=1, help="number of densities in the sweep [1]")
     subparsers = parser.add_subparsers(dest='variance')
     parser_zero = subparsers.add_parser('zero-var')
     parser_const = subparsers.add_parser('const-var')
@@ -100,31 +126,21 @@ if __name__ == '__main__':
         print("error: variance mode not specified")
         raise SystemExit
 
-    with open(clargs.lnhEV, 'r') as f:
-        lnhEV = read_histogram(f)
-    with open(clargs.dihedrals, 'r') as f:
-        dihedrals, dihedrals_meta = load_dihedrals(f)
+    lnhEV = EVHistogram.load(clargs.lnhEV)[0]
+    layout = lnhEV.storage_layout()
+    lnhEV = lnhEV.h
+    dihedrals, dihedrals_meta = load_dihedrals(clargs.dihedrals, layout)
     target_indices = find_target_indices(dihedrals)
 
     if clargs.variance == 'const-var':
-        with open(clargs.distribution, 'r') as f:
-            epsilon_expmean = read_histogram(f)
+        epsilon_expmean = load_histogram(clargs.distribution, layout=layout)[0]
         epsilon_expmean -= epsilon_expmean[max(target_indices)]
     else:
         epsilon_expmean = np.zeros(dihedrals.shape)
 
-    mu = math.log(clargs.rho)
-    epsilon = clargs.Emin
-    eta = {}
-    DFG = {}
-    while epsilon < clargs.Emax + clargs.dE:
-        lnhz = lnhzEV(lnhEV, dihedrals, mu, epsilon, epsilon_expmean, qcoord=dihedrals_meta['qcoord'])
-        eta[epsilon] = yield_from_lnhz(lnhz, target_indices)
-        DFG[epsilon] = -math.log(sum(math.exp(lnhz[index] - lnhz[0,0]) for index in target_indices))
-        epsilon += clargs.dE
+    epsilon = epsilon_range(clargs.Emin, clargs.Emax, clargs.dE)
+    rho = rho_range(clargs.rho, clargs.rho_max, clargs.nrho)
 
     print("Writing output to %s" % clargs.output)
     with open(clargs.output, 'w') as f:
-        f.write("# epsilon rho yield DeltaF_G\n")
-        for epsilon in sorted(eta.keys()):
-            f.write("%g %g %g %g\n" % (epsilon, clargs.rho, eta[epsilon], DFG[epsilon]))
+        write_yield(f, lnhEV, dihedrals, dihedrals_meta, epsilon, rho, epsilon_expmean, layout)
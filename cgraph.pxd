@@ -15,17 +15,26 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
 cdef extern from "random.h":
-    void random_init ()
+    ctypedef struct gsl_rng:
+        pass
+
+    gsl_rng * random_alloc (unsigned long seed, unsigned long stream)
+    void random_free (gsl_rng * rng)
+    void * gsl_rng_state (const gsl_rng * rng)
+    size_t gsl_rng_size (const gsl_rng * rng)
 
 cdef extern from "graph.h":
+    ctypedef unsigned int vertex_t
+
     ctypedef struct edge_t:
-        unsigned short v1, v2
+        vertex_t v1, v2
 
     ctypedef struct graph_t:
         size_t max_nvertices, nvertices
         size_t max_nedges, nedges
         size_t * nvedges
-        unsigned short ** edges
+        size_t * offsets
+        vertex_t ** edges
         size_t nbridges
         edge_t * bridges
         size_t nremovable
@@ -34,33 +43,116 @@ cdef extern from "graph.h":
         edge_t * adjacents
 
     graph_t * graph_alloc (size_t nv, size_t max_degree)
+    graph_t * graph_alloc_degrees (size_t nv, const size_t * degrees)
     void graph_free (graph_t * graph)
     void graph_copy (const graph_t * orig, graph_t * dest)
 
-    void graph_add_edge (graph_t * graph, unsigned short v1, unsigned short v2)
-    void graph_remove_edge (graph_t * graph, unsigned short v1, unsigned short v2)
+    void graph_add_edge (graph_t * graph, vertex_t v1, vertex_t v2)
+    void graph_remove_edge (graph_t * graph, vertex_t v1, vertex_t v2)
+    void graph_set_edges (graph_t * graph, size_t nedges, const edge_t * edges)
     void set_edge (edge, va, vb) # macro
 
     void graph_find_bridges (graph_t * graph)
     void graph_find_adjacents (const graph_t * graph, graph_t * subgraph)
 
-cdef extern from "sample.h":
+cdef extern from "sample.h" nogil:
     ctypedef struct histogramEV_t:
-        pass
+        size_t size
+        Py_ssize_t * offsets
+        double * data
 
     histogramEV_t * histogramEV_alloc (const graph_t * graph)
     void histogramEV_free (histogramEV_t * h)
     void histogramEV_fill (histogramEV_t * h, double z)
+    int histogramEV_flat (const histogramEV_t * visits, double flatness)
+    void histogramEV_tare (histogramEV_t * h)
+
+    ctypedef struct histogramEVB_t:
+        size_t nedges, nvertices
+        size_t size, n
+        size_t * keys
+        double * counts
+
+    histogramEVB_t * histogramEVB_alloc (const graph_t * graph)
+    void histogramEVB_free (histogramEVB_t * h)
+
+    ctypedef struct flatness_t:
+        unsigned long nvisited
+        double sum, max
+
+    void flatness_init (flatness_t * stats, const histogramEV_t * visits)
+    int flatness_check (const flatness_t * stats, double flatness)
+
+    ctypedef struct move_set_t:
+        double vertex, patch
+        size_t max_patch
+
+    enum: MOVE_ADD, MOVE_REMOVE, MOVE_ADD_VERTEX, MOVE_REMOVE_VERTEX, MOVE_GROW, MOVE_SHRINK, NMOVES
+
+    ctypedef struct sampler_stats_t:
+        unsigned long nsteps
+        unsigned long nproposed[NMOVES]
+        unsigned long naccepted[NMOVES]
+        histogramEV_t * proposed[NMOVES]
+        histogramEV_t * accepted[NMOVES]
+        int timing
+        double update_time
+        unsigned long ntunnels[2]
+        unsigned long tunnel_steps[2]
+        int end
+        unsigned long end_step
+
+    void sampler_stats_init (sampler_stats_t * stats)
+
+    ctypedef struct sample_file_t:
+        unsigned long nrecords
+
+    sample_file_t * sample_file_open (const graph_t * graph, const char * path)
+    int sample_file_close (sample_file_t * file)
 
     double histogramEV_get(histogramEV_t * h, size_t E, size_t V) # macro
     void histogramEV_set(histogramEV_t * h, size_t E, size_t V, double z) # macro
     void histogramEV_inc(histogramEV_t * h, size_t E, size_t V, double z) # macro
 
     void wl_sample_subgraphs_EV (const graph_t * graph, graph_t * subgraph, histogramEV_t * lnhEV, \
-                                 double f, double flatness, unsigned int ncheck)
-
-    void mc_sample_subgraphs_EV (const graph_t * graph, graph_t * subgraph, const histogramEV_t * lnhEV, unsigned int nsteps)
+                                 double f, double flatness, unsigned long ncheck, int incremental, gsl_rng * rng)
+    void wl_step_subgraphs_EV (const graph_t * graph, graph_t * subgraph, histogramEV_t * lnhEV, histogramEV_t * visits, \
+                               flatness_t * stats, double f, size_t Emin, size_t Emax, unsigned long nsteps, \
+                               int incremental, const move_set_t * moves, gsl_rng * rng, \
+                               sampler_stats_t * sampler_stats)
+
+    void mc_sample_subgraphs_EV (const graph_t * graph, graph_t * subgraph, const histogramEV_t * lnhEV, \
+                                 unsigned long nsteps, int incremental, const move_set_t * moves, gsl_rng * rng, \
+                                 sampler_stats_t * sampler_stats)
+    void mc_collect_subgraphs_EV (const graph_t * graph, graph_t * subgraph, const histogramEV_t * lnhEV, \
+                                  unsigned long nsteps, unsigned long nsamples, int incremental, \
+                                  const move_set_t * moves, gsl_rng * rng, double qdih, histogramEV_t * visits, \
+                                  histogramEV_t * dihedrals, histogramEVB_t * bridges, histogramEV_t * adjacents, \
+                                  size_t nenergies, const double * energies, double * energy_sums, \
+                                  sample_file_t * samples, Py_ssize_t * trace_bins, double * trace, \
+                                  sampler_stats_t * sampler_stats)
+    void mc_enter_window_EV (const graph_t * graph, graph_t * subgraph, size_t Emin, size_t Emax, int incremental, \
+                             gsl_rng * rng)
+
+    int enumerate_subgraphs_EV (const graph_t * graph, size_t root, double * counts, double * adjacents)
 
 cdef class Graph:
     cdef graph_t * _graph
 
+cdef class RandomStream:
+    cdef gsl_rng * _rng
+
+cdef class HistogramEV:
+    cdef histogramEV_t _view
+    cdef histogramEV_t * _h
+    cdef readonly object hist
+    cdef readonly object layout
+    cdef object _offsets
+
+cdef class SamplerStats:
+    cdef sampler_stats_t _stats
+    cdef readonly object proposed, accepted
+    cdef public double elapsed
+    cdef object _views
+    cdef sampler_stats_t * bind (self, Graph graph) except NULL
+
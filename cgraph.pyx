@@ -14,27 +14,55 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
-import math
+import json, math, os, pickle, time
 import numpy as np
-from pygtsa.histogram import EVHistogram
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pygtsa.histogram import EVHistogram, EVBHistogram, EVLayout, stitch_windows
+from pygtsa.samples import prepare_sample_file, append_sample_file, edges_digest
+from pygtsa.autocorrelation import BatchMeans, bin_residuals, integrated_autocorrelation_time
 
+from libc.string cimport memcpy
 cimport cgraph
 
-# Module initialization
-cgraph.random_init()
-# ---------------------
+def _edge_array(edges, nvertices):
+    if isinstance(edges, np.ndarray):
+        a = np.ascontiguousarray(edges, dtype=np.uint32).reshape(-1, 2)
+    else:
+        a = np.array(list(edges), dtype=np.uint32).reshape(-1, 2)
+    if a.size > 0 and a.max() >= nvertices:
+        raise ValueError("vertex ids must lie in [0, %d)" % nvertices)
+    return a
 
 cdef class Graph:
+    '''C graph with the vertices and edges of an assembly
+
+    Each row of the adjacency array has room for the degree of its vertex in the assembly,
+    so a Graph of the target can hold any of its subgraphs.  Vertices must be labelled by
+    integers from 0 to the number of vertices - 1.'''
     def __init__(self, assembly):
-        self._graph = cgraph.graph_alloc(assembly.number_of_nodes(), \
-                                         max(assembly.degree(v) for v in assembly.nodes()))
+        cdef size_t nvertices = assembly.number_of_nodes()
+        edges = _edge_array(assembly.edge_array() if hasattr(assembly, 'edge_array') else assembly.edges(), nvertices)
+        cdef size_t[::1] degrees = np.bincount(edges.ravel(), minlength=nvertices + 1).astype(np.uintp)
+        self._graph = cgraph.graph_alloc_degrees(nvertices, &degrees[0])
         if self._graph == NULL: raise MemoryError()
-        for edge in assembly.edges():
-            cgraph.graph_add_edge(self._graph, edge[0], edge[1])
+        self._set_edges(edges)
 
     def __dealloc__(self):
         cgraph.graph_free(self._graph)
 
+    def _set_edges(self, edges):
+        cdef const cgraph.vertex_t[:,::1] v = edges
+        cgraph.graph_set_edges(self._graph, v.shape[0], <const cgraph.edge_t *> &v[0,0] if v.shape[0] > 0 else NULL)
+
+    def set_edges(self, edges):
+        '''Replace the edges of the graph, which must be a subgraph of the one that it was allocated for'''
+        edges = _edge_array(edges, self._graph.max_nvertices)
+        cdef size_t nvertices = self._graph.max_nvertices
+        capacities = np.diff(np.asarray(<size_t[:nvertices + 1]> self._graph.offsets))
+        if np.any(np.bincount(edges.ravel(), minlength=nvertices)[:nvertices] > capacities):
+            raise ValueError("edges do not fit in the allocated graph")
+        self._set_edges(edges)
+
     def edges_iter(self):
         cdef size_t i, j
         for i in range(self._graph.max_nvertices):
@@ -46,126 +74,1073 @@ cdef class Graph:
         graph_find_bridges(self._graph)
         return set((self._graph.bridges[i].v1, self._graph.bridges[i].v2) for i in range(self._graph.nbridges))
 
-cdef histogramEV_c_to_py(assembly, histogramEV_t * h):
-    hEV = EVHistogram(assembly)
-    cdef int i, j
-    for i in range(hEV.h.shape[0]):
-        for j in range(hEV.h.shape[1]):
-            E = i
-            V = i - j + 1
-            hEV.h[hEV._index(E, V)] = histogramEV_get(h, E, V)
-    return hEV
+cdef class RandomStream:
+    '''Random number generator owned by a single sampler
+
+    Generators with the same seed but different stream indices produce
+    independent sequences.  If seed is None, a seed is drawn from the OS.'''
+    def __init__(self, seed=None, stream=0):
+        if seed == None:
+            seed = int.from_bytes(os.urandom(8), 'little')
+        self._rng = cgraph.random_alloc(seed, stream)
+        if self._rng == NULL: raise MemoryError()
+
+    def __dealloc__(self):
+        cgraph.random_free(self._rng)
+
+    def getstate(self):
+        return (<char *> cgraph.gsl_rng_state(self._rng))[:cgraph.gsl_rng_size(self._rng)]
+
+    def setstate(self, bytes state):
+        if len(state) != cgraph.gsl_rng_size(self._rng):
+            raise ValueError("invalid random number generator state")
+        memcpy(cgraph.gsl_rng_state(self._rng), <char *> state, len(state))
+
+    def __reduce__(self):
+        return (_random_stream_from_state, (self.getstate(),))
+
+def _random_stream_from_state(state):
+    rng = RandomStream(0)
+    rng.setstate(state)
+    return rng
+
+cdef class HistogramEV:
+    '''View of an EVHistogram's array as a C (E, V) histogram
+
+    The C samplers read and write the NumPy buffer directly.  In a dense histogram, rows are
+    indexed by E and columns by E - V + 1, and any extra columns (such as the one added for
+    gnuplot) are left untouched; a banded histogram is addressed through its EVLayout.  If hEV
+    is None, a new zero-filled EVHistogram is created, which is banded if a layout is given.'''
+    def __init__(self, Graph graph, hEV=None, layout=None):
+        cdef double[::1] data
+        cdef Py_ssize_t[::1] offsets
+        nrows = graph._graph.nedges + 1
+        ncols = graph._graph.nedges - graph._graph.nvertices + 2
+        if hEV == None:
+            hEV = EVHistogram(None, layout=layout)
+            if layout == None:
+                hEV.h = np.zeros((nrows, ncols))
+        if hEV.banded():
+            if hEV.layout.nrows != nrows or hEV.layout.ncols != ncols or hEV.h.shape != hEV.layout.shape:
+                raise ValueError("histogram layout does not match the graph")
+            self._offsets = hEV.layout.offsets()
+            self.layout = hEV.layout
+        else:
+            if hEV.h.shape[0] != nrows or hEV.h.shape[1] < ncols:
+                raise ValueError("histogram shape %s does not match the graph" % (hEV.h.shape,))
+            self._offsets = EVLayout.of_array(hEV.h).offsets()
+            self.layout = None
+        hEV.h = np.require(hEV.h, dtype=float, requirements=['C', 'W'])
+        self.hist = hEV
+        data = hEV.h.reshape(-1)
+        offsets = self._offsets
+        self._view.size = data.shape[0]
+        self._view.offsets = &offsets[0]
+        self._view.data = &data[0]
+        self._h = &self._view
+
+MOVES = ('add', 'remove', 'add_vertex', 'remove_vertex', 'grow', 'shrink')
+TUNNELS = ('up', 'down')
+
+# Default largest number of edges added or removed by a patch move
+MOVE_MAX_PATCH = 4
+
+def move_set(vertex=0., patch=0., max_patch=MOVE_MAX_PATCH):
+    '''The mixture of Monte Carlo moves, for the moves argument of the samplers
+
+    Each step is a vertex move, which adds or removes a vertex with all of its edges, with
+    probability vertex; a patch move, which adds or removes 2 to max_patch edges one after
+    another, with probability patch; and otherwise a move of a single edge (see sample.h).
+    Some single-edge moves are needed to reach every subgraph, since vertex moves only reach
+    induced subgraphs.  The samplers make single-edge moves only if moves is None.'''
+    if vertex < 0. or patch < 0. or vertex + patch >= 1.:
+        raise ValueError("the probabilities of vertex and patch moves must be non-negative, with a sum below 1")
+    if max_patch < 2:
+        raise ValueError("patch moves must add or remove at least 2 edges")
+    return {'vertex' : float(vertex), 'patch' : float(patch), 'max_patch' : int(max_patch)}
+
+cdef cgraph.move_set_t * _bind_moves(moves, cgraph.move_set_t * c_moves) except? NULL:
+    if moves == None:
+        return NULL
+    c_moves.vertex, c_moves.patch, c_moves.max_patch = moves['vertex'], moves['patch'], moves['max_patch']
+    return c_moves
+
+cdef class SamplerStats:
+    '''Counters of the moves made by the C Monte Carlo samplers
+
+    Pass an instance as the stats argument of the samplers to accumulate, over any number of
+    calls, the number of steps, the number of moves of each type in MOVES (see move_set) that
+    were proposed and accepted, and the number and duration (in steps) of tunnels between the lowest and
+    highest allowed numbers of edges (see sample.h).  If per_bin is True, proposed[m] and
+    accepted[m] are EVHistograms of the target, in the given layout, of the moves of type
+    MOVES[m] made from each (E, V) bin.  If timing is True, the time spent updating the
+    bridges and adjacent edges is also recorded, which slows the samplers down noticeably.  elapsed is the time spent in the samplers;
+    the times of parallel chains are added, so steps_per_second is the rate of one thread.'''
+    def __init__(self, target=None, layout=None, per_bin=True, timing=False):
+        cgraph.sampler_stats_init(&self._stats)
+        self._stats.timing = timing
+        self.elapsed = 0.
+        self.proposed = self.accepted = None
+        if per_bin and target != None:
+            self.proposed = [EVHistogram(target, layout=layout) for move in MOVES]
+            self.accepted = [EVHistogram(target, layout=layout) for move in MOVES]
+        self._views = None
+
+    cdef cgraph.sampler_stats_t * bind(self, Graph graph) except NULL:
+        '''Point the C counters at the per-bin histograms, which must match graph'''
+        cdef int m
+        if self.proposed is not None:
+            self._views = [HistogramEV(graph, hist) for hist in self.proposed + self.accepted]
+            for m in range(len(MOVES)):
+                self._stats.proposed[m] = (<HistogramEV> self._views[m])._h
+                self._stats.accepted[m] = (<HistogramEV> self._views[len(MOVES) + m])._h
+        return &self._stats
+
+    def spawn(self):
+        '''New, empty counters with the same settings, e.g. for a parallel chain'''
+        cdef SamplerStats other = SamplerStats(timing=self._stats.timing)
+        if self.proposed is not None:
+            other.proposed = [_evhistogram(np.zeros_like(hist.h), hist.layout) for hist in self.proposed]
+            other.accepted = [_evhistogram(np.zeros_like(hist.h), hist.layout) for hist in self.accepted]
+        return other
+
+    def merge(self, SamplerStats other):
+        '''Add the counts of other, e.g. from a parallel chain, to these counters'''
+        cdef int m
+        self._stats.nsteps += other._stats.nsteps
+        for m in range(len(MOVES)):
+            self._stats.nproposed[m] += other._stats.nproposed[m]
+            self._stats.naccepted[m] += other._stats.naccepted[m]
+        for d in range(2):
+            self._stats.ntunnels[d] += other._stats.ntunnels[d]
+            self._stats.tunnel_steps[d] += other._stats.tunnel_steps[d]
+        self._stats.update_time += other._stats.update_time
+        self.elapsed += other.elapsed
+        if self.proposed is not None and other.proposed is not None:
+            for m in range(len(MOVES)):
+                self.proposed[m].h += other.proposed[m].h
+                self.accepted[m].h += other.accepted[m].h
+
+    def acceptance(self, move):
+        '''EVHistogram of the fraction of the moves of the given type that were accepted in each
+        (E, V) bin, or -1 in bins from which no such moves were proposed'''
+        m = MOVES.index(move)
+        proposed, accepted = self.proposed[m], self.accepted[m]
+        ratio = np.full(proposed.h.shape, -1.)
+        np.divide(accepted.h, proposed.h, out=ratio, where=proposed.h > 0)
+        return _evhistogram(ratio, proposed.layout)
+
+    def summary(self):
+        '''The totals as a dictionary, suitable for writing as JSON'''
+        cdef cgraph.sampler_stats_t * s = &self._stats
+        ratio = lambda a, b: a / b if b > 0 else None
+        return {'steps' : s.nsteps, 'elapsed' : self.elapsed, 'steps_per_second' : ratio(s.nsteps, self.elapsed), \
+                'moves' : {MOVES[m] : {'proposed' : s.nproposed[m], 'accepted' : s.naccepted[m], \
+                                       'acceptance' : ratio(s.naccepted[m], s.nproposed[m])} \
+                           for m in range(len(MOVES))}, \
+                'update_time' : s.update_time if s.timing else None, \
+                'tunnels' : {TUNNELS[d] : {'count' : s.ntunnels[d], \
+                                           'mean_steps' : ratio(s.tunnel_steps[d], s.ntunnels[d])} for d in range(2)}}
+
+    def getstate(self):
+        cdef cgraph.sampler_stats_t * s = &self._stats
+        return {'counts' : (s.nsteps, tuple(s.nproposed), tuple(s.naccepted), s.timing, s.update_time, \
+                            tuple(s.ntunnels), tuple(s.tunnel_steps), s.end, s.end_step), \
+                'elapsed' : self.elapsed, 'proposed' : self.proposed, 'accepted' : self.accepted}
+
+    def setstate(self, state):
+        cdef cgraph.sampler_stats_t * s = &self._stats
+        s.nsteps, nproposed, naccepted, s.timing, s.update_time, ntunnels, tunnel_steps, s.end, s.end_step \
+            = state['counts']
+        for m in range(len(MOVES)):
+            s.nproposed[m], s.naccepted[m] = nproposed[m], naccepted[m]
+        for d in range(2):
+            s.ntunnels[d], s.tunnel_steps[d] = ntunnels[d], tunnel_steps[d]
+        self.elapsed, self.proposed, self.accepted = state['elapsed'], state['proposed'], state['accepted']
+        self._views = None
+
+    def __reduce__(self):
+        return (_sampler_stats_from_state, (self.getstate(),))
+
+def _sampler_stats_from_state(state):
+    stats = SamplerStats()
+    stats.setstate(state)
+    return stats
 
-cdef histogramEV_py_to_c(hEV, histogramEV_t * h):
-    cdef int i, j
-    for i in range(hEV.h.shape[0]):
-        for j in range(hEV.h.shape[1]):
-            E = i
-            V = i - j + 1
-            histogramEV_set(h, E, V, hEV.h[hEV._index(E, V)])
+cdef cgraph.sampler_stats_t * _bind_stats(stats, cgraph.Graph graph) except? NULL:
+    return (<SamplerStats> stats).bind(graph) if stats is not None else NULL
 
-def wl_simulate_EV(target, finit=1., fmin=1.e-4, flatness=0.9, ncheck=100000, output='lnhEV.dat', verbose=True):
+def write_stats_log(stream, record):
+    '''Append a record (a dictionary) to a sampler statistics log, which holds one JSON object per line'''
+    stream.write(json.dumps(record) + '\n')
+    stream.flush()
+
+CHECKPOINT_VERSION = 3
+
+def write_checkpoint(path, state):
+    '''Atomically replace the checkpoint file at path with the sampler state
+
+    The state is written to a temporary file, which is synced and then renamed over path,
+    so that an interrupted write leaves the previous checkpoint intact.'''
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(dict(state, version=CHECKPOINT_VERSION), f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def checkpoint_target(target):
+    '''The numbers of edges and vertices of target and a digest of its edges, as stored in checkpoints'''
+    edges = list(Graph(target).edges_iter())
+    return {'nedges' : len(edges), 'nvertices' : target.number_of_nodes(), 'edges' : edges_digest(edges)}
+
+def checkpoint_options(fmin, flatness, schedule, banded, moves):
+    '''The sampler options that a checkpoint must be resumed with'''
+    return {'fmin' : fmin, 'flatness' : flatness, 'schedule' : schedule, 'banded' : bool(banded), \
+            'moves' : dict(moves) if moves != None else None}
+
+def read_checkpoint(path, target, kind, options):
+    '''Read a checkpoint written by write_checkpoint and check that it belongs to target
+
+    The checkpoint must have been written for the same edges of target and with the same
+    sampler options (see checkpoint_options).'''
+    with open(path, 'rb') as f:
+        state = pickle.load(f)
+    if state.get('version') != CHECKPOINT_VERSION or state.get('kind') != kind:
+        raise ValueError("%s is not a %s checkpoint" % (path, kind))
+    if state['target'] != checkpoint_target(target):
+        raise ValueError("checkpoint %s was written for a different target" % path)
+    if state['options'] != options:
+        changed = sorted(key for key in options if state['options'].get(key) != options[key])
+        raise ValueError("checkpoint %s was written with different options (%s)" % (path, ', '.join(changed)))
+    return state
+
+# Default convergence target, flatness threshold and number of steps between flatness checks
+# of the Wang--Landau samplers
+WL_FMIN = 1.e-4
+WL_FLATNESS = 0.9
+WL_NCHECK = 100000
+
+def _wl_tared(h):
+    '''Copy of a log-histogram that has been tared at least once, shifted so that its minimum is zero'''
+    valid = h >= 0.
+    return np.where(valid, h - h[valid].min(initial=np.inf), -1.)
+
+def _wl_walker(f):
+    '''Schedule state of a single Wang--Landau walker'''
+    return {'f' : f, 'fdone' : None, 'phase' : 'halving', 't' : 0, 'nbins' : 0, 'tcheck' : 0, \
+            'stats' : (0, 0., 0.), 'lnhEV' : None, 'error' : math.inf}
+
+def _wl_active(walker, fmin, tolerance):
+    return walker['f'] >= 0.5 * fmin and not (tolerance != None and walker['error'] < tolerance)
+
+def _wl_advance(walker, lnhEV, ncheck, schedule):
+    '''Advance the modification factor of a walker after a block of ncheck steps
+
+    With the 'halving' schedule, f is halved whenever the visits histogram is flat.  With
+    the '1/t' schedule (Belardinelli and Pereyra), f is halved in the same way until it falls
+    below nbins / t, where t is the number of steps so far and nbins is the number of bins
+    visited in the last stage; from then on, f = nbins / t, updated after every block.
+    Returns True at the end of a stage (or, in the 1/t phase, whenever t doubles), when a
+    tared copy of lnhEV is stored in walker['lnhEV'] and the error estimate is updated.'''
+    nvisited, visits_sum, visits_max = walker['stats']
+    walker['t'] += ncheck
+    if walker['phase'] == 'halving':
+        if not walker['flat']:
+            return False
+        walker['fdone'] = walker['f']
+        walker['f'] *= 0.5
+        if schedule == '1/t' and walker['f'] < nvisited / walker['t']:
+            walker['phase'], walker['nbins'], walker['tcheck'] = '1/t', nvisited, 2 * walker['t']
+            walker['f'] = walker['nbins'] / walker['t']
+    else:
+        walker['f'] = walker['nbins'] / walker['t']
+        if walker['t'] < walker['tcheck']:
+            return False
+        walker['fdone'] = walker['f']
+        walker['tcheck'] *= 2
+    h = _wl_tared(lnhEV)
+    walker['error'] = wl_error_estimate(h, walker['lnhEV'])
+    walker['lnhEV'] = h
+    return True
+
+def _wl_stats_record(event, walker, sampler_stats, window=None):
+    '''Record for the stats log of a walker (in the given window) and its SamplerStats
+
+    event is 'stage' (at the end of a stage), 'interval' or 'done'.  The visits histogram of
+    the current stage is summarized by the number of bins visited and the ratio of the mean to
+    the maximum number of visits, which is compared with the flatness threshold.'''
+    nvisited, visits_sum, visits_max = walker['stats']
+    finite = lambda x: x if x != None and math.isfinite(x) else None
+    record = {'event' : event, 'time' : time.time(), 'f' : walker['f'], 'fdone' : walker['fdone'], \
+              'phase' : walker['phase'], 'steps' : walker['t'], 'error' : finite(walker['error']), \
+              'visited_bins' : nvisited, \
+              'flatness' : visits_sum / nvisited / visits_max if nvisited > 0 and visits_max > 0 else None}
+    if window != None:
+        record['window'] = list(window)
+    record['stats'] = sampler_stats.summary()
+    return record
+
+def wl_error_estimate(lnhEV, previous):
+    '''Estimate the error in a tared log-density of states from its change since a previous estimate
+
+    This is the standard deviation, over the bins sampled in both, of the difference between
+    the two estimates, i.e. the rms change after removing the arbitrary shift between them.
+    The previous estimate is taken at the end of the previous stage (or, with the 1/t schedule,
+    when the number of steps was half as large), so that this tracks the remaining error.'''
+    if previous is None:
+        return math.inf
+    common = (lnhEV >= 0.) & (previous >= 0.)
+    if np.count_nonzero(common) < 2:
+        return math.inf
+    return float(np.std(lnhEV[common] - previous[common]))
+
+def _evhistogram(h, layout=None):
+    hist = EVHistogram(None)
+    hist.h, hist.layout = h, layout
+    return hist
+
+def wl_simulate_EV(target, finit=1., fmin=WL_FMIN, flatness=WL_FLATNESS, ncheck=WL_NCHECK, output='lnhEV.dat', \
+                   verbose=True, incremental=True, nwindows=1, overlap=0.75, nworkers=None, seed=None, stream=0, \
+                   checkpoint=None, checkpoint_interval=600., resume=None, schedule='halving', tolerance=None, \
+                   banded=False, sampler_stats=None, stats_log=None, stats_interval=60., moves=None):
+    '''Wang--Landau sampling of the subgraph density of states
+
+    If banded is True, the histograms are stored in the banded layout of the target (see
+    EVLayout.from_graph), which holds only the reachable (E, V) bins.
+
+    The modification factor follows the given schedule ('halving' or '1/t'; see _wl_advance)
+    from finit down to fmin.  If tolerance is given, the calculation also stops as soon as the
+    estimated error in lnhEV (see wl_error_estimate) falls below it.
+
+    If checkpoint is a path, the full sampler state (including the random number generator)
+    is written there every checkpoint_interval seconds, between blocks of ncheck steps, and
+    when the calculation finishes.  If resume is a path, the calculation continues from that
+    checkpoint instead of starting from finit, and reproduces the uninterrupted run exactly.
+
+    If sampler_stats is a SamplerStats, the moves are counted in it.  If stats_log is a path,
+    a record of the schedule and the counts (see _wl_stats_record) is appended to it, as a line
+    of JSON, at the end of every stage, every stats_interval seconds and when the calculation
+    finishes.
+
+    moves is the mixture of Monte Carlo moves (see move_set); by default, only single edges
+    are added and removed.'''
+    if schedule not in ('halving', '1/t'):
+        raise ValueError("unknown Wang--Landau schedule %r" % schedule)
+    if nwindows > 1:
+        return wl_simulate_windows_EV(target, nwindows, overlap=overlap, nworkers=nworkers, seed=seed, stream=stream, \
+                                      finit=finit, fmin=fmin, flatness=flatness, ncheck=ncheck, \
+                                      output=output, verbose=verbose, incremental=incremental, \
+                                      checkpoint=checkpoint, checkpoint_interval=checkpoint_interval, resume=resume, \
+                                      schedule=schedule, tolerance=tolerance, banded=banded, \
+                                      sampler_stats=sampler_stats, stats_log=stats_log, stats_interval=stats_interval, \
+                                      moves=moves)
+
+    layout = EVLayout.from_graph(target) if banded else None
     cdef cgraph.Graph target_graph = cgraph.Graph(target)
     cdef cgraph.Graph fragment_graph = cgraph.Graph(target)
+    cdef cgraph.RandomStream rng
+    cdef cgraph.HistogramEV lnhEV, visits
+    target_id, options = checkpoint_target(target), checkpoint_options(fmin, flatness, schedule, banded, moves)
+    if resume != None:
+        state = read_checkpoint(resume, target, 'wl', options)
+        walker = state['walker']
+        rng = state['rng']
+        lnhEV = cgraph.HistogramEV(target_graph, state['lnhEV'])
+        visits = cgraph.HistogramEV(target_graph, state['visits'])
+        fragment_graph.set_edges(state['edges'])
+    else:
+        walker = _wl_walker(finit)
+        rng = cgraph.RandomStream(seed, stream)
+        lnhEV = cgraph.HistogramEV(target_graph, layout=layout)
+        visits = cgraph.HistogramEV(target_graph, layout=layout)
+    if stats_log != None and sampler_stats == None:
+        sampler_stats = SamplerStats(target, layout=lnhEV.layout)
+    cdef cgraph.sampler_stats_t * c_stats = _bind_stats(sampler_stats, target_graph)
+    cdef cgraph.move_set_t c_move_set
+    cdef cgraph.move_set_t * c_moves = _bind_moves(moves, &c_move_set)
 
-    cdef cgraph.histogramEV_t * lnhEV = cgraph.histogramEV_alloc(target_graph._graph)
-    if lnhEV == NULL: raise MemoryError()
-    histogramEV_fill(lnhEV, 0.);
-
-    cdef double f = finit
-    while f >= 0.5 * fmin:
-        if verbose:
-            print("W-L calculation: f = %g" % f);
-        cgraph.wl_sample_subgraphs_EV(target_graph._graph, fragment_graph._graph, lnhEV, f, flatness, ncheck)
-        py_lnhEV = histogramEV_c_to_py(target, lnhEV)
-        with open(output, 'w') as out:
-            out.write("# f = %g\n\n" % f)
-            py_lnhEV.write(out)
-        f *= 0.5
-
-    cgraph.histogramEV_free(lnhEV)
-    return py_lnhEV
-
-def mc_sample_EV(target, fragment, py_lnhEV, nsteps):
-    cdef cgraph.Graph target_graph = cgraph.Graph(target)
-    cdef cgraph.Graph fragment_graph = cgraph.Graph(fragment)
+    def save_checkpoint():
+        walker['stats'] = (stats.nvisited, stats.sum, stats.max)
+        write_checkpoint(checkpoint, {'kind' : 'wl', 'target' : target_id, 'options' : options, \
+                                      'walker' : walker, 'rng' : rng, 'lnhEV' : lnhEV.hist, 'visits' : visits.hist, \
+                                      'edges' : list(fragment_graph.edges_iter())})
 
-    cdef cgraph.histogramEV_t * lnhEV = cgraph.histogramEV_alloc(target_graph._graph)
-    if lnhEV == NULL: raise MemoryError()
-    histogramEV_py_to_c(py_lnhEV, lnhEV)
-    cgraph.mc_sample_subgraphs_EV(target_graph._graph, fragment_graph._graph, lnhEV, nsteps)
-    cgraph.histogramEV_free(lnhEV)
+    cdef cgraph.flatness_t stats
+    stats.nvisited, stats.sum, stats.max = walker['stats']
+    cdef double c_f
+    cdef double c_flatness = flatness
+    cdef unsigned long c_ncheck = ncheck
+    cdef int c_incremental = incremental
+    cdef size_t Emax = target_graph._graph.nedges
+    log = open(stats_log, 'a') if stats_log != None else None
+    last_checkpoint = last_log = time.monotonic()
+    while _wl_active(walker, fmin, tolerance):
+        c_f = walker['f']
+        start = time.perf_counter()
+        with nogil:
+            cgraph.wl_step_subgraphs_EV(target_graph._graph, fragment_graph._graph, lnhEV._h, visits._h, &stats, \
+                                        c_f, 1, Emax, c_ncheck, c_incremental, c_moves, rng._rng, c_stats)
+        if c_stats != NULL:
+            sampler_stats.elapsed += time.perf_counter() - start
+        walker['flat'] = walker['phase'] == 'halving' and cgraph.flatness_check(&stats, c_flatness)
+        if walker['flat']:
+            cgraph.histogramEV_tare(lnhEV._h)
+        walker['stats'] = (stats.nvisited, stats.sum, stats.max)
+        if _wl_advance(walker, lnhEV.hist.h, ncheck, schedule):
+            if verbose:
+                print("W-L calculation: f = %g, estimated error = %g" % (walker['fdone'], walker['error']))
+            _evhistogram(walker['lnhEV'], lnhEV.layout).save(output, {'f' : "%g" % walker['fdone'], \
+                                                                      'error' : "%g" % walker['error']})
+            if log != None:
+                write_stats_log(log, _wl_stats_record('stage', walker, sampler_stats))
+                last_log = time.monotonic()
+            if walker['flat']:
+                visits.hist.h.fill(0.)
+                stats.nvisited, stats.sum, stats.max = 0, 0., 0.
+        if log != None and time.monotonic() - last_log >= stats_interval:
+            write_stats_log(log, _wl_stats_record('interval', walker, sampler_stats))
+            last_log = time.monotonic()
+        if checkpoint != None and time.monotonic() - last_checkpoint >= checkpoint_interval:
+            save_checkpoint()
+            last_checkpoint = time.monotonic()
 
-def mc_simulate_dihedrals_adjacents_EV(target, py_lnhEV, qdih, nsteps, nsamples):
+    if log != None:
+        write_stats_log(log, _wl_stats_record('done', walker, sampler_stats))
+        log.close()
+    if checkpoint != None:
+        save_checkpoint()
+    return _evhistogram(walker['lnhEV'], lnhEV.layout) if walker['lnhEV'] is not None else lnhEV.hist
+
+def wl_windows_EV(nedges, nwindows, overlap=0.75):
+    '''Split the edge-count axis [1, nedges] into overlapping windows'''
+    width = (nedges - 1) / (1. + (nwindows - 1) * (1. - overlap))
+    windows = []
+    for k in range(nwindows):
+        Emin = 1 + int(round(k * (1. - overlap) * width))
+        Emax = nedges if k == nwindows - 1 else min(nedges, int(round(Emin + width)))
+        windows.append((Emin, Emax))
+    for k in range(1, nwindows):
+        if windows[k][0] + 1 > windows[k-1][1]:
+            raise Exception("too many windows for %d edges; increase the overlap" % nedges)
+    return windows
+
+def _wl_window_task(args):
+    target, edges, py_lnhEV, py_visits, f, halving, py_stats, window, flatness, nsteps, incremental, moves, py_rng, \
+        sampler_stats = args
+    cdef cgraph.RandomStream rng = py_rng
     cdef cgraph.Graph target_graph = cgraph.Graph(target)
     cdef cgraph.Graph fragment_graph = cgraph.Graph(target)
+    fragment_graph.set_edges(edges)
+
+    cdef cgraph.HistogramEV lnhEV = cgraph.HistogramEV(target_graph, py_lnhEV)
+    cdef cgraph.HistogramEV visits = cgraph.HistogramEV(target_graph, py_visits)
+    cdef cgraph.flatness_t stats
+    stats.nvisited, stats.sum, stats.max = py_stats
 
-    cdef cgraph.histogramEV_t * lnhEV = cgraph.histogramEV_alloc(target_graph._graph)
-    if lnhEV == NULL: raise MemoryError()
-    histogramEV_py_to_c(py_lnhEV, lnhEV)
-
-    dihedrals = EVHistogram(target)
-    adjacents = EVHistogram(target)
-    visits = EVHistogram(target, dtype=int)
-
-    cdef int E, V, B
-
-    for sample in range(nsamples):
-        cgraph.mc_sample_subgraphs_EV(target_graph._graph, fragment_graph._graph, lnhEV, nsteps)
-        E = fragment_graph._graph.nedges
-        V = fragment_graph._graph.nvertices
-        B = fragment_graph._graph.nbridges
-        dih = qdih**(1 + B - V)
-        dihedrals.inc(E, V, dih)
-        adjacents.inc(E, V, fragment_graph._graph.nadjacents)
-        visits.inc(E, V, 1)
-
-    for i in range(visits.h.shape[0]):
-        for j in range(visits.h.shape[1]):
-            if visits.h[i,j] > 0:
-                dihedrals.h[i,j] = -math.log(dihedrals.h[i,j] / visits.h[i,j])
-                adjacents.h[i,j] /= visits.h[i,j]
-            else:
-                dihedrals.h[i,j] = -1.
-                adjacents.h[i,j] = -1.
-
-    cgraph.histogramEV_free(lnhEV)
-    return dihedrals, adjacents, visits
-
-def mc_simulate_energies_EV(target, py_lnhEV, energy_dicts, nsteps, nsamples):
+    cdef size_t Emin = window[0], Emax = window[1]
+    cdef unsigned long c_nsteps = nsteps
+    cdef int c_incremental = incremental
+    cdef double c_f = f
+    cdef cgraph.sampler_stats_t * c_stats = _bind_stats(sampler_stats, target_graph)
+    cdef cgraph.move_set_t c_move_set
+    cdef cgraph.move_set_t * c_moves = _bind_moves(moves, &c_move_set)
+    start = time.perf_counter()
+    with nogil:
+        cgraph.mc_enter_window_EV(target_graph._graph, fragment_graph._graph, Emin, Emax, c_incremental, rng._rng)
+        cgraph.wl_step_subgraphs_EV(target_graph._graph, fragment_graph._graph, lnhEV._h, visits._h, &stats, \
+                                    c_f, Emin, Emax, c_nsteps, c_incremental, c_moves, rng._rng, c_stats)
+    if c_stats != NULL:
+        sampler_stats.elapsed += time.perf_counter() - start
+    flat = halving and bool(cgraph.flatness_check(&stats, flatness))
+    if flat:
+        cgraph.histogramEV_tare(lnhEV._h)
+
+    return list(fragment_graph.edges_iter()), lnhEV.hist, visits.hist, (stats.nvisited, stats.sum, stats.max), flat, \
+        rng, sampler_stats
+
+def wl_simulate_windows_EV(target, nwindows, overlap=0.75, nworkers=None, seed=None, stream=0, \
+                           finit=1., fmin=WL_FMIN, flatness=WL_FLATNESS, ncheck=WL_NCHECK, output='lnhEV.dat', \
+                           verbose=True, incremental=True, checkpoint=None, checkpoint_interval=600., resume=None, \
+                           schedule='halving', tolerance=None, banded=False, sampler_stats=None, stats_log=None, \
+                           stats_interval=60., moves=None):
+    '''Replica-exchange Wang--Landau sampling over overlapping windows in the number of edges.
+
+    Each window is sampled by an independent walker with its own modification factor and
+    schedule; walkers in neighbouring windows attempt to swap configurations every ncheck
+    steps.  The per-window densities of states are stitched together on output.
+    Window k uses the random stream (stream + k); exchanges use the stream (stream + nwindows).
+    Checkpoints are written between rounds of window updates; see wl_simulate_EV.
+
+    The moves in each window are counted separately, and records for every window are written
+    to stats_log (see wl_simulate_EV).  If sampler_stats is given, the counts of all of the
+    windows are added to it when the calculation finishes.'''
+    windows = wl_windows_EV(target.number_of_edges(), nwindows, overlap=overlap)
+    layout = EVLayout.from_graph(target) if banded else None
+    target_id, options = checkpoint_target(target), checkpoint_options(fmin, flatness, schedule, banded, moves)
+    if resume != None:
+        state = read_checkpoint(resume, target, 'wl-windows', options)
+        if state['windows'] != windows:
+            raise ValueError("checkpoint %s was written for different windows" % resume)
+        rngs, rng, edges, lnhEVs, visits, walkers = \
+            (state[key] for key in ('rngs', 'rng', 'edges', 'lnhEVs', 'visits', 'walkers'))
+    else:
+        if seed == None:
+            seed = int.from_bytes(os.urandom(8), 'little')
+        rngs = [RandomStream(seed, stream + k) for k in range(nwindows)]
+        rng = np.random.default_rng([seed, stream + nwindows])
+        edges = [list(target.edges()) for k in range(nwindows)]
+        lnhEVs = [EVHistogram(target, layout=layout) for k in range(nwindows)]
+        visits = [EVHistogram(target, layout=layout) for k in range(nwindows)]
+        walkers = [_wl_walker(finit) for k in range(nwindows)]
+    window_stats = [None] * nwindows
+    if sampler_stats != None:
+        window_stats = [sampler_stats.spawn() for k in range(nwindows)]
+    elif stats_log != None:
+        window_stats = [SamplerStats(target, layout=lnhEVs[k].layout) for k in range(nwindows)]
+
+    def log_stats(event, ks):
+        for k in ks:
+            write_stats_log(log, _wl_stats_record(event, walkers[k], window_stats[k], window=windows[k]))
+
+    def save_checkpoint():
+        write_checkpoint(checkpoint, {'kind' : 'wl-windows', \
+                                      'target' : target_id, 'options' : options, \
+                                      'windows' : windows, 'rngs' : rngs, 'rng' : rng, 'edges' : edges, \
+                                      'lnhEVs' : lnhEVs, 'visits' : visits, 'walkers' : walkers})
+
+    def EV(edges):
+        return len(edges), len(set(v for edge in edges for v in edge))
+
+    def stitched():
+        return stitch_windows([_evhistogram(walkers[k]['lnhEV'], lnhEVs[k].layout) \
+                               if walkers[k]['lnhEV'] is not None else lnhEVs[k] for k in range(nwindows)], windows)
+
+    executor = ProcessPoolExecutor(max_workers=nworkers) if nworkers != None and nworkers > 1 else None
+    log = open(stats_log, 'a') if stats_log != None else None
+    last_checkpoint = last_log = time.monotonic()
+    try:
+        while any(_wl_active(walker, fmin, tolerance) for walker in walkers):
+            if checkpoint != None and time.monotonic() - last_checkpoint >= checkpoint_interval:
+                save_checkpoint()
+                last_checkpoint = time.monotonic()
+            active = [k for k in range(nwindows) if _wl_active(walkers[k], fmin, tolerance)]
+            tasks = [(target, edges[k], lnhEVs[k], visits[k], walkers[k]['f'], walkers[k]['phase'] == 'halving', \
+                      walkers[k]['stats'], windows[k], flatness, ncheck, incremental, moves, rngs[k], \
+                      window_stats[k]) \
+                     for k in active]
+            results = executor.map(_wl_window_task, tasks) if executor != None else map(_wl_window_task, tasks)
+            stage_done = False
+            for k, result in zip(active, results):
+                edges[k], lnhEVs[k], visits[k], walkers[k]['stats'], walkers[k]['flat'], rngs[k], window_stats[k] \
+                    = result
+                if _wl_advance(walkers[k], lnhEVs[k].h, ncheck, schedule):
+                    if verbose:
+                        print("W-L calculation: window %d [%d, %d]: f = %g, estimated error = %g" \
+                              % (k, windows[k][0], windows[k][1], walkers[k]['fdone'], walkers[k]['error']))
+                    if log != None:
+                        log_stats('stage', [k])
+                    if walkers[k]['flat']:
+                        visits[k] = EVHistogram(target, layout=lnhEVs[k].layout)
+                        walkers[k]['stats'] = (0, 0., 0.)
+                    stage_done = True
+
+            # Attempt to exchange configurations between neighbouring windows.
+            for k in range(nwindows - 1):
+                if not (k in active and k + 1 in active):
+                    continue
+                (E1, V1), (E2, V2) = EV(edges[k]), EV(edges[k+1])
+                if not (windows[k+1][0] <= E1 <= windows[k+1][1] and windows[k][0] <= E2 <= windows[k][1]):
+                    continue
+                arg = lnhEVs[k].get(E1, V1) - lnhEVs[k].get(E2, V2) \
+                      + lnhEVs[k+1].get(E2, V2) - lnhEVs[k+1].get(E1, V1)
+                if arg >= 0. or rng.random() < math.exp(arg):
+                    edges[k], edges[k+1] = edges[k+1], edges[k]
+
+            if log != None and time.monotonic() - last_log >= stats_interval:
+                log_stats('interval', active)
+                last_log = time.monotonic()
+
+            if stage_done and all(walker['fdone'] != None for walker in walkers):
+                stitched().save(output, {'f' : "%g" % max(walker['fdone'] for walker in walkers), \
+                                         'error' : "%g" % max(walker['error'] for walker in walkers), \
+                                         'windows' : ' '.join("%d:%d" % w for w in windows)})
+    finally:
+        if executor != None:
+            executor.shutdown()
+
+    if log != None:
+        log_stats('done', range(nwindows))
+        log.close()
+    if sampler_stats != None:
+        for k in range(nwindows):
+            sampler_stats.merge(window_stats[k])
+    if checkpoint != None:
+        save_checkpoint()
+    return stitched()
+
+def mc_sample_EV(target, fragment, py_lnhEV, nsteps, incremental=True, seed=None, stream=0, sampler_stats=None, \
+                 moves=None):
     cdef cgraph.Graph target_graph = cgraph.Graph(target)
     cdef cgraph.Graph fragment_graph = cgraph.Graph(target)
+    fragment_graph.set_edges(fragment.edges())
+    cdef cgraph.RandomStream rng = cgraph.RandomStream(seed, stream)
+    cdef cgraph.HistogramEV lnhEV = cgraph.HistogramEV(target_graph, py_lnhEV)
+    cdef unsigned long c_nsteps = nsteps
+    cdef int c_incremental = incremental
+    cdef cgraph.sampler_stats_t * c_stats = _bind_stats(sampler_stats, target_graph)
+    cdef cgraph.move_set_t c_move_set
+    cdef cgraph.move_set_t * c_moves = _bind_moves(moves, &c_move_set)
+    start = time.perf_counter()
+    with nogil:
+        cgraph.mc_sample_subgraphs_EV(target_graph._graph, fragment_graph._graph, lnhEV._h, c_nsteps, c_incremental, \
+                                      c_moves, rng._rng, c_stats)
+    if c_stats != NULL:
+        sampler_stats.elapsed += time.perf_counter() - start
+
+def mc_run_chains(chain, nsamples, nchains=1, nthreads=None, seed=None, stream=0, sampler_stats=None, samples=None, \
+                  rngs=None, fragments=None):
+    '''Run independent MC chains on a thread pool and return their results in order.
+
+    chain(nsamples, rng, fragment, sampler_stats, samples) is called once per chain, with the
+    samples split as evenly as possible between chains.  Chain k uses the random stream
+    (stream + k) and starts from the full target, unless lists of the RandomStreams and
+    fragment Graphs of the chains are given as rngs and fragments, in which case the chains
+    continue from them; fragment is None otherwise.  The C samplers release the GIL, so
+    chains sampling from the same read-only target graph and density of states run
+    concurrently.  If sampler_stats is given, each chain counts its moves separately, and
+    the counts are added to it at the end.  If samples is the path of a sample file (see
+    pygtsa.samples), each chain is given the path of a separate part file, and the parts
+    are appended to samples in order at the end; otherwise, the chains are given None.'''
+    if seed == None and rngs == None:
+        seed = int.from_bytes(os.urandom(8), 'little')
+    if rngs == None:
+        rngs = [RandomStream(seed, stream + k) for k in range(nchains)]
+    if fragments == None:
+        fragments = [None] * nchains
+    parts = [None] * nchains
+    if samples != None:
+        parts = [samples] if nchains == 1 else ["%s.part%d" % (samples, k) for k in range(nchains)]
+        for part in parts:
+            if part != samples and os.path.exists(part):
+                os.remove(part)
+    tasks = [(nsamples // nchains + (1 if k < nsamples % nchains else 0), rngs[k], fragments[k], \
+              sampler_stats.spawn() if sampler_stats != None else None, parts[k]) for k in range(nchains)]
+    try:
+        if nchains == 1:
+            results = [chain(*tasks[0])]
+        else:
+            if nthreads == None:
+                nthreads = min(nchains, os.cpu_count() or 1)
+            with ThreadPoolExecutor(max_workers=nthreads) as executor:
+                results = list(executor.map(lambda task: chain(*task), tasks))
+        for part in parts:
+            if part != None and part != samples:
+                append_sample_file(samples, part)
+    finally:
+        for part in parts:
+            if part != None and part != samples and os.path.exists(part):
+                os.remove(part)
+    if sampler_stats != None:
+        for task in tasks:
+            sampler_stats.merge(task[3])
+    return results
+
+cdef cgraph.sample_file_t * _open_sample_file(path, cgraph.Graph graph) except? NULL:
+    if path == None:
+        return NULL
+    encoded = os.fsencode(path)
+    cdef cgraph.sample_file_t * samples = cgraph.sample_file_open(graph._graph, encoded)
+    if samples == NULL:
+        raise IOError("could not open %s" % path)
+    return samples
+
+def _prepare_sample_file(path, cgraph.Graph graph):
+    if path != None:
+        prepare_sample_file(path, list(graph.edges_iter()), graph._graph.nvertices)
+
+cdef _close_sample_file(cgraph.sample_file_t * samples, path, nsamples):
+    if samples == NULL:
+        return
+    nrecords = samples.nrecords
+    if cgraph.sample_file_close(samples) != 0 or nrecords != nsamples:
+        raise IOError("could not write the samples to %s" % path)
+
+def _histogramEV_from_array(target, a, dtype=float, layout=None):
+    hEV = EVHistogram(target, dtype=dtype, layout=layout)
+    hEV.h[...] = a
+    return hEV
+
+def _trace_arrays(nsamples, trace):
+    if not trace or nsamples == 0:
+        return None, None
+    return np.zeros(nsamples, dtype=np.intp), np.zeros(nsamples)
+
+def _reachable_bins(cgraph.HistogramEV lnhEV, shape):
+    '''The bins of an array of the given shape, in the layout of lnhEV, that lnhEV can reach'''
+    h = lnhEV.hist.h
+    return (h if h.shape == shape else h[:,:shape[1]]) >= 0.
+
+# Adaptive sampling (see mc_run_adaptive) collects MC_BATCH_SAMPLES_PER_BIN samples per reachable
+# bin in each of the first MC_NBATCHES batches, and merges the batches in pairs, doubling the
+# length of the later batches, whenever there are twice as many.
+MC_NBATCHES = 16
+MC_BATCH_SAMPLES_PER_BIN = 25
+
+def mc_run_adaptive(chain, add_batch, bin_errors, reachable, nsteps, max_samples, tolerance, fragments, \
+                    nchains=1, nthreads=None, seed=None, stream=0, sampler_stats=None, samples=None, verbose=False):
+    '''Run MC chains in batches until the averages in every reachable bin are within a tolerance
+
+    chain(nsteps, nsamples, rng, fragment, sampler_stats, samples) is run on each chain as by
+    mc_run_chains, continuing from the fragments (one per chain) and random streams of the
+    previous batch, and returns a tuple that ends with the trace of the chain (see
+    mc_collect_subgraphs_EV).  add_batch(batches, results) adds the results of each batch to
+    batches, a pygtsa.autocorrelation.BatchMeans, and bin_errors(batches) returns the error
+    of the averages in each bin of the array reachable.  Sampling stops once the errors in
+    all of the reachable bins are at most tolerance, after at least MC_NBATCHES batches, or
+    after max_samples samples.
+
+    The number of steps between samples starts at nsteps, and after each batch is set to the
+    integrated autocorrelation time, in steps, of the number of adjacent edges of the samples
+    relative to its average in their bins, changing by at most a factor of 4 at a time.
+    Returns the BatchMeans and a dict reporting the number of samples and batches, the final
+    number of steps between samples, the autocorrelation time in steps, the largest error
+    and whether the tolerance was met.'''
+    if seed == None:
+        seed = int.from_bytes(os.urandom(8), 'little')
+    rngs = [RandomStream(seed, stream + k) for k in range(nchains)]
+    batch_samples = max(MC_BATCH_SAMPLES_PER_BIN * int(np.count_nonzero(reachable)), nchains)
+    batches = BatchMeans()
+    report = {'nsamples' : 0, 'nbatches' : 0, 'nsteps' : nsteps, 'tau' : None, 'max_error' : np.inf, \
+              'converged' : False}
+
+    def batch_chain(*args):
+        return chain(report['nsteps'], *args)
+
+    while report['nsamples'] < max_samples:
+        nsamples = min(batch_samples, max_samples - report['nsamples'])
+        results = mc_run_chains(batch_chain, nsamples, nchains=nchains, nthreads=nthreads, \
+                                sampler_stats=sampler_stats, samples=samples, rngs=rngs, fragments=fragments)
+        report['nsamples'] += nsamples
+        add_batch(batches, results)
+        traces = [result[-2:] for result in results if result[-2] is not None]
+        if len(traces) > 0:
+            residuals = bin_residuals(np.concatenate([trace[0] for trace in traces]), \
+                                      np.concatenate([trace[1] for trace in traces]), reachable.size)
+            series = np.split(residuals, np.cumsum([len(trace[0]) for trace in traces])[:-1])
+            report['tau'] = integrated_autocorrelation_time(series) * report['nsteps']
+        errors = bin_errors(batches)[reachable]
+        report['nbatches'] = len(batches)
+        report['max_error'] = float(errors.max(initial=0.))
+        report['converged'] = len(batches) >= MC_NBATCHES and report['max_error'] <= tolerance
+        if verbose and (report['converged'] or len(batches) == 2 * MC_NBATCHES):
+            print("Collected %d samples, %d steps apart (tau = %.3g steps): %d of %d bins within the tolerance " \
+                  "(largest error %g)." % (report['nsamples'], report['nsteps'], report['tau'], \
+                                           np.count_nonzero(errors <= tolerance), len(errors), report['max_error']))
+        if report['converged']:
+            break
+        if report['tau'] != None:
+            report['nsteps'] = min(4 * report['nsteps'], max(1, report['nsteps'] // 4, int(round(report['tau']))))
+        if len(batches) == 2 * MC_NBATCHES:
+            batches.merge()
+            batch_samples *= 2
+    if verbose and not report['converged']:
+        print("WARNING: stopped after %d samples with %d of %d bins within the tolerance (largest error %g)." \
+              % (report['nsamples'], np.count_nonzero(errors <= tolerance), len(errors), report['max_error']))
+    return batches, report
 
-    cdef cgraph.histogramEV_t * lnhEV = cgraph.histogramEV_alloc(target_graph._graph)
-    if lnhEV == NULL: raise MemoryError()
-    histogramEV_py_to_c(py_lnhEV, lnhEV)
-
-    visits = EVHistogram(target, dtype=int)
-    sums = [EVHistogram(target) for k in range(len(energy_dicts))]
-    energy_means = [sum(energy_dicts[k].values()) / len(energy_dicts[k]) for k in range(len(energy_dicts))]
-    energy_diffs = [{edge : (energy_dicts[k][edge] - energy_means[k]) for edge in energy_dicts[k].keys()} \
-                    for k in range(len(energy_dicts))]
-
-    cdef size_t E, V
-
-    for sample in range(nsamples):
-        cgraph.mc_sample_subgraphs_EV(target_graph._graph, fragment_graph._graph, lnhEV, nsteps)
-        E = fragment_graph._graph.nedges
-        V = fragment_graph._graph.nvertices
-        for k in range(len(energy_dicts)):
-            val = math.exp(sum(energy_diffs[k][edge] for edge in fragment_graph.edges_iter()))
-            sums[k].inc(E, V, val)
-        visits.inc(E, V, 1)
-
-    means = EVHistogram(target)
-    for i in range(visits.h.shape[0]):
-        for j in range(visits.h.shape[1]):
-            if visits.h[i,j] > 0:
-                E = i
-                means.h[i,j] = sum(math.log(sums[k].h[i,j] / visits.h[i,j]) / E + energy_means[k] \
-                                   for k in range(len(energy_dicts))) / len(energy_dicts)
-            else:
-                means.h[i,j] = -1.
-
-    cgraph.histogramEV_free(lnhEV)
+def _relative_errors(means, errors):
+    '''Standard errors relative to the means, which are 0 where the errors are 0'''
+    relative = np.full(means.shape, np.inf)
+    np.divide(errors, np.abs(means), out=relative, where=(means != 0.))
+    relative[errors == 0.] = 0.
+    return relative
+
+def _mc_chain_dihedrals_adjacents_EV(target, cgraph.Graph target_graph, cgraph.HistogramEV lnhEV, qdih, nsteps, \
+                                     nsamples, incremental, moves, bridges, trace, cgraph.RandomStream rng, fragment, \
+                                     sampler_stats, samples):
+    cdef cgraph.Graph fragment_graph = fragment if fragment != None else cgraph.Graph(target)
+    cdef unsigned long c_nsteps = nsteps, c_nsamples = nsamples
+    cdef int c_incremental = incremental
+    cdef double c_qdih = qdih
+
+    cdef cgraph.HistogramEV dihedrals = cgraph.HistogramEV(target_graph, layout=lnhEV.layout)
+    cdef cgraph.HistogramEV adjacents = cgraph.HistogramEV(target_graph, layout=lnhEV.layout)
+    cdef cgraph.HistogramEV visits = cgraph.HistogramEV(target_graph, layout=lnhEV.layout)
+    cdef cgraph.sampler_stats_t * c_stats = _bind_stats(sampler_stats, target_graph)
+    cdef cgraph.move_set_t c_move_set
+    cdef cgraph.move_set_t * c_moves = _bind_moves(moves, &c_move_set)
+    cdef cgraph.histogramEVB_t * c_bridges = NULL
+    cdef cgraph.sample_file_t * c_samples = NULL
+    trace_bins, trace_values = _trace_arrays(nsamples, trace)
+    cdef Py_ssize_t[::1] c_trace_bins = trace_bins
+    cdef double[::1] c_trace_values = trace_values
+    cdef Py_ssize_t * p_trace_bins = NULL
+    cdef double * p_trace_values = NULL
+    if trace_bins is not None:
+        p_trace_bins, p_trace_values = &c_trace_bins[0], &c_trace_values[0]
+    if bridges:
+        c_bridges = cgraph.histogramEVB_alloc(target_graph._graph)
+        if c_bridges == NULL: raise MemoryError()
+
+    try:
+        c_samples = _open_sample_file(samples, target_graph)
+        start = time.perf_counter()
+        with nogil:
+            cgraph.mc_collect_subgraphs_EV(target_graph._graph, fragment_graph._graph, lnhEV._h, c_nsteps, c_nsamples, \
+                                           c_incremental, c_moves, rng._rng, c_qdih, visits._h, dihedrals._h, \
+                                           c_bridges, adjacents._h, 0, NULL, NULL, c_samples, p_trace_bins, \
+                                           p_trace_values, c_stats)
+        if c_stats != NULL:
+            sampler_stats.elapsed += time.perf_counter() - start
+        bridge_keys = bridge_counts = None
+        if c_bridges != NULL:
+            bridge_keys = np.array(<size_t[:c_bridges.size]> c_bridges.keys)
+            bridge_counts = np.array(<double[:c_bridges.size]> c_bridges.counts)
+            occupied = bridge_keys != 0
+            bridge_keys, bridge_counts = bridge_keys[occupied], bridge_counts[occupied]
+            if bridge_counts.sum() != nsamples: raise MemoryError()
+    finally:
+        cgraph.histogramEVB_free(c_bridges)
+        _close_sample_file(c_samples, samples, nsamples)
+    return dihedrals.hist.h, adjacents.hist.h, visits.hist.h, bridge_keys, bridge_counts, trace_bins, trace_values
+
+def mc_simulate_dihedrals_adjacents_EV(target, py_lnhEV, qdih, nsteps, nsamples, incremental=True, \
+                                       seed=None, stream=0, nchains=1, nthreads=None, bridges=False, \
+                                       sampler_stats=None, samples=None, tolerance=None, verbose=False, moves=None):
+    '''Sample the average dihedral entropy loss and number of adjacent edges in each (E, V) bin
+
+    If bridges is True, an EVBHistogram of the number of samples with each value of B - V is
+    also returned, from which the dihedrals for any other qdih can be calculated.  If
+    sampler_stats is a SamplerStats, the moves of all of the chains are counted in it.  If
+    samples is a path, every sampled fragment is appended to the sample file there; see
+    pygtsa.samples.SampleReader.  moves is the mixture of Monte Carlo moves (see move_set).
+
+    If tolerance is given, the samples are collected adaptively (see mc_run_adaptive) until
+    the standard errors of the dihedrals and of the logarithm of the adjacents are at most
+    tolerance in every bin, with nsteps as the initial number of steps between samples and
+    nsamples as the largest number of samples.  A dict is then returned last, with the
+    standard errors of the dihedrals and adjacents as EVHistograms (under 'dihedrals' and
+    'adjacents'), together with the report of mc_run_adaptive.'''
+    cdef cgraph.Graph target_graph = cgraph.Graph(target)
+    cdef cgraph.HistogramEV lnhEV = cgraph.HistogramEV(target_graph, py_lnhEV)
+    _prepare_sample_file(samples, target_graph)
+
+    adaptive = tolerance != None
+    def chain(nsteps, nsamples, rng, fragment, chain_stats, chain_samples):
+        return _mc_chain_dihedrals_adjacents_EV(target, target_graph, lnhEV, qdih, nsteps, nsamples, incremental, \
+                                                moves, bridges, adaptive, rng, fragment, chain_stats, chain_samples)
+
+    if adaptive:
+        bridge_keys, bridge_counts = [], []
+        def add_batch(batches, results):
+            batches.add(sum(result[2] for result in results), \
+                        np.stack((sum(result[0] for result in results), sum(result[1] for result in results)), axis=-1))
+            if bridges:
+                bridge_keys.extend(result[3] for result in results)
+                bridge_counts.extend(result[4] for result in results)
+        def bin_errors(batches):
+            counts, means, errors = batches.errors()
+            return np.maximum(_relative_errors(means[...,0], errors[...,0]), \
+                              _relative_errors(means[...,1], errors[...,1]))
+        shape = cgraph.HistogramEV(target_graph, layout=lnhEV.layout).hist.h.shape
+        batches, report = mc_run_adaptive(chain, add_batch, bin_errors, _reachable_bins(lnhEV, shape), nsteps, \
+                                          nsamples, tolerance, [cgraph.Graph(target) for k in range(nchains)], \
+                                          nchains=nchains, nthreads=nthreads, seed=seed, stream=stream, \
+                                          sampler_stats=sampler_stats, samples=samples, verbose=verbose)
+        visits_h, means, errors = batches.errors()
+        dihedrals_h, adjacents_h = means[...,0], means[...,1]
+    else:
+        results = mc_run_chains(lambda *args: chain(nsteps, *args), nsamples, nchains=nchains, nthreads=nthreads, \
+                                seed=seed, stream=stream, sampler_stats=sampler_stats, samples=samples)
+        dihedrals_h = sum(result[0] for result in results)
+        adjacents_h = sum(result[1] for result in results)
+        visits_h = sum(result[2] for result in results)
+        bridge_keys, bridge_counts = [result[3] for result in results], [result[4] for result in results]
+    dihedrals = _histogramEV_from_array(target, dihedrals_h, layout=lnhEV.layout)
+    adjacents = _histogramEV_from_array(target, adjacents_h, layout=lnhEV.layout)
+    visits = _histogramEV_from_array(target, visits_h, dtype=int, layout=lnhEV.layout)
+
+    sampled = visits.h > 0
+    if not adaptive:
+        dihedrals.h[sampled] /= visits.h[sampled]
+        adjacents.h[sampled] /= visits.h[sampled]
+    dihedrals.h[sampled] = -np.log(dihedrals.h[sampled])
+    dihedrals.h[~sampled] = -1.
+    adjacents.h[~sampled] = -1.
+    outputs = (dihedrals, adjacents, visits)
+    if bridges:
+        outputs += (EVBHistogram.from_keys(target.number_of_edges(), target.number_of_nodes(), \
+                                           np.concatenate(bridge_keys), np.concatenate(bridge_counts)),)
+    if adaptive:
+        dihedral_errors = _histogramEV_from_array(target, _relative_errors(means[...,0], errors[...,0]), \
+                                                  layout=lnhEV.layout)
+        adjacent_errors = _histogramEV_from_array(target, errors[...,1], layout=lnhEV.layout)
+        dihedral_errors.h[~sampled] = -1.
+        adjacent_errors.h[~sampled] = -1.
+        outputs += (dict(report, dihedrals=dihedral_errors, adjacents=adjacent_errors),)
+    return outputs
+
+def energy_matrix(target, energy_dicts):
+    '''Compile per-edge energies into a K x N_edges array
+
+    Columns follow the stable edge order of the C graph, i.e. Graph(target).edges_iter().
+    Each dict may key an edge in either orientation.'''
+    edges = list(Graph(target).edges_iter())
+    energies = np.empty((len(energy_dicts), len(edges)))
+    for k in range(len(energy_dicts)):
+        d = energy_dicts[k]
+        energies[k,:] = [d[edge] if edge in d else d[edge[::-1]] for edge in edges]
+    return energies
+
+def _mc_chain_energies_EV(target, cgraph.Graph target_graph, cgraph.HistogramEV lnhEV, double[:, ::1] energies, \
+                          nsteps, nsamples, incremental, moves, trace, cgraph.RandomStream rng, fragment, \
+                          sampler_stats, samples):
+    cdef cgraph.Graph fragment_graph = fragment if fragment != None else cgraph.Graph(target)
+    cdef unsigned long c_nsteps = nsteps, c_nsamples = nsamples
+    cdef int c_incremental = incremental
+    cdef size_t nenergies = energies.shape[1]
+
+    cdef cgraph.HistogramEV visits = cgraph.HistogramEV(target_graph, layout=lnhEV.layout)
+    cdef double[:, ::1] sums = np.zeros((visits.hist.h.size, nenergies))
+    cdef cgraph.sampler_stats_t * c_stats = _bind_stats(sampler_stats, target_graph)
+    cdef cgraph.move_set_t c_move_set
+    cdef cgraph.move_set_t * c_moves = _bind_moves(moves, &c_move_set)
+    cdef cgraph.sample_file_t * c_samples = _open_sample_file(samples, target_graph)
+    trace_bins, trace_values = _trace_arrays(nsamples, trace)
+    cdef Py_ssize_t[::1] c_trace_bins = trace_bins
+    cdef double[::1] c_trace_values = trace_values
+    cdef Py_ssize_t * p_trace_bins = NULL
+    cdef double * p_trace_values = NULL
+    if trace_bins is not None:
+        p_trace_bins, p_trace_values = &c_trace_bins[0], &c_trace_values[0]
+
+    try:
+        start = time.perf_counter()
+        with nogil:
+            cgraph.mc_collect_subgraphs_EV(target_graph._graph, fragment_graph._graph, lnhEV._h, c_nsteps, c_nsamples, \
+                                           c_incremental, c_moves, rng._rng, 1., visits._h, NULL, NULL, NULL, \
+                                           nenergies, &energies[0, 0], &sums[0, 0], c_samples, p_trace_bins, \
+                                           p_trace_values, c_stats)
+        if c_stats != NULL:
+            sampler_stats.elapsed += time.perf_counter() - start
+    finally:
+        _close_sample_file(c_samples, samples, nsamples)
+    return np.asarray(sums).reshape(visits.hist.h.shape + (nenergies,)), visits.hist.h, trace_bins, trace_values
+
+def mc_simulate_energies_EV(target, py_lnhEV, energies, nsteps, nsamples, incremental=True, \
+                            seed=None, stream=0, nchains=1, nthreads=None, sampler_stats=None, samples=None, \
+                            tolerance=None, verbose=False, moves=None):
+    '''Average bond energies of sampled subgraphs for K independent realizations of the bond energies
+
+    energies is either a list of K dicts, mapping edges to energies, or a K x N_edges array in the
+    edge order of energy_matrix().  The result is averaged over the K realizations.  If
+    sampler_stats is a SamplerStats, the moves of all of the chains are counted in it.  If
+    samples is a path, every sampled fragment is appended to the sample file there, from which
+    SampleReader.mean_energies() calculates the same averages for any other energies.  moves
+    is the mixture of Monte Carlo moves (see move_set).
+
+    If tolerance is given, the samples are collected adaptively (see mc_run_adaptive) until
+    the standard error of the average bond energy is at most tolerance in every bin, with
+    nsteps as the initial number of steps between samples and nsamples as the largest number
+    of samples.  A dict is then returned last, with the standard errors as an EVHistogram
+    (under 'energies'), together with the report of mc_run_adaptive.  The errors are
+    estimated to first order in the fluctuations of the K averaged Boltzmann factors.'''
+    cdef cgraph.Graph target_graph = cgraph.Graph(target)
+    cdef cgraph.HistogramEV lnhEV = cgraph.HistogramEV(target_graph, py_lnhEV)
+
+    if not isinstance(energies, np.ndarray):
+        energies = energy_matrix(target, energies)
+    if energies.shape[1] != target.number_of_edges():
+        raise ValueError("expected energies for %d edges" % target.number_of_edges())
+    energy_means = energies.mean(axis=1)
+    energy_diffs = np.ascontiguousarray((energies - energy_means[:,None]).T, dtype=float)
+    _prepare_sample_file(samples, target_graph)
+
+    adaptive = tolerance != None
+    def chain(nsteps, nsamples, rng, fragment, chain_stats, chain_samples):
+        return _mc_chain_energies_EV(target, target_graph, lnhEV, energy_diffs, nsteps, nsamples, incremental, \
+                                     moves, adaptive, rng, fragment, chain_stats, chain_samples)
+
+    shape = cgraph.HistogramEV(target_graph, layout=lnhEV.layout).hist.h.shape
+    E = (lnhEV.layout if lnhEV.layout != None else EVLayout.of_array(np.empty(shape))).E
+    if adaptive:
+        def add_batch(batches, results):
+            batches.add(sum(result[1] for result in results), sum(result[0] for result in results))
+        def bin_errors(batches):
+            # To first order, the error of the average of ln <exp(-energy)> over the K realizations
+            counts, means = batches.means()
+            counts, means, errors = batches.errors(weights=1. / np.where(means > 0., means, 1.))
+            return errors[...,0] / (len(energies) * np.maximum(E, 1))
+        batches, report = mc_run_adaptive(chain, add_batch, bin_errors, _reachable_bins(lnhEV, shape), nsteps, \
+                                          nsamples, tolerance, [cgraph.Graph(target) for k in range(nchains)], \
+                                          nchains=nchains, nthreads=nthreads, seed=seed, stream=stream, \
+                                          sampler_stats=sampler_stats, samples=samples, verbose=verbose)
+        visits_h, sums = sum(batches.counts), sum(batches.sums)
+    else:
+        results = mc_run_chains(lambda *args: chain(nsteps, *args), nsamples, nchains=nchains, nthreads=nthreads, \
+                                seed=seed, stream=stream, sampler_stats=sampler_stats, samples=samples)
+        sums = sum(result[0] for result in results)
+        visits_h = sum(result[1] for result in results)
+    visits = _histogramEV_from_array(target, visits_h, dtype=int, layout=lnhEV.layout)
+
+    means = EVHistogram(target, layout=lnhEV.layout)
+    sampled = visits.h > 0
+    means.h[sampled] = (np.log(sums[sampled] / visits.h[sampled][:,None]) / E[sampled][:,None] \
+                        + energy_means[None,:]).mean(axis=1)
+    means.h[~sampled] = -1.
+    if adaptive:
+        errors = _histogramEV_from_array(target, bin_errors(batches), layout=lnhEV.layout)
+        errors.h[~sampled] = -1.
+        return means, visits, dict(report, energies=errors)
     return means, visits
+
+def _enumerate_root_EV(cgraph.Graph target_graph, size_t root):
+    cdef size_t M = target_graph._graph.nedges, N = target_graph._graph.max_nvertices
+    cdef double[::1] counts = np.zeros((M + 1) * (N + 1) * (M + 1))
+    cdef double[::1] adjacents = np.zeros((M + 1) * (N + 1))
+    cdef int status
+    with nogil:
+        status = cgraph.enumerate_subgraphs_EV(target_graph._graph, root, &counts[0], &adjacents[0])
+    if status < 0:
+        raise ValueError("exact enumeration is limited to graphs with at most 64 edges and vertices")
+    return np.asarray(counts), np.asarray(adjacents)
+
+def enumerate_EV(target, qdih, nthreads=None, banded=False):
+    '''Count every connected subgraph of the target exactly
+
+    Returns the density of states, the dihedral entropy loss and the average number of
+    adjacent edges in each (E, V) bin, in the same form as wl_simulate_EV and
+    mc_simulate_dihedrals_adjacents_EV, together with the number of subgraphs in each bin
+    and an EVBHistogram of the exact counts of each value of B - V.  The search tree is
+    split by the lowest-numbered edge of each subgraph, and the parts are enumerated on
+    nthreads threads.  Targets are limited to 64 edges and vertices; the time taken grows
+    with the number of connected subgraphs, so this is practical up to about 40 edges.'''
+    cdef cgraph.Graph target_graph = cgraph.Graph(target)
+    M, N = target.number_of_edges(), target.number_of_nodes()
+    if M == 0:
+        raise ValueError("the target has no edges")
+    if nthreads == None:
+        nthreads = os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        counts, adjacent_sums = 0., 0.
+        for result in executor.map(lambda root: _enumerate_root_EV(target_graph, root), range(M)):
+            counts, adjacent_sums = counts + result[0], adjacent_sums + result[1]
+
+    layout = EVLayout.from_graph(target, banded=False)
+    counts = counts.reshape(M + 1, N + 1, M + 1)
+    E, V, B = np.nonzero(counts)
+    bridges = EVBHistogram(M, N, E, V, B - V, counts[E,V,B])
+    nsubgraphs = np.zeros(layout.shape)
+    nsubgraphs[E, E - V + 1] = counts.sum(axis=2)[E,V]
+    adjacents = np.full(layout.shape, -1.)
+    adjacents[E, E - V + 1] = adjacent_sums.reshape(M + 1, N + 1)[E,V] / nsubgraphs[E, E - V + 1]
+    occupied = nsubgraphs > 0
+    lnhEV = np.full(layout.shape, -1.)
+    lnhEV[occupied] = np.log(nsubgraphs[occupied])
+
+    if banded:
+        layout = EVLayout.from_graph(target)
+    hists = [_histogramEV_from_array(target, layout.compact(h), dtype=h.dtype, layout=layout if banded else None) \
+             for h in (lnhEV, bridges.dihedrals(qdih), adjacents, nsubgraphs.astype(np.int64))]
+    return tuple(hists) + (bridges,)
@@ -25,12 +25,10 @@ if __name__ == '__main__':
     parser.add_argument('hist2', type=str, help="path to histogram file 2")
     clargs = parser.parse_args()
 
-    with open(clargs.hist1, 'r') as f:
-        hist1 = EVHistogram.read(f)
-    with open(clargs.hist2, 'r') as f:
-        hist2 = EVHistogram.read(f)
+    hist1 = EVHistogram.load(clargs.hist1)[0]
+    hist2 = EVHistogram.load(clargs.hist2)[0]
 
-    diff = hist2 - hist1
+    diff = hist2.to_layout(hist1.storage_layout()) - hist1.h
 
     print("mean(diff):", np.mean(diff))
     print("stddev(diff):", np.std(diff))
@@ -0,0 +1,29 @@
+# Copyright (C) 2014 William M. Jacobs
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or (at
+# your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import argparse
+from pygtsa.histogram import EVHistogram, BINARY_EXTENSION
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Convert histogram files between the text (.dat) and "
+                                     "binary (%s) formats; the format is chosen by file extension." % BINARY_EXTENSION)
+    parser.add_argument('input', type=str, help="path to input histogram file")
+    parser.add_argument('output', type=str, help="path to output histogram file")
+    clargs = parser.parse_args()
+
+    hist, meta = EVHistogram.load(clargs.input, mmap=False)
+    hist.save(clargs.output, meta)
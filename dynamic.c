@@ -0,0 +1,452 @@
+/* Copyright (C) 2014 William M. Jacobs
+ * 
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; either version 3 of the License, or (at
+ * your option) any later version.
+ * 
+ * This program is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * General Public License for more details.
+ * 
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+ */
+
+#include "config.h"
+
+#include "dynamic.h"
+
+dynamic_t * dynamic_alloc (const graph_t * graph)
+{
+  dynamic_t * dyn = (dynamic_t *) calloc (1, sizeof (dynamic_t));
+  if (dyn == NULL) goto fail;
+  const size_t nv = graph->max_nvertices;
+  const size_t ne = graph->nedges;
+  dyn->nedges = ne;
+
+  dyn->offset = (size_t *) malloc (sizeof (size_t) * (nv + 1));
+  if (dyn->offset == NULL) goto fail;
+  dyn->eids = (size_t *) malloc (sizeof (size_t) * (2 * ne + 1));
+  if (dyn->eids == NULL) goto fail;
+  dyn->edges = (edge_t *) malloc (sizeof (edge_t) * (ne + 1));
+  if (dyn->edges == NULL) goto fail;
+
+  dyn->in_subgraph = (unsigned long *) calloc (ne / DYNAMIC_WORD_BITS + 1, sizeof (unsigned long));
+  if (dyn->in_subgraph == NULL) goto fail;
+  dyn->pos_bridge = (size_t *) malloc (sizeof (size_t) * (ne + 1));
+  if (dyn->pos_bridge == NULL) goto fail;
+  dyn->pos_removable = (size_t *) malloc (sizeof (size_t) * (ne + 1));
+  if (dyn->pos_removable == NULL) goto fail;
+  dyn->pos_adjacent = (size_t *) malloc (sizeof (size_t) * (ne + 1));
+  if (dyn->pos_adjacent == NULL) goto fail;
+  dyn->eid_bridge = (size_t *) malloc (sizeof (size_t) * (ne + 1));
+  if (dyn->eid_bridge == NULL) goto fail;
+  dyn->eid_removable = (size_t *) malloc (sizeof (size_t) * (ne + 1));
+  if (dyn->eid_removable == NULL) goto fail;
+  dyn->eid_adjacent = (size_t *) malloc (sizeof (size_t) * (ne + 1));
+  if (dyn->eid_adjacent == NULL) goto fail;
+
+  dyn->nlog = 0;
+  dyn->log_eid = (size_t *) malloc (sizeof (size_t) * (ne + 1));
+  if (dyn->log_eid == NULL) goto fail;
+  dyn->log_bridge = (char *) malloc (sizeof (char) * (ne + 1));
+  if (dyn->log_bridge == NULL) goto fail;
+
+  dyn->gen = 0;
+  dyn->vmark = (unsigned long *) calloc (nv + 1, sizeof (unsigned long));
+  if (dyn->vmark == NULL) goto fail;
+  dyn->emark = (unsigned long *) calloc (ne + 1, sizeof (unsigned long));
+  if (dyn->emark == NULL) goto fail;
+  dyn->vparent = (size_t *) malloc (sizeof (size_t) * (nv + 1));
+  if (dyn->vparent == NULL) goto fail;
+  dyn->eflow = (size_t *) malloc (sizeof (size_t) * (ne + 1));
+  if (dyn->eflow == NULL) goto fail;
+  dyn->queue = (size_t *) malloc (sizeof (size_t) * (nv + 1));
+  if (dyn->queue == NULL) goto fail;
+  dyn->stack_iter = (size_t *) malloc (sizeof (size_t) * (nv + 1));
+  if (dyn->stack_iter == NULL) goto fail;
+  dyn->disc = (size_t *) malloc (sizeof (size_t) * (nv + 1));
+  if (dyn->disc == NULL) goto fail;
+  dyn->low = (size_t *) malloc (sizeof (size_t) * (nv + 1));
+  if (dyn->low == NULL) goto fail;
+
+  /* Assign a stable index to every edge of the target graph. */
+  size_t i, j, n = 0, eid = 0;
+  for (i = 0; i < nv; i++)
+    {
+      dyn->offset[i] = n;
+      for (j = 0; j < graph->nvedges[i]; j++, n++)
+	{
+	  if (graph->edges[i][j] > i)
+	    {
+	      dyn->eids[n] = eid;
+	      set_edge (dyn->edges[eid], i, graph->edges[i][j]);
+	      eid++;
+	    }
+	}
+    }
+  dyn->offset[nv] = n;
+  for (i = 0; i < nv; i++)
+    {
+      for (j = 0; j < graph->nvedges[i]; j++)
+	{
+	  if (graph->edges[i][j] < i)
+	    {
+	      dyn->eids[dyn->offset[i] + j] = dynamic_eid (dyn, graph, graph->edges[i][j], i);
+	    }
+	}
+    }
+
+  return dyn;
+
+ fail:
+  dynamic_free (dyn);
+  return NULL;
+}
+
+void dynamic_free (dynamic_t * dyn)
+{
+  if (dyn)
+    {
+      if (dyn->offset) free (dyn->offset);
+      if (dyn->eids) free (dyn->eids);
+      if (dyn->edges) free (dyn->edges);
+      if (dyn->in_subgraph) free (dyn->in_subgraph);
+      if (dyn->pos_bridge) free (dyn->pos_bridge);
+      if (dyn->pos_removable) free (dyn->pos_removable);
+      if (dyn->pos_adjacent) free (dyn->pos_adjacent);
+      if (dyn->eid_bridge) free (dyn->eid_bridge);
+      if (dyn->eid_removable) free (dyn->eid_removable);
+      if (dyn->eid_adjacent) free (dyn->eid_adjacent);
+      if (dyn->log_eid) free (dyn->log_eid);
+      if (dyn->log_bridge) free (dyn->log_bridge);
+      if (dyn->vmark) free (dyn->vmark);
+      if (dyn->emark) free (dyn->emark);
+      if (dyn->vparent) free (dyn->vparent);
+      if (dyn->eflow) free (dyn->eflow);
+      if (dyn->queue) free (dyn->queue);
+      if (dyn->stack_iter) free (dyn->stack_iter);
+      if (dyn->disc) free (dyn->disc);
+      if (dyn->low) free (dyn->low);
+      free (dyn);
+    }
+}
+
+size_t dynamic_eid (const dynamic_t * dyn, const graph_t * graph, vertex_t v1, vertex_t v2)
+{
+  /* Target rows are sorted by graph_add_edge. */
+  size_t lo = 0, hi = graph->nvedges[v1], mid;
+  while (lo < hi)
+    {
+      mid = (lo + hi) / 2;
+      if (graph->edges[v1][mid] < v2)
+	lo = mid + 1;
+      else
+	hi = mid;
+    }
+  if (lo < graph->nvedges[v1] && graph->edges[v1][lo] == v2)
+    return dyn->eids[dyn->offset[v1] + lo];
+  return DYNAMIC_NONE;
+}
+
+#define other_vertex(dyn, eid, v) \
+  (((dyn)->edges[eid].v1 == (v)) ? (dyn)->edges[eid].v2 : (dyn)->edges[eid].v1)
+
+#define is_bridge(dyn, eid) ((dyn)->pos_bridge[eid] != DYNAMIC_NONE)
+
+static void set_in_subgraph (dynamic_t * dyn, size_t eid, int in)
+{
+  const unsigned long bit = 1UL << (eid % DYNAMIC_WORD_BITS);
+  if (in)
+    dyn->in_subgraph[eid / DYNAMIC_WORD_BITS] |= bit;
+  else
+    dyn->in_subgraph[eid / DYNAMIC_WORD_BITS] &= ~bit;
+}
+
+static void list_insert (edge_t * list, size_t * n, size_t * pos, size_t * eid_at, const edge_t * edges, size_t eid)
+{
+  if (pos[eid] != DYNAMIC_NONE) return;
+  pos[eid] = *n;
+  eid_at[*n] = eid;
+  list[*n] = edges[eid];
+  (*n)++;
+}
+
+static void list_remove (edge_t * list, size_t * n, size_t * pos, size_t * eid_at, size_t eid)
+{
+  size_t i = pos[eid];
+  if (i == DYNAMIC_NONE) return;
+  (*n)--;
+  list[i] = list[*n];
+  eid_at[i] = eid_at[*n];
+  pos[eid_at[i]] = i;
+  pos[eid] = DYNAMIC_NONE;
+}
+
+static void set_bridge (dynamic_t * dyn, graph_t * subgraph, size_t eid, char bridge, int log)
+{
+  if (is_bridge (dyn, eid) == bridge) return;
+  if (log)
+    {
+      dyn->log_eid[dyn->nlog] = eid;
+      dyn->log_bridge[dyn->nlog] = !bridge;
+      dyn->nlog++;
+    }
+  if (bridge)
+    list_insert (subgraph->bridges, &subgraph->nbridges, dyn->pos_bridge, dyn->eid_bridge, dyn->edges, eid);
+  else
+    list_remove (subgraph->bridges, &subgraph->nbridges, dyn->pos_bridge, dyn->eid_bridge, eid);
+}
+
+static void update_edge (dynamic_t * dyn, graph_t * subgraph, size_t eid)
+{
+  const size_t d1 = subgraph->nvedges[dyn->edges[eid].v1];
+  const size_t d2 = subgraph->nvedges[dyn->edges[eid].v2];
+
+  /* Removable: non-bridges, and bridges that end in a leaf. */
+  if (dynamic_in_subgraph (dyn, eid) && (!is_bridge (dyn, eid) || d1 == 1 || d2 == 1))
+    list_insert (subgraph->removable, &subgraph->nremovable, dyn->pos_removable, dyn->eid_removable, dyn->edges, eid);
+  else
+    list_remove (subgraph->removable, &subgraph->nremovable, dyn->pos_removable, dyn->eid_removable, eid);
+
+  /* Adjacent: not in the subgraph, but touching at least one of its vertices. */
+  if (!dynamic_in_subgraph (dyn, eid) && (d1 > 0 || d2 > 0))
+    list_insert (subgraph->adjacents, &subgraph->nadjacents, dyn->pos_adjacent, dyn->eid_adjacent, dyn->edges, eid);
+  else
+    list_remove (subgraph->adjacents, &subgraph->nadjacents, dyn->pos_adjacent, dyn->eid_adjacent, eid);
+}
+
+static void update_vertex (dynamic_t * dyn, const graph_t * graph, graph_t * subgraph, vertex_t v)
+{
+  size_t k;
+  for (k = dyn->offset[v]; k < dyn->offset[v + 1]; k++)
+    {
+      update_edge (dyn, subgraph, dyn->eids[k]);
+    }
+}
+
+static void finish_move (dynamic_t * dyn, const graph_t * graph, graph_t * subgraph, vertex_t v1, vertex_t v2)
+{
+  size_t i;
+  update_vertex (dyn, graph, subgraph, v1);
+  update_vertex (dyn, graph, subgraph, v2);
+  for (i = 0; i < dyn->nlog; i++)
+    {
+      update_edge (dyn, subgraph, dyn->log_eid[i]);
+    }
+}
+
+void dynamic_init (dynamic_t * dyn, const graph_t * graph, graph_t * subgraph)
+{
+  size_t eid, i;
+
+  graph_find_bridges (subgraph);
+
+  for (eid = 0; eid < dyn->nedges; eid++)
+    {
+      const vertex_t v1 = dyn->edges[eid].v1, v2 = dyn->edges[eid].v2;
+      set_in_subgraph (dyn, eid, 0);
+      for (i = 0; i < subgraph->nvedges[v1]; i++)
+	{
+	  if (subgraph->edges[v1][i] == v2)
+	    {
+	      set_in_subgraph (dyn, eid, 1);
+	      break;
+	    }
+	}
+      dyn->pos_bridge[eid] = DYNAMIC_NONE;
+      dyn->pos_removable[eid] = DYNAMIC_NONE;
+      dyn->pos_adjacent[eid] = DYNAMIC_NONE;
+    }
+
+  const size_t nbridges = subgraph->nbridges;
+  subgraph->nbridges = 0;
+  subgraph->nremovable = 0;
+  subgraph->nadjacents = 0;
+  for (i = 0; i < nbridges; i++)
+    {
+      eid = dynamic_eid (dyn, graph, subgraph->bridges[i].v1, subgraph->bridges[i].v2);
+      /* Entries are rewritten in place, never ahead of the one being read. */
+      set_bridge (dyn, subgraph, eid, 1, 0);
+    }
+  for (eid = 0; eid < dyn->nedges; eid++)
+    {
+      update_edge (dyn, subgraph, eid);
+    }
+  dyn->nlog = 0;
+}
+
+/* Breadth-first search from u to v through the subgraph, skipping the
+ * edge eid_skip.  Only non-bridges are traversed if nonbridges_only is
+ * set.  If eid_flow is a valid generation, an edge may not be traversed
+ * in the direction of an earlier augmenting path.  On success, the
+ * path can be recovered from dyn->vparent. */
+static int find_path (dynamic_t * dyn, const graph_t * graph, const graph_t * subgraph, \
+		      vertex_t u, vertex_t v, size_t eid_skip, int nonbridges_only, unsigned long flow_gen)
+{
+  size_t head = 0, tail = 0, k;
+  const unsigned long gen = ++(dyn->gen);
+
+  dyn->vmark[u] = gen;
+  dyn->vparent[u] = DYNAMIC_NONE;
+  dyn->queue[tail++] = u;
+  while (head < tail)
+    {
+      const size_t x = dyn->queue[head++];
+      for (k = 0; k < graph->nvedges[x]; k++)
+	{
+	  const size_t eid = dyn->eids[dyn->offset[x] + k];
+	  const size_t y = graph->edges[x][k];
+	  if (!dynamic_in_subgraph (dyn, eid) || eid == eid_skip || dyn->vmark[y] == gen) continue;
+	  if (nonbridges_only && is_bridge (dyn, eid)) continue;
+	  if (flow_gen && dyn->emark[eid] == flow_gen && dyn->eflow[eid] == x) continue;
+	  dyn->vmark[y] = gen;
+	  dyn->vparent[y] = eid;
+	  if (y == v) return 1;
+	  dyn->queue[tail++] = y;
+	}
+    }
+  return 0;
+}
+
+/* Find all bridges in the 2-edge-connected component containing u,
+ * using an iterative version of Tarjan's algorithm. */
+static void find_component_bridges (dynamic_t * dyn, const graph_t * graph, graph_t * subgraph, vertex_t u)
+{
+  size_t sp = 0, t = 0;
+  const unsigned long gen = ++(dyn->gen);
+
+  dyn->vmark[u] = gen;
+  dyn->disc[u] = dyn->low[u] = ++t;
+  dyn->vparent[u] = DYNAMIC_NONE;
+  dyn->stack_iter[u] = 0;
+  dyn->queue[sp++] = u;
+  while (sp > 0)
+    {
+      const size_t x = dyn->queue[sp - 1];
+      if (dyn->stack_iter[x] < graph->nvedges[x])
+	{
+	  const size_t k = dyn->stack_iter[x]++;
+	  const size_t eid = dyn->eids[dyn->offset[x] + k];
+	  const size_t y = graph->edges[x][k];
+	  if (!dynamic_in_subgraph (dyn, eid) || is_bridge (dyn, eid) || eid == dyn->vparent[x]) continue;
+	  if (dyn->vmark[y] != gen)
+	    {
+	      dyn->vmark[y] = gen;
+	      dyn->disc[y] = dyn->low[y] = ++t;
+	      dyn->vparent[y] = eid;
+	      dyn->stack_iter[y] = 0;
+	      dyn->queue[sp++] = y;
+	    }
+	  else if (dyn->disc[y] < dyn->low[x])
+	    {
+	      dyn->low[x] = dyn->disc[y];
+	    }
+	}
+      else
+	{
+	  sp--;
+	  if (sp > 0)
+	    {
+	      const size_t p = dyn->queue[sp - 1];
+	      if (dyn->low[x] < dyn->low[p]) dyn->low[p] = dyn->low[x];
+	      if (dyn->low[x] > dyn->disc[p]) set_bridge (dyn, subgraph, dyn->vparent[x], 1, 1);
+	    }
+	}
+    }
+}
+
+void dynamic_add_edge (dynamic_t * dyn, const graph_t * graph, graph_t * subgraph, vertex_t v1, vertex_t v2)
+{
+  const size_t eid = dynamic_eid (dyn, graph, v1, v2);
+  const int cycle = (subgraph->nvedges[v1] > 0 && subgraph->nvedges[v2] > 0);
+
+  dyn->nlog = 0;
+  graph_add_edge (subgraph, v1, v2);
+  set_in_subgraph (dyn, eid, 1);
+  if (cycle)
+    {
+      /* Every bridge on a path from v1 to v2 now lies on a cycle. */
+      find_path (dyn, graph, subgraph, v1, v2, eid, 0, 0);
+      size_t y = v2;
+      while (y != v1)
+	{
+	  const size_t e = dyn->vparent[y];
+	  set_bridge (dyn, subgraph, e, 0, 1);
+	  y = other_vertex (dyn, e, y);
+	}
+    }
+  else
+    {
+      set_bridge (dyn, subgraph, eid, 1, 0);
+    }
+  finish_move (dyn, graph, subgraph, v1, v2);
+}
+
+void dynamic_remove_edge (dynamic_t * dyn, const graph_t * graph, graph_t * subgraph, vertex_t v1, vertex_t v2)
+{
+  const size_t eid = dynamic_eid (dyn, graph, v1, v2);
+  const int bridge = is_bridge (dyn, eid);
+
+  dyn->nlog = 0;
+  graph_remove_edge (subgraph, v1, v2);
+  set_in_subgraph (dyn, eid, 0);
+  set_bridge (dyn, subgraph, eid, 0, 0);
+  if (!bridge)
+    {
+      /* Any new bridge must separate v1 from v2.  If two edge-disjoint
+       * paths remain between them, no bridges have been created. */
+      find_path (dyn, graph, subgraph, v1, v2, eid, 1, 0);
+      const unsigned long flow_gen = dyn->gen;
+      size_t y = v2;
+      while (y != v1)
+	{
+	  const size_t e = dyn->vparent[y];
+	  y = other_vertex (dyn, e, y);
+	  dyn->emark[e] = flow_gen;
+	  dyn->eflow[e] = y;
+	}
+      if (!find_path (dyn, graph, subgraph, v1, v2, eid, 1, flow_gen))
+	{
+	  find_component_bridges (dyn, graph, subgraph, v1);
+	}
+    }
+  finish_move (dyn, graph, subgraph, v1, v2);
+}
+
+static void restore_log (dynamic_t * dyn, graph_t * subgraph)
+{
+  size_t i;
+  for (i = dyn->nlog; i > 0; i--)
+    {
+      set_bridge (dyn, subgraph, dyn->log_eid[i-1], dyn->log_bridge[i-1], 0);
+    }
+}
+
+void dynamic_undo_add_edge (dynamic_t * dyn, const graph_t * graph, graph_t * subgraph, vertex_t v1, vertex_t v2)
+{
+  const size_t eid = dynamic_eid (dyn, graph, v1, v2);
+
+  graph_remove_edge (subgraph, v1, v2);
+  set_in_subgraph (dyn, eid, 0);
+  set_bridge (dyn, subgraph, eid, 0, 0);
+  restore_log (dyn, subgraph);
+  finish_move (dyn, graph, subgraph, v1, v2);
+  dyn->nlog = 0;
+}
+
+void dynamic_undo_remove_edge (dynamic_t * dyn, const graph_t * graph, graph_t * subgraph, vertex_t v1, vertex_t v2)
+{
+  const size_t eid = dynamic_eid (dyn, graph, v1, v2);
+  const int cycle = (subgraph->nvedges[v1] > 0 && subgraph->nvedges[v2] > 0);
+
+  graph_add_edge (subgraph, v1, v2);
+  set_in_subgraph (dyn, eid, 1);
+  set_bridge (dyn, subgraph, eid, !cycle, 0);
+  restore_log (dyn, subgraph);
+  finish_move (dyn, graph, subgraph, v1, v2);
+  dyn->nlog = 0;
+}
@@ -0,0 +1,79 @@
+/* Copyright (C) 2014 William M. Jacobs
+ * 
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; either version 3 of the License, or (at
+ * your option) any later version.
+ * 
+ * This program is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * General Public License for more details.
+ * 
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+ */
+
+#ifndef __DYNAMIC_H__
+#define __DYNAMIC_H__
+
+#include <stdlib.h>
+#include "graph.h"
+
+#define DYNAMIC_NONE ((size_t) -1)
+
+/* Incremental maintenance of the bridges, removable and adjacent edge
+ * lists of a subgraph after single-edge insertions and deletions.
+ *
+ * Every edge of the target graph is assigned a stable index.  The
+ * subgraph's bridges, removable and adjacents arrays are kept up to
+ * date in place, so that the samplers can use them exactly as if they
+ * had been recomputed by graph_find_bridges and graph_find_adjacents.
+ * The order of the entries within each array is arbitrary. */
+
+typedef struct
+{
+  size_t nedges;
+  size_t * offset;		/* Index of the first edge of each target row */
+  size_t * eids;		/* Edge index for each target adjacency entry */
+  edge_t * edges;		/* Endpoints (v1 < v2) of each edge */
+
+  unsigned long * in_subgraph;	/* Bitset of the edges in the subgraph */
+  size_t * pos_bridge, * pos_removable, * pos_adjacent;
+  size_t * eid_bridge, * eid_removable, * eid_adjacent;
+
+  /* Bridge flags changed by the most recent move */
+  size_t nlog;
+  size_t * log_eid;
+  char * log_bridge;
+
+  /* Workspace for local searches */
+  unsigned long gen;
+  unsigned long * vmark;
+  unsigned long * emark;
+  size_t * vparent;
+  size_t * eflow;
+  size_t * queue;
+  size_t * stack_iter;
+  size_t * disc;
+  size_t * low;
+}
+dynamic_t;
+
+#define DYNAMIC_WORD_BITS (8 * sizeof (unsigned long))
+#define dynamic_in_subgraph(dyn, eid) \
+  (((dyn)->in_subgraph[(eid) / DYNAMIC_WORD_BITS] >> ((eid) % DYNAMIC_WORD_BITS)) & 1UL)
+
+dynamic_t * dynamic_alloc (const graph_t * graph);
+void dynamic_free (dynamic_t * dyn);
+void dynamic_init (dynamic_t * dyn, const graph_t * graph, graph_t * subgraph);
+
+size_t dynamic_eid (const dynamic_t * dyn, const graph_t * graph, vertex_t v1, vertex_t v2);
+
+void dynamic_add_edge (dynamic_t * dyn, const graph_t * graph, graph_t * subgraph, vertex_t v1, vertex_t v2);
+void dynamic_remove_edge (dynamic_t * dyn, const graph_t * graph, graph_t * subgraph, vertex_t v1, vertex_t v2);
+void dynamic_undo_add_edge (dynamic_t * dyn, const graph_t * graph, graph_t * subgraph, vertex_t v1, vertex_t v2);
+void dynamic_undo_remove_edge (dynamic_t * dyn, const graph_t * graph, graph_t * subgraph, vertex_t v1, vertex_t v2);
+
+#endif /* __DYNAMIC_H__ */
@@ -0,0 +1,158 @@
+/* Copyright (C) 2014 William M. Jacobs
+ * 
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; either version 3 of the License, or (at
+ * your option) any later version.
+ * 
+ * This program is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * General Public License for more details.
+ * 
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+ */
+
+#include "config.h"
+
+#include <string.h>
+#include "sample.h"
+
+/* Exact enumeration of connected subgraphs by Redelmeier's algorithm.
+ * Subgraphs, vertex sets and bridge sets are held as bitsets, so that
+ * every subgraph is visited once, in O(1) time apart from the search
+ * for the bridges on a newly closed cycle, and nothing is stored. */
+
+typedef unsigned long long edgeset_t;
+
+#define ENUMERATE_MAX (8 * sizeof (edgeset_t))
+#define bit(i) (((edgeset_t) 1) << (i))
+
+typedef struct
+{
+  size_t nedges, nvertices;
+  vertex_t v1[ENUMERATE_MAX], v2[ENUMERATE_MAX];
+  edgeset_t incident[ENUMERATE_MAX];	/* Edges incident to each vertex */
+  double * counts;
+  double * adjacents;
+}
+enumeration_t;
+
+static inline size_t count_bits (edgeset_t x)
+{
+#ifdef __GNUC__
+  return __builtin_popcountll (x);
+#else
+  size_t n = 0;
+  for (; x != 0; x &= x - 1) n++;
+  return n;
+#endif
+}
+
+static inline size_t lowest_bit (edgeset_t x)
+{
+#ifdef __GNUC__
+  return __builtin_ctzll (x);
+#else
+  size_t i = 0;
+  for (; !(x & 1); x >>= 1) i++;
+  return i;
+#endif
+}
+
+/* The edges of a path from u to v through the subgraph S. */
+static edgeset_t find_path (const enumeration_t * en, edgeset_t S, vertex_t u, vertex_t v)
+{
+  vertex_t queue[ENUMERATE_MAX];
+  size_t parent[ENUMERATE_MAX];
+  size_t head = 0, tail = 0, e;
+  edgeset_t visited = bit (u), es, path = 0;
+  vertex_t x, y;
+
+  queue[tail++] = u;
+  while (head < tail && !(visited & bit (v)))
+    {
+      x = queue[head++];
+      for (es = en->incident[x] & S; es != 0; es &= es - 1)
+	{
+	  e = lowest_bit (es);
+	  y = (en->v1[e] == x) ? en->v2[e] : en->v1[e];
+	  if (visited & bit (y)) continue;
+	  visited |= bit (y);
+	  parent[y] = e;
+	  queue[tail++] = y;
+	}
+    }
+  for (y = v; y != u; )
+    {
+      e = parent[y];
+      path |= bit (e);
+      y = (en->v1[e] == y) ? en->v2[e] : en->v1[e];
+    }
+  return path;
+}
+
+/* Visit S, then every connected extension of S by edges in ext.  Edges
+ * in seen are never added to ext again, so each subgraph is reached
+ * along exactly one path. */
+static void grow (const enumeration_t * en, edgeset_t S, edgeset_t ext, edgeset_t seen, edgeset_t vertices, \
+		  edgeset_t touched, edgeset_t bridges, size_t E)
+{
+  const size_t V = count_bits (vertices);
+  const size_t slot = E * (en->nvertices + 1) + V;
+  en->counts[slot * (en->nedges + 1) + count_bits (bridges)] += 1.;
+  en->adjacents[slot] += (double) count_bits (touched & ~S);
+
+  size_t e;
+  vertex_t u, v;
+  edgeset_t added;
+  while (ext != 0)
+    {
+      e = lowest_bit (ext);
+      ext &= ext - 1;
+      u = en->v1[e];
+      v = en->v2[e];
+      added = (en->incident[u] | en->incident[v]) & ~seen;
+      grow (en, S | bit (e), ext | added, seen | added, vertices | bit (u) | bit (v), \
+	    touched | en->incident[u] | en->incident[v], \
+	    ((vertices & bit (u)) && (vertices & bit (v))) ? bridges & ~find_path (en, S, u, v) : bridges | bit (e), \
+	    E + 1);
+    }
+}
+
+int enumerate_subgraphs_EV (const graph_t * graph, size_t root, double * counts, double * adjacents)
+{
+  enumeration_t en;
+  size_t i, j;
+
+  if (graph->nedges > ENUMERATE_MAX || graph->max_nvertices > ENUMERATE_MAX || root >= graph->nedges)
+    return -1;
+  en.nvertices = graph->max_nvertices;
+  en.counts = counts;
+  en.adjacents = adjacents;
+  memset (en.incident, 0, sizeof (en.incident));
+  /* Edges are numbered by their first vertex and then by their second. */
+  for (i = 0, en.nedges = 0; i < graph->max_nvertices; i++)
+    {
+      for (j = 0; j < graph->nvedges[i]; j++)
+	{
+	  if (graph->edges[i][j] > i)
+	    {
+	      en.v1[en.nedges] = i;
+	      en.v2[en.nedges] = graph->edges[i][j];
+	      en.incident[i] |= bit (en.nedges);
+	      en.incident[graph->edges[i][j]] |= bit (en.nedges);
+	      en.nedges++;
+	    }
+	}
+    }
+
+  /* Subgraphs whose lowest edge is root. */
+  const vertex_t u = en.v1[root], v = en.v2[root];
+  const edgeset_t below = bit (root) | (bit (root) - 1);
+  const edgeset_t touched = en.incident[u] | en.incident[v];
+  grow (&en, bit (root), touched & ~below, touched | below, bit (u) | bit (v), touched, bit (root), 1);
+  return 0;
+}
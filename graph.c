@@ -21,53 +21,69 @@
 
 graph_t * graph_alloc (size_t nv, size_t max_degree)
 {
-  graph_t * graph = (graph_t *) malloc (sizeof (graph_t));
+  size_t i;
+  size_t * degrees = (size_t *) malloc (sizeof (size_t) * (nv + 1));
+  if (degrees == NULL) return NULL;
+  for (i = 0; i < nv; i++)
+    {
+      degrees[i] = max_degree;
+    }
+  graph_t * graph = graph_alloc_degrees (nv, degrees);
+  free (degrees);
+  return graph;
+}
+
+graph_t * graph_alloc_degrees (size_t nv, const size_t * degrees)
+{
+  graph_t * graph = (graph_t *) calloc (1, sizeof (graph_t));
   if (graph == NULL) goto fail;
   graph->max_nvertices = nv;
-  graph->max_nedges = nv * max_degree;
   graph->nvertices = 0;
   graph->nedges = 0;
-  graph->nvedges = (size_t *) malloc (sizeof (size_t) * nv);
+  graph->nvedges = (size_t *) calloc (nv + 1, sizeof (size_t));
   if (graph->nvedges == NULL) goto fail;
-  graph->edges = (unsigned short **) malloc (sizeof (unsigned short *) * nv);
+  graph->offsets = (size_t *) malloc (sizeof (size_t) * (nv + 1));
+  if (graph->offsets == NULL) goto fail;
+  size_t i;
+  graph->offsets[0] = 0;
+  for (i = 0; i < nv; i++)
+    {
+      graph->offsets[i+1] = graph->offsets[i] + degrees[i];
+    }
+  /* Each edge appears in the rows of both of its vertices. */
+  graph->max_nedges = graph->offsets[nv] / 2;
+  graph->edges = (vertex_t **) malloc (sizeof (vertex_t *) * (nv + 1));
   if (graph->edges == NULL) goto fail;
-  graph->edges[0] = (unsigned short *) malloc (sizeof (unsigned short *) * graph->max_nedges);
+  graph->edges[0] = (vertex_t *) calloc (graph->offsets[nv] + 1, sizeof (vertex_t));
   if (graph->edges[0] == NULL) goto fail;
-  size_t i, j;
-  for (i = 0; i < nv; i++)
+  for (i = 1; i < nv; i++)
     {
-      graph->nvedges[i] = 0;
-      if (i > 0)
-	{
-	  graph->edges[i] = graph->edges[0] + i * max_degree;
-	}
-      for (j = 0; j < max_degree; j++)
-	{
-	  graph->edges[i][j] = 0;
-	}
+      graph->edges[i] = graph->edges[0] + graph->offsets[i];
     }
   graph->nbridges = 0;
-  graph->bridges = (edge_t *) malloc (sizeof (edge_t) * graph->max_nedges);
+  graph->bridges = (edge_t *) malloc (sizeof (edge_t) * (graph->max_nedges + 1));
   if (graph->bridges == NULL) goto fail;
   graph->nremovable = 0;
-  graph->removable = (edge_t *) malloc (sizeof (edge_t) * graph->max_nedges);
+  graph->removable = (edge_t *) malloc (sizeof (edge_t) * (graph->max_nedges + 1));
   if (graph->removable == NULL) goto fail;
   graph->nadjacents = 0;
-  graph->adjacents = (edge_t *) malloc (sizeof (edge_t) * graph->max_nedges);
+  graph->adjacents = (edge_t *) malloc (sizeof (edge_t) * (graph->max_nedges + 1));
   if (graph->adjacents == NULL) goto fail;
-
   graph->_dfs_iter = 0;
-  graph->_dfs_visited = (char *) malloc (sizeof (char) * nv);
+  graph->_dfs_gen = 0;
+  graph->_dfs_visited = (unsigned long *) calloc (nv + 1, sizeof (unsigned long));
   if (graph->_dfs_visited == NULL) goto fail;
-  graph->_dfs_discovery = (unsigned short *) malloc (sizeof (unsigned short) * nv);
+  graph->_dfs_discovery = (size_t *) malloc (sizeof (size_t) * (nv + 1));
   if (graph->_dfs_discovery == NULL) goto fail;
-  graph->_dfs_low = (unsigned short *) malloc (sizeof (unsigned short) * nv);
+  graph->_dfs_low = (size_t *) malloc (sizeof (size_t) * (nv + 1));
   if (graph->_dfs_low == NULL) goto fail;
-  graph->_dfs_parent = (unsigned short *) malloc (sizeof (unsigned short) * nv);
+  graph->_dfs_parent = (vertex_t *) malloc (sizeof (vertex_t) * (nv + 1));
   if (graph->_dfs_parent == NULL) goto fail;
-
+  graph->_dfs_next = (size_t *) malloc (sizeof (size_t) * (nv + 1));
+  if (graph->_dfs_next == NULL) goto fail;
+  graph->_dfs_stack = (vertex_t *) malloc (sizeof (vertex_t) * (nv + 1));
+  if (graph->_dfs_stack == NULL) goto fail;
   return graph;
-
  fail:
   graph_free (graph);
   return NULL;
@@ -78,6 +94,7 @@ void graph_free (graph_t * graph)
   if (graph)
     {
       if (graph->nvedges) free (graph->nvedges);
+      if (graph->offsets) free (graph->offsets);
       if (graph->edges)
 	{
 	  if (graph->edges[0]) free (graph->edges[0]);
@@ -90,6 +107,8 @@ void graph_free (graph_t * graph)
       if (graph->_dfs_discovery) free (graph->_dfs_discovery);
       if (graph->_dfs_low) free (graph->_dfs_low);
       if (graph->_dfs_parent) free (graph->_dfs_parent);
+      if (graph->_dfs_next) free (graph->_dfs_next);
+      if (graph->_dfs_stack) free (graph->_dfs_stack);
       free (graph);
     }
 }
@@ -119,7 +138,7 @@ void graph_copy (const graph_t * orig, graph_t * dest)
 
 }
 
-void graph_add_edge (graph_t * graph, unsigned short v1, unsigned short v2)
+void graph_add_edge (graph_t * graph, vertex_t v1, vertex_t v2)
 {
   size_t i, j;
 
@@ -144,7 +163,7 @@ void graph_add_edge (graph_t * graph, unsigned short v1, unsigned short v2)
   if (graph->nvedges[v2] == 1) graph->nvertices++;
 }
 
-void graph_remove_edge (graph_t * graph, unsigned short v1, unsigned short v2)
+void graph_remove_edge (graph_t * graph, vertex_t v1, vertex_t v2)
 {
   size_t i, j;
 
@@ -166,3 +185,36 @@ void graph_remove_edge (graph_t * graph, unsigned short v1, unsigned short v2)
   if (graph->nvedges[v1] == 0) graph->nvertices--;
   if (graph->nvedges[v2] == 0) graph->nvertices--;
 }
+
+void graph_set_edges (graph_t * graph, size_t nedges, const edge_t * edges)
+{
+  /* Fill the rows directly, then sort them, rather than inserting one
+   * edge at a time. */
+  size_t i, j, k;
+  vertex_t v, * row;
+  for (i = 0; i < graph->max_nvertices; i++)
+    {
+      graph->nvedges[i] = 0;
+    }
+  for (k = 0; k < nedges; k++)
+    {
+      graph->edges[edges[k].v1][graph->nvedges[edges[k].v1]++] = edges[k].v2;
+      graph->edges[edges[k].v2][graph->nvedges[edges[k].v2]++] = edges[k].v1;
+    }
+  graph->nedges = nedges;
+  graph->nvertices = 0;
+  for (i = 0; i < graph->max_nvertices; i++)
+    {
+      row = graph->edges[i];
+      for (j = 1; j < graph->nvedges[i]; j++)
+	{
+	  v = row[j];
+	  for (k = j; k > 0 && row[k-1] > v; k--)
+	    {
+	      row[k] = row[k-1];
+	    }
+	  row[k] = v;
+	}
+      if (graph->nvedges[i] > 0) graph->nvertices++;
+    }
+}
@@ -20,18 +20,29 @@
 
 #include <stdlib.h>
 
+/* Vertex ids are 32 bits wide, so that targets may have more than
+ * 65535 vertices. */
+typedef unsigned int vertex_t;
+
 typedef struct
 {
-  unsigned short v1, v2;
+  vertex_t v1, v2;
 }
 edge_t;
 
+/* Adjacency lists are stored in compressed sparse row form.  The
+ * neighbours of vertex i, in increasing order, are edges[i][0] to
+ * edges[i][nvedges[i] - 1], where edges[i] points to offsets[i] in a
+ * single array with room for offsets[i + 1] - offsets[i] neighbours.
+ * A subgraph of a target is allocated with the target's degrees. */
+
 typedef struct
 {
   size_t max_nvertices, nvertices;
   size_t max_nedges, nedges;
   size_t * nvedges;
-  unsigned short ** edges;
+  size_t * offsets;
+  vertex_t ** edges;
   size_t nbridges;
   edge_t * bridges;
   size_t nremovable;
@@ -39,21 +50,27 @@ typedef struct
   size_t nadjacents;
   edge_t * adjacents;
 
-  /* Workspace for dfs bridge detection */
+  /* Workspace for dfs bridge detection; a vertex has been visited if
+   * it is marked with the current generation */
   size_t _dfs_iter;
-  char * _dfs_visited;
-  unsigned short * _dfs_discovery;
-  unsigned short * _dfs_low;
-  unsigned short * _dfs_parent;
+  unsigned long _dfs_gen;
+  unsigned long * _dfs_visited;
+  size_t * _dfs_discovery;
+  size_t * _dfs_low;
+  vertex_t * _dfs_parent;
+  size_t * _dfs_next;
+  vertex_t * _dfs_stack;
 }
 graph_t;
 
 graph_t * graph_alloc (size_t nv, size_t max_degree);
+graph_t * graph_alloc_degrees (size_t nv, const size_t * degrees);
 void graph_free (graph_t * graph);
 void graph_copy (const graph_t * orig, graph_t * dest);
 
-void graph_add_edge (graph_t * graph, unsigned short v1, unsigned short v2);
-void graph_remove_edge (graph_t * graph, unsigned short v1, unsigned short v2);
+void graph_add_edge (graph_t * graph, vertex_t v1, vertex_t v2);
+void graph_remove_edge (graph_t * graph, vertex_t v1, vertex_t v2);
+void graph_set_edges (graph_t * graph, size_t nedges, const edge_t * edges);
 
 #define set_edge(edge, va, vb)			\
   do {						\
@@ -14,18 +14,153 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
+import json, struct
 import numpy as np
 
+# Binary histogram files hold a JSON header and the raw array, so that they
+# can be memory-mapped.  The header records the dtype, the shape, the index
+# convention (rows E, columns E - V + 1), the band of a banded histogram
+# (see EVLayout) and the '#' metadata tags of the equivalent text file.
+BINARY_EXTENSION = '.evh'
+BINARY_MAGIC = b'PYGTSAEV'
+BINARY_ALIGN = 64
+
+class EVLayout(object):
+    '''Storage layout of an (E, V) histogram
+
+    A dense layout stores an array with rows E and columns j = E - V + 1.  A banded layout
+    stores, for each E, only the columns jmin[E] <= j <= jmax[E], concatenated row by row in
+    a 1-d array.  In either case, E and V are arrays of the coordinates of the stored entries,
+    and axes are the array axes that they span.'''
+    def __init__(self, nrows, ncols, nvertices, jmin=None, jmax=None):
+        self.nrows, self.ncols, self.nvertices = nrows, ncols, nvertices
+        if jmin is None:
+            self.jmin = self.jmax = None
+            self.shape = (nrows, ncols)
+            self.axes = (-2, -1)
+            self.E, j = np.indices(self.shape)
+        else:
+            self.jmin, self.jmax = np.asarray(jmin, dtype=int), np.asarray(jmax, dtype=int)
+            widths = self.jmax - self.jmin + 1
+            self.starts = np.concatenate(([0], np.cumsum(widths)[:-1]))
+            self.shape = (int(widths.sum()),)
+            self.axes = (-1,)
+            self.E = np.repeat(np.arange(nrows), widths)
+            j = self.jmin[self.E] + np.arange(self.shape[0]) - self.starts[self.E]
+        self.V = self.E - j + 1
+
+    def banded(self):
+        return self.jmin is not None
+
+    @staticmethod
+    def of_array(h):
+        '''Dense layout of an array with rows E and columns E - V + 1
+
+        As in the text files, the last column is taken to be the extra column added for gnuplot.'''
+        return EVLayout(h.shape[-2], h.shape[-1], h.shape[-2] - h.shape[-1] + 2)
+
+    @staticmethod
+    def from_graph(graph, banded=True):
+        '''Layout of the histograms of the connected subgraphs of graph
+
+        In the banded layout, the number of vertices V of a subgraph with E edges satisfies
+        V <= min(E + 1, N), and V >= Vmin(E), the smallest V for which an upper bound on the
+        number of edges among V vertices (from the number of pairs, the largest degrees, and
+        the edges lost with the remaining vertices) reaches E.'''
+        nedges, nvertices = graph.number_of_edges(), graph.number_of_nodes()
+        nrows, ncols = nedges + 1, nedges - nvertices + 2
+        if not banded:
+            return EVLayout(nrows, ncols, nvertices)
+        degrees = np.sort([d for v, d in graph.degree()])[::-1]
+        v = np.arange(nvertices + 1)
+        top = np.concatenate(([0], np.cumsum(degrees)))
+        Emax = np.minimum(np.minimum(v * (v - 1) // 2, top // 2), nedges - (top[-1] - top + 1) // 2)
+        E = np.arange(nrows)
+        Vmin = np.searchsorted(np.maximum.accumulate(Emax), E)
+        jmin = np.maximum(0, E + 1 - nvertices)
+        jmax = np.maximum(jmin, np.minimum(E + 1 - Vmin, ncols - 1))
+        return EVLayout(nrows, ncols, nvertices, jmin, jmax)
+
+    def index(self, E, V):
+        j = E - V + 1
+        if j < 0:
+            raise Exception("The graph is disconnected.")
+        if not self.banded():
+            return E, j
+        if not self.jmin[E] <= j <= self.jmax[E]:
+            raise IndexError("(E, V) = (%d, %d) lies outside the stored band" % (E, V))
+        return (self.starts[E] + j - self.jmin[E],)
+
+    def flat_index(self, E, V):
+        '''Indices of the entries (E, V) (which must lie in the layout) in the flattened array'''
+        return self.offsets()[E] + E - V + 1
+
+    def offsets(self, row_length=None):
+        '''The offset of column 0 of each row, as used by the C histograms (see sample.h)'''
+        if not self.banded():
+            return np.arange(self.nrows, dtype=np.intp) * (self.ncols if row_length == None else row_length)
+        return (self.starts - self.jmin).astype(np.intp)
+
+    def dense(self, data, fill=-1.):
+        '''Expand data in this layout into a dense array, with fill outside the band'''
+        if not self.banded():
+            return data
+        h = np.full(data.shape[:-1] + (self.nrows, self.ncols), fill, dtype=data.dtype)
+        h[...,self.E,self.E - self.V + 1] = data
+        return h
+
+    def compact(self, h):
+        '''Extract the entries of this layout from a dense array'''
+        if not self.banded():
+            return h
+        return h[...,self.E,self.E - self.V + 1]
+
+    def __eq__(self, other):
+        return isinstance(other, EVLayout) and (self.nrows, self.ncols, self.nvertices) \
+            == (other.nrows, other.ncols, other.nvertices) and self.banded() == other.banded() \
+            and (not self.banded() or (np.array_equal(self.jmin, other.jmin) and np.array_equal(self.jmax, other.jmax)))
+
 class EVHistogram(object):
-    def __init__(self, graph, dtype=float):
-        if graph != None:
+    '''Histogram over (E, V)
+
+    By default, h is a dense array with rows E and columns E - V + 1.  If layout is a banded
+    EVLayout, h holds only the entries in the band; see EVLayout.'''
+    def __init__(self, graph, dtype=float, layout=None):
+        self.layout = layout
+        if layout != None:
+            self.h = np.zeros(layout.shape, dtype=dtype)
+        elif graph != None:
             Emax = len(graph.edges())
             Vmax = len(graph.nodes())
             self.h = np.zeros((Emax + 1, Emax - Vmax + 2), dtype=dtype)
         else:
             self.h = None
 
+    def banded(self):
+        return getattr(self, 'layout', None) != None and self.layout.banded()
+
+    def dense(self):
+        return self.layout.dense(self.h) if self.banded() else self.h
+
+    def storage_layout(self):
+        '''The layout of h: either its banded layout, or the dense layout of the array'''
+        return self.layout if self.banded() else EVLayout.of_array(self.h)
+
+    def to_layout(self, layout, fill=-1.):
+        '''The histogram in the given layout, with fill in any entries that are not stored here'''
+        if self.storage_layout() == layout:
+            return self.h
+        h = self.dense()
+        if layout.banded():
+            return layout.compact(h)
+        dense = np.full(layout.shape, fill, dtype=h.dtype)
+        nrows, ncols = min(layout.shape[0], h.shape[0]), min(layout.shape[1], h.shape[1])
+        dense[:nrows,:ncols] = h[:nrows,:ncols]
+        return dense
+
     def _index(self, E, V):
+        if self.banded():
+            return self.layout.index(E, V)
         index = E, (E - V + 1)
         if index[1] < 0:
             raise Exception("The graph is disconnected.")
@@ -37,14 +172,21 @@ class EVHistogram(object):
     def inc(self, E, V, w=1.):
         self.h[self._index(E, V)] += w
 
+    def _addrow(self):
+        if self.banded():
+            return True
+        return not all(self.h[i,-1] == -1. for i in range(self.h.shape[0]))
+
     def write(self, stream, addrow=True):
-        if all(self.h[i,-1] == -1. for i in range(self.h.shape[0])):
+        '''Write the histogram as text; banded histograms are written in full, with -1 outside the band'''
+        if not self._addrow():
             addrow = False
-        for i in range(self.h.shape[0]):
-            for j in range(self.h.shape[1]):
-                stream.write("%d %d %g\n" % (i, j, self.h[i,j]))
+        h = self.dense()
+        for i in range(h.shape[0]):
+            for j in range(h.shape[1]):
+                stream.write("%d %d %g\n" % (i, j, h[i,j]))
             if addrow: # Add extra row for gnuplot: `pm3d map corners2color c3'
-                stream.write("%d %d %g\n" % (i, self.h.shape[1], -1.))
+                stream.write("%d %d %g\n" % (i, h.shape[1], -1.))
             stream.write("\n")
 
     @staticmethod
@@ -60,14 +202,192 @@ class EVHistogram(object):
             hist.h[int(d[0]),int(d[1])] = d[2]
         return hist
 
+    def save(self, path, meta={}):
+        '''Write the histogram and metadata tags, in the binary format if path ends in BINARY_EXTENSION
+
+        Either way, reading the file back gives the same array, including the extra column
+        that is added for gnuplot.  Banded histograms keep their layout in binary files.'''
+        meta = {key : _meta_tokens(value) for key, value in meta.items()}
+        if is_binary_path(path):
+            if self.banded():
+                write_binary(path, self.h, meta, layout=self.layout)
+                return
+            h = self.h
+            if self._addrow():
+                h = np.concatenate((h, np.full((h.shape[0], 1), -1, dtype=h.dtype)), axis=1)
+            write_binary(path, h, meta)
+        else:
+            with open(path, 'w') as f:
+                for key, value in meta.items():
+                    f.write("# %s %s\n" % (key, ' '.join(value)))
+                if len(meta) > 0:
+                    f.write("\n")
+                self.write(f)
+
+    @staticmethod
+    def load(path, mmap=True):
+        '''Read a histogram and its metadata tags from a text or binary file'''
+        if is_binary_path(path):
+            hist = EVHistogram(None)
+            hist.h, meta, hist.layout = read_binary(path, mmap=mmap)
+        else:
+            with open(path, 'r') as f:
+                hist = EVHistogram.read(f)
+                f.seek(0, 0)
+                meta = read_meta(f)
+        return hist, meta
+
     def __add__(self, s):
         return self.h + s.h
     def __sub__(self, s):
         return self.h - s.h
 
+class EVBHistogram(object):
+    '''Sparse histogram of samples over (E, V, B - V), where B is the number of bridges
+
+    The occupied entries are held as parallel arrays E, V, BV (= B - V) and counts, sorted
+    by bin.  nedges and nvertices are those of the target graph.'''
+    def __init__(self, nedges, nvertices, E=(), V=(), BV=(), counts=()):
+        self.nedges, self.nvertices = nedges, nvertices
+        E, V, BV = (np.asarray(a, dtype=int) for a in (E, V, BV))
+        counts = np.asarray(counts, dtype=float)
+        order = np.lexsort((BV, V, E))
+        self.E, self.V, self.BV, self.counts = E[order], V[order], BV[order], counts[order]
+
+    @staticmethod
+    def from_keys(nedges, nvertices, keys, counts):
+        '''Decode and merge the keys of one or more C histogramEVB_t tables (see sample.h)'''
+        keys, index = np.unique(np.asarray(keys, dtype=np.uint64) - 1, return_inverse=True)
+        counts = np.bincount(index.ravel(), weights=counts, minlength=len(keys))
+        EV, B = np.divmod(keys, nedges + 1)
+        E, V = np.divmod(EV, nvertices + 1)
+        return EVBHistogram(nedges, nvertices, E, V, B.astype(int) - V.astype(int), counts)
+
+    def shape(self):
+        return (self.nedges + 1, self.nedges - self.nvertices + 2)
+
+    def dihedrals(self, qdih, layout=None):
+        '''Calculate -ln <qdih^(1 + B - V)> in each (E, V) bin, or -1 in bins with no samples
+
+        If qdih is an array, the result has its shape as leading dimensions.  The result is
+        dense unless a (banded) layout is given.'''
+        if layout == None:
+            layout = EVLayout(*self.shape(), self.nvertices)
+        qdih = np.asarray(qdih, dtype=float)
+        dihedrals = np.full(qdih.shape + (int(np.prod(layout.shape)),), -1.)
+        if len(self.counts) > 0:
+            bins = layout.flat_index(self.E, self.V)
+            starts = np.flatnonzero(np.concatenate(([True], bins[1:] != bins[:-1])))
+            lnw = np.log(self.counts) + np.multiply.outer(np.log(qdih), 1. + self.BV)
+            lnsum = np.logaddexp.reduceat(lnw, starts, axis=-1)
+            dihedrals[...,bins[starts]] = np.log(np.add.reduceat(self.counts, starts)) - lnsum
+        return dihedrals.reshape(qdih.shape + layout.shape)
+
+    def write(self, stream):
+        stream.write("# E V B-V count\n")
+        for E, V, BV, count in zip(self.E, self.V, self.BV, self.counts):
+            stream.write("%d %d %d %.17g\n" % (E, V, BV, count))
+
+    @staticmethod
+    def read(stream):
+        meta = read_meta(stream)
+        stream.seek(0, 0)
+        data = np.loadtxt(stream, ndmin=2).reshape(-1, 4)
+        return EVBHistogram(int(meta['nedges'][-1]), int(meta['nvertices'][-1]), \
+                            data[:,0], data[:,1], data[:,2], data[:,3])
+
+    def save(self, path, meta={}):
+        meta = dict({'nedges' : self.nedges, 'nvertices' : self.nvertices}, **meta)
+        with open(path, 'w') as f:
+            for key, value in meta.items():
+                f.write("# %s %s\n" % (key, ' '.join(_meta_tokens(value))))
+            self.write(f)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'r') as f:
+            hist = EVBHistogram.read(f)
+            f.seek(0, 0)
+            meta = read_meta(f)
+        return hist, meta
+
+def stitch_windows(hists, windows):
+    '''Combine log-histograms sampled over overlapping windows in E into one histogram'''
+    layout = hists[0].layout if hists[0].banded() else EVLayout.of_array(hists[0].h)
+    E = layout.E
+    h = np.array(hists[0].h, dtype=float)
+    valid = (h >= 0.) & (E <= windows[0][1])
+    for k in range(1, len(hists)):
+        piece = hists[k].h
+        Emin, Emax_prev = windows[k][0], windows[k-1][1]
+        overlap = (E >= Emin) & (E <= Emax_prev) & valid & (piece >= 0.)
+        if not overlap.any():
+            raise Exception("windows %d and %d have no sampled bins in common" % (k - 1, k))
+        shift = np.mean(h[overlap] - piece[overlap])
+        upper = E >= (Emin + Emax_prev + 1) // 2
+        h[upper] = piece[upper] + shift
+        valid[upper] = piece[upper] >= 0.
+        valid &= E <= windows[k][1]
+    hist = EVHistogram(None)
+    hist.h = np.where(valid, h - h[valid].min(), -1.)
+    hist.layout = hists[0].layout
+    return hist
+
 def read_histogram(stream):
     return EVHistogram.read(stream).h
 
 def read_meta(stream):
     tags = {line.split()[1] : line.split()[2:] for line in stream if line[0] == '#'}
     return tags
+
+def load_histogram(path, mmap=True, layout=None):
+    '''Read a histogram array and its metadata tags, converted to the given layout if not None'''
+    hist, meta = EVHistogram.load(path, mmap=mmap)
+    return (hist.h if layout == None else hist.to_layout(layout)), meta
+
+def _meta_tokens(value):
+    if isinstance(value, (list, tuple)):
+        return [str(v) for v in value]
+    return ['='] + str(value).split()
+
+def is_binary_path(path):
+    return path.endswith(BINARY_EXTENSION)
+
+def write_binary(path, h, meta={}, layout=None):
+    h = np.ascontiguousarray(h)
+    header = {'dtype' : h.dtype.str, 'shape' : list(h.shape), 'index' : 'E, E-V+1', 'meta' : meta}
+    if layout != None and layout.banded():
+        header['layout'] = {'nrows' : layout.nrows, 'ncols' : layout.ncols, 'nvertices' : layout.nvertices, \
+                            'jmin' : layout.jmin.tolist(), 'jmax' : layout.jmax.tolist()}
+    header = json.dumps(header).encode('utf-8')
+    offset = len(BINARY_MAGIC) + 4 + len(header)
+    header += b' ' * (-offset % BINARY_ALIGN)
+    with open(path, 'wb') as f:
+        f.write(BINARY_MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        f.write(h.tobytes())
+
+def read_binary(path, mmap=True):
+    '''Read a binary histogram file; with mmap, the array is a copy-on-write view of the file
+
+    Returns the array, the metadata tags and the EVLayout of a banded histogram (or None).'''
+    with open(path, 'rb') as f:
+        if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise Exception("%s is not a binary histogram file" % path)
+        length, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(length).decode('utf-8'))
+        offset = len(BINARY_MAGIC) + 4 + length
+        if header['index'] != 'E, E-V+1':
+            raise Exception("unknown histogram index convention in %s" % path)
+        dtype = np.dtype(header['dtype'])
+        shape = tuple(header['shape'])
+        if mmap:
+            h = np.memmap(path, dtype=dtype, mode='c', offset=offset, shape=shape)
+        else:
+            f.seek(offset, 0)
+            h = np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+    layout = header.get('layout')
+    if layout != None:
+        layout = EVLayout(layout['nrows'], layout['ncols'], layout['nvertices'], layout['jmin'], layout['jmax'])
+    return h, header['meta'], layout
@@ -17,15 +17,26 @@
 
 #include "config.h"
 
+#include <float.h>
 #include "sample.h"
 
 histogramEV_t * histogramEV_alloc (const graph_t * graph)
 {
-  histogramEV_t * h = (histogramEV_t *) malloc (sizeof (histogramEV_t));
+  /* A dense histogram with one row for each number of edges and one
+   * column for each cyclomatic number of the graph. */
+  const size_t nrows = graph->nedges + 1;
+  const size_t ncols = graph->nedges - graph->nvertices + 2;
+  size_t E;
+  histogramEV_t * h = (histogramEV_t *) calloc (1, sizeof (histogramEV_t));
   if (h == NULL) goto fail;
-  h->max_x = graph->max_nedges + 1;
-  h->max_y = graph->max_nedges - graph->max_nvertices + 2;
-  h->data = (double *) malloc (sizeof (double) * h->max_x * h->max_y);
+  h->size = nrows * ncols;
+  h->offsets = (ptrdiff_t *) malloc (sizeof (ptrdiff_t) * nrows);
+  if (h->offsets == NULL) goto fail;
+  for (E = 0; E < nrows; E++)
+    {
+      h->offsets[E] = E * ncols;
+    }
+  h->data = (double *) malloc (sizeof (double) * h->size);
   if (h->data == NULL) goto fail;
   return h;
  fail:
@@ -36,6 +47,7 @@ histogramEV_t * histogramEV_alloc (const graph_t * graph)
 void histogramEV_free (histogramEV_t * h)
 {
   if (h == NULL) return;
+  if (h->offsets != NULL) free (h->offsets);
   if (h->data != NULL) free (h->data);
   free (h);
 }
@@ -43,8 +55,157 @@ void histogramEV_free (histogramEV_t * h)
 void histogramEV_fill (histogramEV_t * h, double z)
 {
   size_t i;
-  for (i = 0; i < h->max_x * h->max_y; i++)
+  for (i = 0; i < h->size; i++)
     {
       h->data[i] = z;
     }
 }
+
+int histogramEV_flat (const histogramEV_t * visits, double flatness)
+{
+  /* Compare the mean and maximum over all visited bins. */
+  size_t i;
+  unsigned long n = 0;
+  double visits_sum = 0.;
+  double visits_max = 0.;
+  for (i = 0; i < visits->size; i++)
+    {
+      if (visits->data[i] > 0.)
+	{
+	  n++;
+	  visits_sum += visits->data[i];
+	  visits_max = (visits->data[i] > visits_max) ? visits->data[i] : visits_max;
+	}
+    }
+  return (n > 0 && visits_sum / (double) n > flatness * visits_max);
+}
+
+void flatness_init (flatness_t * stats, const histogramEV_t * visits)
+{
+  size_t i;
+  stats->nvisited = 0;
+  stats->sum = 0.;
+  stats->max = 0.;
+  for (i = 0; i < visits->size; i++)
+    {
+      if (visits->data[i] > 0.)
+	{
+	  stats->nvisited++;
+	  stats->sum += visits->data[i];
+	  stats->max = (visits->data[i] > stats->max) ? visits->data[i] : stats->max;
+	}
+    }
+}
+
+int flatness_check (const flatness_t * stats, double flatness)
+{
+  /* Equivalent to histogramEV_flat for the histogram that stats describes. */
+  return (stats->nvisited > 0 && stats->sum / (double) stats->nvisited > flatness * stats->max);
+}
+
+void histogramEV_tare (histogramEV_t * h)
+{
+  /* Shift the smallest positive entry to zero; mark all others as -1. */
+  size_t i;
+  double h_min = DBL_MAX;
+  for (i = 0; i < h->size; i++)
+    {
+      h_min = (h->data[i] > 0 && h->data[i] < h_min) ? h->data[i] : h_min;
+    }
+  for (i = 0; i < h->size; i++)
+    {
+      if (h->data[i] >= h_min)
+	{
+	  h->data[i] -= h_min;
+	}
+      else
+	{
+	  h->data[i] = -1.;
+	}
+    }
+}
+
+#define HISTOGRAMEVB_INITIAL_SIZE 1024
+
+histogramEVB_t * histogramEVB_alloc (const graph_t * graph)
+{
+  histogramEVB_t * h = (histogramEVB_t *) calloc (1, sizeof (histogramEVB_t));
+  if (h == NULL) goto fail;
+  h->nedges = graph->nedges;
+  h->nvertices = graph->nvertices;
+  h->size = HISTOGRAMEVB_INITIAL_SIZE;
+  h->keys = (size_t *) calloc (h->size, sizeof (size_t));
+  if (h->keys == NULL) goto fail;
+  h->counts = (double *) calloc (h->size, sizeof (double));
+  if (h->counts == NULL) goto fail;
+  return h;
+ fail:
+  histogramEVB_free (h);
+  return NULL;
+}
+
+void histogramEVB_free (histogramEVB_t * h)
+{
+  if (h == NULL) return;
+  if (h->keys != NULL) free (h->keys);
+  if (h->counts != NULL) free (h->counts);
+  free (h);
+}
+
+static size_t histogramEVB_slot (const size_t * keys, size_t size, size_t key)
+{
+  /* Multiplicative hashing with linear probing; size is a power of two. */
+  size_t i = (size_t) ((key * 11400714819323198485ULL) >> 17) & (size - 1);
+  while (keys[i] != 0 && keys[i] != key)
+    {
+      i = (i + 1) & (size - 1);
+    }
+  return i;
+}
+
+static int histogramEVB_grow (histogramEVB_t * h)
+{
+  size_t i, j, size = 2 * h->size;
+  size_t * keys = (size_t *) calloc (size, sizeof (size_t));
+  double * counts = (double *) calloc (size, sizeof (double));
+  if (keys == NULL || counts == NULL)
+    {
+      if (keys) free (keys);
+      if (counts) free (counts);
+      return -1;
+    }
+  for (i = 0; i < h->size; i++)
+    {
+      if (h->keys[i] != 0)
+	{
+	  j = histogramEVB_slot (keys, size, h->keys[i]);
+	  keys[j] = h->keys[i];
+	  counts[j] = h->counts[i];
+	}
+    }
+  free (h->keys);
+  free (h->counts);
+  h->keys = keys;
+  h->counts = counts;
+  h->size = size;
+  return 0;
+}
+
+int histogramEVB_inc (histogramEVB_t * h, size_t E, size_t V, size_t B, double z)
+{
+  const size_t key = 1 + B + (h->nedges + 1) * (V + (h->nvertices + 1) * E);
+  size_t i = histogramEVB_slot (h->keys, h->size, key);
+  if (h->keys[i] == 0)
+    {
+      /* Keep the table at most half full. */
+      if (2 * (h->n + 1) > h->size)
+	{
+	  if (histogramEVB_grow (h) < 0) return -1;
+	  i = histogramEVB_slot (h->keys, h->size, key);
+	}
+      h->keys[i] = key;
+      h->n++;
+    }
+  h->counts[i] += z;
+  return 0;
+}
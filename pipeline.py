@@ -0,0 +1,436 @@
+# Copyright (C) 2014 William M. Jacobs
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or (at
+# your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import argparse, hashlib, json, os, sys, time, traceback
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pygtsa.structure import Assembly
+from pygtsa.histogram import EVHistogram, BINARY_EXTENSION
+from pygtsa.calc_yield import find_target_indices, epsilon_range, rho_range, write_yield
+from pygtsa.calc_barrier import write_barrier
+from pygtsa.calc_fe_profile import write_fe_profile
+from pygtsa.calc_incidental import write_incidental
+from pygtsa.calc_energies import write_bond_energies
+from pygtsa.calc_subgraphs import MC_STEPS_PER_EDGE, MC_SAMPLES_PER_BIN, MC_MAX_SAMPLES_PER_BIN
+from pygtsa.cgraph import Graph, wl_simulate_EV, mc_simulate_dihedrals_adjacents_EV, mc_simulate_energies_EV, \
+    enumerate_EV, move_set, MOVE_MAX_PATCH
+
+# The stages of a calculation, in order, and the analyses among them, which only depend on
+# the outputs of the subgraphs and energies stages and run concurrently.
+STAGES = ('subgraphs', 'energies', 'yield', 'barrier', 'fe_profile', 'incidental')
+ANALYSES = ('yield', 'barrier', 'fe_profile', 'incidental')
+
+# Options that affect the outputs of each stage
+STAGE_OPTIONS = {'subgraphs' : ('qdih', 'qcoord', 'windows', 'seed', 'chains', 'schedule', 'tolerance', 'banded', \
+                                'exact', 'error_tolerance', 'max_samples_per_bin', 'vertex_moves', 'patch_moves', \
+                                'max_patch', 'format'),
+                 'energies' : ('energies', 'energy_samples', 'seed', 'chains', 'energy_error_tolerance', \
+                               'max_samples_per_bin', 'vertex_moves', 'patch_moves', 'max_patch', 'format'),
+                 'yield' : ('rho', 'rho_max', 'nrho', 'epsilon'),
+                 'barrier' : ('rho', 'rho_max', 'nrho', 'epsilon'),
+                 'fe_profile' : ('rho', 'fixed_epsilon'),
+                 'incidental' : ('rho', 'fixed_epsilon', 'incidental_w')}
+
+# Record of the stages that have run in an output directory
+MANIFEST = 'pipeline.json'
+
+def digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def read_manifest(directory):
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def write_manifest(directory, manifest):
+    path = os.path.join(directory, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+def structure_name(path):
+    '''Name of the output directory for a structure file: that of its directory if the file is named edges.dat'''
+    path = os.path.abspath(path)
+    if os.path.basename(path) == 'edges.dat':
+        return os.path.basename(os.path.dirname(path))
+    return os.path.splitext(os.path.basename(path))[0]
+
+def find_structures(paths):
+    '''Structure files named by paths: files, directories with an edges.dat, or directories of such directories'''
+    structures = []
+    for path in paths:
+        if not os.path.isdir(path):
+            structures.append(path)
+        elif os.path.exists(os.path.join(path, 'edges.dat')):
+            structures.append(os.path.join(path, 'edges.dat'))
+        else:
+            structures.extend(os.path.join(path, name, 'edges.dat') for name in sorted(os.listdir(path)) \
+                              if os.path.exists(os.path.join(path, name, 'edges.dat')))
+    return structures
+
+def _as_saved(hist, text=False):
+    '''The histogram as it is read back after it is saved
+
+    A dense histogram gains an extra gnuplot column, and a text file holds the histogram in
+    full, rounded to the precision of %g.'''
+    if text:
+        h = np.char.mod('%g', hist.dense()).astype(float)
+    elif hist.banded() or not hist._addrow():
+        return hist
+    else:
+        h = hist.h
+    if hist._addrow():
+        h = np.concatenate((h, np.full((h.shape[0], 1), -1, dtype=h.dtype)), axis=1)
+    saved = EVHistogram(None)
+    saved.h = h
+    return saved
+
+def mc_budget(target, lnhEV, error_tolerance, options):
+    '''The error tolerance (or None), initial number of steps between samples and number of samples
+    of the Monte Carlo averages, as in calc_subgraphs and calc_energies'''
+    nsteps = MC_STEPS_PER_EDGE * target.number_of_edges()
+    nbins = int(np.count_nonzero(lnhEV.h >= 0.))
+    if error_tolerance > 0.:
+        return error_tolerance, nsteps, options['max_samples_per_bin'] * nbins
+    return None, nsteps, MC_SAMPLES_PER_BIN * nbins
+
+class Pipeline(object):
+    '''The declared stages of the calculation for one structure, run in a single process
+
+    Each stage writes the same files as the corresponding calc_* script to directory, and
+    passes its histograms to the following stages in memory.  A stage is skipped if its options
+    and the contents of its input files are the same as when it last ran, according to the
+    manifest in directory; the outputs of skipped or undeclared stages are read from directory
+    if a later stage needs them.  If the energies stage is declared, the analyses use its
+    average bond energies (as with const-var in the calc_* scripts); otherwise the bond
+    energies are uniform (zero-var).  The analyses run concurrently on nthreads threads.'''
+    def __init__(self, structure, directory, stages, options, nthreads=None, force=False, verbose=True):
+        self.structure, self.directory = structure, directory
+        self.stages = [stage for stage in STAGES if stage in stages]
+        self.options = options
+        self.nthreads, self.force, self.verbose = nthreads, force, verbose
+        self.ext = '.dat' if options['format'] == 'text' else BINARY_EXTENSION
+        self.data = {}
+
+    def log(self, message):
+        if self.verbose:
+            sys.stdout.write("%s: %s\n" % (structure_name(self.structure), message))
+            sys.stdout.flush()
+
+    def path(self, name):
+        if name == 'structure':
+            return self.structure
+        text = ('bonds', 'dihedral_counts') + ANALYSES
+        return os.path.join(self.directory, name + ('.dat' if name in text else self.ext))
+
+    def inputs(self, stage):
+        if stage == 'subgraphs':
+            return ('structure',)
+        elif stage == 'energies':
+            return ('structure', 'lnhEV')
+        inputs = ('lnhEV', 'dihedrals') + (('adjacents',) if stage == 'incidental' else ())
+        return inputs + (('energies',) if 'energies' in self.stages else ())
+
+    def outputs(self, stage):
+        if stage == 'subgraphs':
+            errors = ('dihedrals_error', 'adjacents_error') \
+                if not self.options['exact'] and self.options['error_tolerance'] > 0. else ()
+            return ('lnhEV', 'dihedrals', 'dihedral_counts', 'adjacents') + errors + \
+                ('subgraph_counts' if self.options['exact'] else 'sampling_visits',)
+        elif stage == 'energies':
+            errors = ('energies_error',) if self.options['energy_error_tolerance'] > 0. else ()
+            return ('bonds', 'energies') + errors + ('energies_sampling_visits',)
+        return (stage,)
+
+    def fingerprint(self, stage):
+        '''Digest of the options of a stage and the contents of its input files'''
+        inputs = {}
+        for name in self.inputs(stage):
+            if not os.path.exists(self.path(name)):
+                raise Exception("%s not found; run the stage that writes it first" % self.path(name))
+            inputs[name] = file_digest(self.path(name))
+        options = {key : self.options[key] for key in STAGE_OPTIONS[stage]}
+        return digest(json.dumps([stage, options, inputs], sort_keys=True).encode('utf-8'))
+
+    def up_to_date(self, stage, fingerprint):
+        record = self.manifest.get(stage)
+        return not self.force and record != None and record['fingerprint'] == fingerprint \
+            and all(os.path.exists(self.path(name)) for name in self.outputs(stage))
+
+    def get(self, name):
+        '''A histogram written by an earlier stage, from memory or else from its file'''
+        if name not in self.data:
+            hist, meta = EVHistogram.load(self.path(name))
+            self.data[name] = hist
+            if name == 'dihedrals':
+                self.data['dihedrals_meta'] = {key : float(meta[key][-1]) for key in ('qdih', 'qcoord')}
+        return self.data[name]
+
+    def run(self):
+        '''Run the stages that are out of date and return a summary of each stage'''
+        os.makedirs(self.directory, exist_ok=True)
+        self.manifest = read_manifest(self.directory)
+        summary = {}
+        for stage in [stage for stage in self.stages if stage not in ANALYSES]:
+            summary[stage] = self.run_stages([stage], getattr(self, 'run_' + stage))
+        analyses = [stage for stage in self.stages if stage in ANALYSES]
+        if len(analyses) > 0:
+            summary.update(self.run_stages(analyses, self.run_analysis, concurrent=True))
+        return summary
+
+    def run_stages(self, stages, run, concurrent=False):
+        fingerprints = {stage : self.fingerprint(stage) for stage in stages}
+        todo = [stage for stage in stages if not self.up_to_date(stage, fingerprints[stage])]
+        summary = {stage : {'skipped' : True} for stage in stages if stage not in todo}
+        for stage in summary:
+            self.log("%s is up to date" % stage)
+        if len(todo) == 0:
+            return summary if concurrent else summary[stages[0]]
+        if concurrent:
+            self.prepare_analyses()
+        def timed_run(stage):
+            self.log("running %s" % stage)
+            start = time.perf_counter()
+            run(stage)
+            return time.perf_counter() - start
+        if concurrent and len(todo) > 1:
+            with ThreadPoolExecutor(max_workers=self.nthreads or len(todo)) as executor:
+                times = list(executor.map(timed_run, todo))
+        else:
+            times = [timed_run(stage) for stage in todo]
+        for stage, elapsed in zip(todo, times):
+            self.log("%s finished in %.3g s" % (stage, elapsed))
+            self.manifest[stage] = {'fingerprint' : fingerprints[stage], 'time' : elapsed, \
+                                    'outputs' : [os.path.basename(self.path(name)) for name in self.outputs(stage)]}
+            summary[stage] = {'skipped' : False, 'time' : elapsed}
+        write_manifest(self.directory, self.manifest)
+        return summary if concurrent else summary[stages[0]]
+
+    def target(self):
+        if 'target' not in self.data:
+            self.data['target'] = Assembly.read(self.structure)
+        return self.data['target']
+
+    def moves(self):
+        return move_set(self.options['vertex_moves'], self.options['patch_moves'], self.options['max_patch'])
+
+    def run_subgraphs(self, stage):
+        '''As calc_subgraphs, without checkpoints or statistics'''
+        target, options = self.target(), self.options
+        if options['exact']:
+            lnhEV, dihedrals, adjacents, visits, bridges = \
+                enumerate_EV(target, options['qdih'], banded=options['banded'])
+            lnhEV.save(self.path('lnhEV'), {'method' : 'exact'})
+        else:
+            lnhEV = wl_simulate_EV(target, output=self.path('lnhEV'), verbose=False, nwindows=options['windows'], \
+                                   nworkers=options['wl_workers'], seed=options['seed'], \
+                                   schedule=options['schedule'], tolerance=options['tolerance'], \
+                                   banded=options['banded'], moves=self.moves())
+            tolerance, nsteps, nsamples = mc_budget(target, lnhEV, options['error_tolerance'], options)
+            results = mc_simulate_dihedrals_adjacents_EV(target, lnhEV, options['qdih'], nsteps, nsamples, \
+                                                         seed=options['seed'], stream=options['windows'] + 1, \
+                                                         nchains=options['chains'], bridges=True, tolerance=tolerance, \
+                                                         moves=self.moves())
+            dihedrals, adjacents, visits, bridges = results[:4]
+            if tolerance != None:
+                for name in ('dihedrals', 'adjacents'):
+                    results[4][name].save(self.path(name + '_error'), {'tolerance' : "%g" % tolerance})
+        dihedrals.save(self.path('dihedrals'), {'qcoord' : "%g" % options['qcoord'], 'qdih' : "%g" % options['qdih']})
+        bridges.save(self.path('dihedral_counts'), {'qcoord' : "%g" % options['qcoord']})
+        adjacents.save(self.path('adjacents'))
+        visits.save(self.path(self.outputs(stage)[-1]))
+        self.data.update({'lnhEV' : lnhEV, 'dihedrals' : dihedrals, 'adjacents' : adjacents, \
+                          'dihedrals_meta' : {key : float("%g" % options[key]) for key in ('qdih', 'qcoord')}})
+
+    def run_energies(self, stage):
+        '''As calc_energies with a Gaussian distribution of bond energies'''
+        target, options = self.target(), self.options
+        mean, stddev = options['energies']
+        edges = list(Graph(target).edges_iter())
+        rng = np.random.default_rng(options['seed'])
+        bond_energies = rng.normal(mean, stddev, size=(options['energy_samples'], len(edges)))
+        with open(self.path('bonds'), 'w') as f:
+            write_bond_energies(f, edges, bond_energies)
+        lnhEV = self.get('lnhEV')
+        tolerance, nsteps, nsamples = mc_budget(target, lnhEV, options['energy_error_tolerance'], options)
+        results = mc_simulate_energies_EV(target, lnhEV, bond_energies, nsteps, nsamples, seed=options['seed'], \
+                                          nchains=options['chains'], tolerance=tolerance, moves=self.moves())
+        energies, visits = results[:2]
+        energies.save(self.path('energies'), {'average' : ['energies', '(gaussian', 'distribution)']})
+        if tolerance != None:
+            results[2]['energies'].save(self.path('energies_error'), {'tolerance' : "%g" % tolerance})
+        visits.save(self.path('energies_sampling_visits'))
+        self.data['energies'] = energies
+
+    def prepare_analyses(self):
+        '''Arrays shared by the analyses, with the layout and precision that the analysis scripts
+        read from the files'''
+        text = self.ext == '.dat'
+        lnhEV = _as_saved(self.get('lnhEV'), text)
+        layout = lnhEV.storage_layout()
+        dihedrals = _as_saved(self.get('dihedrals'), text).to_layout(layout)
+        if 'energies' in self.stages:
+            energies = _as_saved(self.get('energies'), text).to_layout(layout)
+            epsilon_expmean = energies - energies[max(find_target_indices(dihedrals))]
+        else:
+            epsilon_expmean = np.zeros(dihedrals.shape)
+        adjacents = None
+        if 'incidental' in self.stages:
+            adjacents = _as_saved(self.get('adjacents'), text).to_layout(layout)
+        self.analysis_inputs = (lnhEV.h, dihedrals, self.data['dihedrals_meta'], adjacents, epsilon_expmean, layout)
+
+    def run_analysis(self, stage):
+        '''As calc_yield, calc_barrier, calc_fe_profile or calc_incidental'''
+        lnhEV, dihedrals, dihedrals_meta, adjacents, epsilon_expmean, layout = self.analysis_inputs
+        options = self.options
+        with open(self.path(stage), 'w') as f:
+            if stage in ('yield', 'barrier'):
+                epsilon = epsilon_range(*options['epsilon'])
+                rho = rho_range(options['rho'], options['rho_max'], options['nrho'])
+                write = write_yield if stage == 'yield' else write_barrier
+                write(f, lnhEV, dihedrals, dihedrals_meta, epsilon, rho, epsilon_expmean, layout)
+            elif stage == 'fe_profile':
+                write_fe_profile(f, lnhEV, dihedrals, dihedrals_meta, options['fixed_epsilon'], options['rho'], \
+                                 epsilon_expmean, layout)
+            else:
+                write_incidental(f, lnhEV, dihedrals, dihedrals_meta, adjacents, options['fixed_epsilon'], \
+                                 options['rho'], options['incidental_w'], epsilon_expmean, layout)
+
+def run_pipeline(task):
+    '''Run the pipeline for one structure; returns its name, the summary of each stage and any error'''
+    structure, directory, stages, options, nthreads, force = task
+    try:
+        summary = Pipeline(structure, directory, stages, options, nthreads=nthreads, force=force).run()
+        return structure_name(structure), summary, None
+    except Exception:
+        return structure_name(structure), None, traceback.format_exc()
+
+def make_parser():
+    parser = argparse.ArgumentParser(description="Run the stages of the calculation for one or more structures "
+                                     "in a single process per structure, skipping the stages whose inputs are "
+                                     "unchanged.")
+    parser.add_argument('structures', type=str, nargs='+', \
+                        help="structure files, directories containing edges.dat, or directories of such directories")
+    parser.add_argument('--stages', choices=STAGES, nargs='+', \
+                        default=['subgraphs', 'yield', 'barrier', 'fe_profile', 'incidental'], \
+                        help="stages to run [subgraphs yield barrier fe_profile incidental]")
+    parser.add_argument('--output-dir', metavar='PATH', type=str, default='.', \
+                        help="directory in which a directory is made for the outputs of each structure [.]")
+    parser.add_argument('--format', choices=('text', 'binary'), default='text', \
+                        help="histogram file format: text (.dat) or binary (%s) [text]" % BINARY_EXTENSION)
+    parser.add_argument('--force', action='store_true', help="run every declared stage, even if it is up to date")
+    parser.add_argument('--workers', metavar='N', type=int, default=1, \
+                        help="number of structures processed at once, in separate processes [1]")
+    parser.add_argument('--threads', metavar='N', type=int, default=None, \
+                        help="number of threads for the analysis stages of each structure [one per stage]")
+    parser.add_argument('--seed', type=int, default=None, help="random number generator seed [None]")
+    parser.add_argument('--chains', metavar='N', type=int, default=1, \
+                        help="number of independent Monte Carlo chains, run on parallel threads [1]")
+    parser.add_argument('--qcoord', metavar='Q', type=float, default=4., help="monomer rotation constant [4.]")
+    parser.add_argument('--qdih', metavar='Q', type=float, default=3., help="dihedral angle connective constant [3.]")
+    parser.add_argument('--windows', metavar='N', type=int, default=1, \
+                        help="number of overlapping Wang--Landau windows in the number of edges [1]")
+    parser.add_argument('--wl-workers', metavar='N', type=int, default=None, \
+                        help="number of worker processes for windowed Wang--Landau sampling [None]")
+    parser.add_argument('--schedule', choices=('halving', '1/t'), default='halving', \
+                        help="Wang--Landau modification factor schedule [halving]")
+    parser.add_argument('--tolerance', metavar='TOL', type=float, default=None, \
+                        help="stop Wang--Landau sampling once the estimated error in lnhEV is below TOL [None]")
+    parser.add_argument('--banded', action='store_true', \
+                        help="store only the reachable band of (E, V) bins; written in full to text files")
+    parser.add_argument('--exact', action='store_true', \
+                        help="count every connected subgraph instead of sampling (at most 64 edges)")
+    parser.add_argument('--energies', metavar=('MU', 'SIGMA'), type=float, nargs=2, default=None, \
+                        help="mean and standard deviation of the Gaussian bond energies, for the energies stage")
+    parser.add_argument('--energy-samples', metavar='N', type=int, default=100, \
+                        help="number of independent energy samples [100]")
+    parser.add_argument('--error-tolerance', metavar='TOL', type=float, default=0., \
+                        help="sample the dihedrals and adjacents until the standard errors of the dihedrals and of " \
+                        "ln(adjacents) are at most TOL in every bin, or with 0, collect %d samples per bin [0]" \
+                        % MC_SAMPLES_PER_BIN)
+    parser.add_argument('--energy-error-tolerance', metavar='TOL', type=float, default=0., \
+                        help="sample the energies until the standard error of the average energy is at most TOL in " \
+                        "every bin, or with 0, collect %d samples per bin [0]" % MC_SAMPLES_PER_BIN)
+    parser.add_argument('--max-samples-per-bin', metavar='N', type=int, default=MC_MAX_SAMPLES_PER_BIN, \
+                        help="largest number of samples per bin with an error tolerance [%d]" % MC_MAX_SAMPLES_PER_BIN)
+    parser.add_argument('--vertex-moves', metavar='P', type=float, default=0., \
+                        help="probability of moves that add or remove a vertex with all of its edges [0]")
+    parser.add_argument('--patch-moves', metavar='P', type=float, default=0., \
+                        help="probability of moves that add or remove a patch of several edges [0]")
+    parser.add_argument('--max-patch', metavar='N', type=int, default=MOVE_MAX_PATCH, \
+                        help="largest number of edges in a patch move [%d]" % MOVE_MAX_PATCH)
+    parser.add_argument('--rho', type=float, default=1.e-3, help="dimensionless number density [1e-3]")
+    parser.add_argument('--rho-max', metavar='RHO', type=float, default=None, \
+                        help="maximum density, for a logarithmically spaced sweep in yield and barrier [None]")
+    parser.add_argument('--nrho', metavar='N', type=int, default=1, help="number of densities in the sweep [1]")
+    parser.add_argument('--epsilon', metavar=('EMIN', 'EMAX', 'DE'), type=float, nargs=3, default=[0., 20., 0.1], \
+                        help="range of dimensionless energies for yield and barrier [0 20 0.1]")
+    parser.add_argument('--fixed-epsilon', metavar='E', type=float, default=4., \
+                        help="dimensionless energy for fe_profile and incidental [4]")
+    parser.add_argument('--incidental-w', metavar='W', type=float, default=1., \
+                        help="mean dimensionless incidental energy [1]")
+    return parser
+
+if __name__ == '__main__':
+
+    parser = make_parser()
+    clargs = parser.parse_args()
+
+    if 'energies' in clargs.stages and clargs.energies == None:
+        print("ERROR: the energies stage requires --energies MU SIGMA")
+        raise SystemExit
+    if clargs.error_tolerance < 0. or clargs.energy_error_tolerance < 0. or clargs.max_samples_per_bin < 1:
+        print("ERROR: the error tolerances must not be negative, and --max-samples-per-bin must be positive")
+        raise SystemExit
+    if clargs.vertex_moves < 0. or clargs.patch_moves < 0. or clargs.vertex_moves + clargs.patch_moves >= 1. \
+       or clargs.max_patch < 2:
+        print("ERROR: --vertex-moves and --patch-moves must not be negative, and their sum must be below 1; " \
+              "--max-patch must be at least 2")
+        raise SystemExit
+    structures = find_structures(clargs.structures)
+    if len(structures) == 0:
+        print("ERROR: no structure files found")
+        raise SystemExit
+    names = [structure_name(structure) for structure in structures]
+    if len(set(names)) != len(names):
+        print("ERROR: the output directories of the structures are not distinct")
+        raise SystemExit
+
+    options = vars(clargs)
+    tasks = [(structure, os.path.join(clargs.output_dir, name), clargs.stages, options, clargs.threads, clargs.force) \
+             for structure, name in zip(structures, names)]
+    print("Running %s for %d structure(s) on %d worker(s)." % (' '.join(clargs.stages), len(tasks), clargs.workers))
+    if clargs.workers == 1 or len(tasks) == 1:
+        results = [run_pipeline(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=clargs.workers) as executor:
+            results = list(executor.map(run_pipeline, tasks))
+
+    failed = [(name, error) for name, summary, error in results if error != None]
+    for name, error in failed:
+        print("ERROR: %s failed:\n%s" % (name, error))
+    print("Finished %d structure(s); %d failed." % (len(results), len(failed)))
+    if len(failed) > 0:
+        raise SystemExit(1)
@@ -19,10 +19,23 @@
 
 #include "random.h"
 
-gsl_rng * rng;
+static unsigned long long splitmix64 (unsigned long long x)
+{
+  x += 0x9E3779B97F4A7C15ULL;
+  x = (x ^ (x >> 30)) * 0xBF58476D1CE4E5B9ULL;
+  x = (x ^ (x >> 27)) * 0x94D049BB133111EBULL;
+  return x ^ (x >> 31);
+}
+
+gsl_rng * random_alloc (unsigned long seed, unsigned long stream)
+{
+  gsl_rng * rng = gsl_rng_alloc (gsl_rng_default);
+  if (rng == NULL) return NULL;
+  gsl_rng_set (rng, (unsigned long) splitmix64 (splitmix64 (seed) ^ stream));
+  return rng;
+}
 
-void random_init ()
+void random_free (gsl_rng * rng)
 {
-  rng = gsl_rng_alloc (gsl_rng_default);
-  gsl_rng_set (rng, gsl_rng_default_seed);
+  if (rng) gsl_rng_free (rng);
 }
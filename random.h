@@ -3,9 +3,13 @@
 
 #include <gsl/gsl_rng.h>
 
-extern gsl_rng * rng;
-#define random_uniform() (gsl_rng_uniform (rng))
+/* Each sampler owns its own generator, so that independent chains can
+ * run concurrently.  A generator is identified by a seed and a stream
+ * index; distinct streams with the same seed are seeded independently. */
 
-void random_init ();
+#define random_uniform(rng) (gsl_rng_uniform (rng))
+
+gsl_rng * random_alloc (unsigned long seed, unsigned long stream);
+void random_free (gsl_rng * rng);
 
 #endif /* __RANDOM_H__ */
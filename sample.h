@@ -18,12 +18,23 @@
 #ifndef __SAMPLE_H__
 #define __SAMPLE_H__
 
+#include <stdio.h>
 #include <stdlib.h>
+#include <stddef.h>
+#include <stdint.h>
 #include "graph.h"
+#include "random.h"
+
+/* Histogram over (E, V).  The entry for (E, V) is stored at
+ * data[offsets[E] + (E + 1) - V], so that both a dense array with
+ * rows E and columns E - V + 1 (offsets[E] = E * row_length) and a
+ * banded array, which stores only the columns that can be reached in
+ * each row, can be described.  size is the number of stored entries. */
 
 typedef struct
 {
-  size_t max_x, max_y;
+  size_t size;
+  ptrdiff_t * offsets;
   double * data;
 }
 histogramEV_t;
@@ -31,17 +42,183 @@ histogramEV_t;
 histogramEV_t * histogramEV_alloc (const graph_t * graph);
 void histogramEV_free (histogramEV_t * h);
 void histogramEV_fill (histogramEV_t * h, double z);
+int histogramEV_flat (const histogramEV_t * visits, double flatness);
+void histogramEV_tare (histogramEV_t * h);
+
+#define histogramEV_index(h, E, V) ((h)->offsets[E] + ((E) + 1) - (V))
+#define histogramEV_get(h, E, V) ((h)->data[histogramEV_index (h, E, V)])
+#define histogramEV_set(h, E, V, z) do {(h)->data[histogramEV_index (h, E, V)] = z;} while (0)
+#define histogramEV_inc(h, E, V, z) do {(h)->data[histogramEV_index (h, E, V)] += z;} while (0)
+
+/* Sparse histogram over (E, V, B), where B is the number of bridges,
+ * stored as an open-addressing hash table.  Each occupied slot holds
+ * key = 1 + B + (nedges + 1) * (V + (nvertices + 1) * E), where nedges
+ * and nvertices are those of the target graph; empty slots hold 0.
+ * histogramEVB_inc returns -1 if the table cannot be enlarged. */
+
+typedef struct
+{
+  size_t nedges, nvertices;
+  size_t size, n;
+  size_t * keys;
+  double * counts;
+}
+histogramEVB_t;
+
+histogramEVB_t * histogramEVB_alloc (const graph_t * graph);
+void histogramEVB_free (histogramEVB_t * h);
+int histogramEVB_inc (histogramEVB_t * h, size_t E, size_t V, size_t B, double z);
+
+/* Running totals of a visits histogram, which the Wang--Landau
+ * samplers update as they fill it, so that its flatness can be checked
+ * without scanning the histogram.  flatness_init computes the totals of
+ * an existing histogram. */
+
+typedef struct
+{
+  unsigned long nvisited;
+  double sum, max;
+}
+flatness_t;
+
+void flatness_init (flatness_t * stats, const histogramEV_t * visits);
+int flatness_check (const flatness_t * stats, double flatness);
+
+/* Mixture of Monte Carlo moves.  Each step is a vertex move with
+ * probability vertex, a patch move with probability patch, and
+ * otherwise a single-edge move, which adds a random adjacent edge or
+ * removes a random removable edge.  A vertex move adds a vertex of the
+ * target with all of its edges to the subgraph, or removes a vertex of
+ * the subgraph with all of its edges.  A patch move adds (or removes) k
+ * edges one after another, each chosen at random from the adjacent (or
+ * removable) edges of the subgraph as it grows (or shrinks), with k
+ * drawn uniformly from 2 to max_patch.  All of the moves satisfy
+ * detailed balance.  The samplers make single-edge moves only if they
+ * are passed a NULL move_set_t. */
+
+typedef struct
+{
+  double vertex, patch;
+  size_t max_patch;
+}
+move_set_t;
+
+/* Optional counters of the Monte Carlo moves, which the samplers
+ * update if they are passed a non-NULL sampler_stats_t.  Moves are
+ * indexed by MOVE_ADD and MOVE_REMOVE (single-edge moves),
+ * MOVE_ADD_VERTEX and MOVE_REMOVE_VERTEX (vertex moves), and MOVE_GROW
+ * and MOVE_SHRINK (patch moves); a move is counted as proposed when the
+ * edge, vertex or number of edges to add or remove has been chosen.  If
+ * they are not NULL, the histograms proposed and accepted count the
+ * moves made from each (E, V) bin.  If timing is nonzero, the time
+ * spent updating the bridges, removable and adjacent edges (including
+ * undoing rejected moves) is added to update_time, in seconds.  A
+ * tunnel is a passage between the lowest and highest allowed numbers
+ * of edges, in either direction (0: up, 1: down); tunnel_steps is the
+ * total number of steps that they took.  end (-1: lowest, 1: highest,
+ * 0: neither yet) and end_step record the last end reached, so that
+ * counting continues across calls.  Initialize with sampler_stats_init. */
+
+enum { MOVE_ADD = 0, MOVE_REMOVE = 1, MOVE_ADD_VERTEX = 2, MOVE_REMOVE_VERTEX = 3, MOVE_GROW = 4, MOVE_SHRINK = 5,
+       NMOVES = 6 };
+
+typedef struct
+{
+  unsigned long nsteps;
+  unsigned long nproposed[NMOVES], naccepted[NMOVES];
+  histogramEV_t * proposed[NMOVES];
+  histogramEV_t * accepted[NMOVES];
+  int timing;
+  double update_time;
+  unsigned long ntunnels[2], tunnel_steps[2];
+  int end;
+  unsigned long end_step;
+}
+sampler_stats_t;
+
+void sampler_stats_init (sampler_stats_t * stats);
 
-#define histogramEV_get(h, E, V) ((h)->data[((E) + 1) - (V) + (h)->max_y * (E)])
-#define histogramEV_set(h, E, V, z) do {(h)->data[((E) + 1) - (V) + (h)->max_y * (E)] = z;} while (0)
-#define histogramEV_inc(h, E, V, z) do {(h)->data[((E) + 1) - (V) + (h)->max_y * (E)] += z;} while (0)
+/* Stream of sampled subgraphs, appended to a file as fixed-size
+ * records: E, V, B and the number of adjacent edges as uint32 values,
+ * followed by the subgraph's edges as a bitset of nwords uint64 words,
+ * with edge i in bit i % 64 of word i / 64 and the edges numbered as
+ * for energies below.  Values are stored in native byte order, and the
+ * file header, if any, is left to the caller (see samples.py).
+ * sample_file_write returns -1 on a write error; sample_file_close
+ * returns -1 if any write has failed.  nrecords counts the records
+ * written so far. */
+
+typedef struct
+{
+  FILE * stream;
+  size_t nwords;
+  uint64_t * record;
+  unsigned long nrecords;
+  int error;
+}
+sample_file_t;
+
+sample_file_t * sample_file_open (const graph_t * graph, const char * path);
+int sample_file_write (sample_file_t * file, const graph_t * graph, const graph_t * subgraph, \
+		       const unsigned long * in_subgraph);
+int sample_file_close (sample_file_t * file);
+
+/* If incremental is nonzero, the bridges, removable and adjacent edges
+ * of the subgraph are updated locally after each move (see dynamic.h);
+ * otherwise, they are recomputed from scratch.  moves, which may be
+ * NULL, sets the mixture of moves (see move_set_t).  All random numbers
+ * are drawn from rng, which is owned by the caller. */
 
 void wl_simulate_subgraphs_EV (const graph_t * graph, graph_t * subgraph, histogramEV_t * lnhEV, \
-			       double f_start, double f_target, double flatness, unsigned long ncheck);
+			       double f_start, double f_target, double flatness, unsigned long ncheck, \
+			       int incremental, gsl_rng * rng);
 void wl_sample_subgraphs_EV (const graph_t * graph, graph_t * subgraph, histogramEV_t * lnhEV, \
-			     double f, double flatness, unsigned long ncheck);
+			     double f, double flatness, unsigned long ncheck, int incremental, gsl_rng * rng);
+
+/* A fixed number of Wang--Landau updates, restricted to subgraphs with
+ * Emin <= E <= Emax, for use with windowed (replica-exchange) sampling.
+ * The subgraph must already lie within the window; see mc_enter_window_EV.
+ * The running totals in stats must match visits on entry.  The move
+ * counters in sampler_stats, if it is not NULL, are updated as well. */
+void wl_step_subgraphs_EV (const graph_t * graph, graph_t * subgraph, histogramEV_t * lnhEV, histogramEV_t * visits, \
+			   flatness_t * stats, double f, size_t Emin, size_t Emax, unsigned long nsteps, \
+			   int incremental, const move_set_t * moves, gsl_rng * rng, sampler_stats_t * sampler_stats);
 
 void mc_sample_subgraphs_EV (const graph_t * graph, graph_t * subgraph, const histogramEV_t * lnhEV, \
-			     unsigned long nsteps);
+			     unsigned long nsteps, int incremental, const move_set_t * moves, gsl_rng * rng, \
+			     sampler_stats_t * sampler_stats);
+/* Collect nsamples samples, nsteps apart, accumulating the number of
+ * visits, the sum of qdih^(1 + B - V), the number of samples with each
+ * number of bridges B, the sum of the number of adjacent edges and, for
+ * each of the nenergies rows of energies, the sum of the Boltzmann
+ * factors of the subgraph's edges.  Any of the output histograms may be
+ * NULL, and the outputs need not share the
+ * layout of lnhEV.  energies holds the nenergies values for each target
+ * edge in turn, with the edges ordered by their first vertex and then
+ * by their second vertex.  energy_sums holds nenergies values for each
+ * bin of visits, which is required if nenergies > 0.  If samples is
+ * not NULL, every sample is also appended to it.  If trace_bins is not
+ * NULL, the index in visits of the bin of each sample, and its number of
+ * adjacent edges, are stored in trace_bins and trace, which hold nsamples
+ * values each, so that the autocorrelation of the samples can be
+ * estimated. */
+void mc_collect_subgraphs_EV (const graph_t * graph, graph_t * subgraph, const histogramEV_t * lnhEV, \
+			      unsigned long nsteps, unsigned long nsamples, int incremental, const move_set_t * moves, \
+			      gsl_rng * rng, double qdih, histogramEV_t * visits, histogramEV_t * dihedrals, \
+			      histogramEVB_t * bridges, histogramEV_t * adjacents, size_t nenergies, \
+			      const double * energies, double * energy_sums, sample_file_t * samples, \
+			      ptrdiff_t * trace_bins, double * trace, sampler_stats_t * sampler_stats);
+void mc_enter_window_EV (const graph_t * graph, graph_t * subgraph, size_t Emin, size_t Emax, int incremental, \
+			 gsl_rng * rng);
+
+/* Exact enumeration of the connected subgraphs whose lowest-numbered
+ * edge is root, with the edges numbered as for energies above.  For
+ * each subgraph, counts[(E * (N + 1) + V) * (M + 1) + B] is incremented
+ * and the number of adjacent edges is added to adjacents[E * (N + 1) + V],
+ * where M and N are the numbers of edges and vertices of the graph and B
+ * is the number of bridges.  Enumerating every root in turn counts every
+ * connected subgraph once.  Returns -1 if the graph has more than 64
+ * edges or vertices. */
+int enumerate_subgraphs_EV (const graph_t * graph, size_t root, double * counts, double * adjacents);
 
 #endif /* __SAMPLE_H__ */
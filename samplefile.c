@@ -0,0 +1,98 @@
+/* Copyright (C) 2014 William M. Jacobs
+ * 
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; either version 3 of the License, or (at
+ * your option) any later version.
+ * 
+ * This program is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * General Public License for more details.
+ * 
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+ */
+
+#include "config.h"
+
+#include <string.h>
+#include "sample.h"
+#include "dynamic.h"
+
+#define RECORD_HEADER_WORDS 2	/* E, V, B and nadjacents as uint32 */
+
+sample_file_t * sample_file_open (const graph_t * graph, const char * path)
+{
+  sample_file_t * file = (sample_file_t *) calloc (1, sizeof (sample_file_t));
+  if (file == NULL) goto fail;
+  file->nwords = (graph->nedges + 63) / 64;
+  file->record = (uint64_t *) malloc (sizeof (uint64_t) * (RECORD_HEADER_WORDS + file->nwords));
+  if (file->record == NULL) goto fail;
+  file->stream = fopen (path, "ab");
+  if (file->stream == NULL) goto fail;
+  return file;
+ fail:
+  if (file != NULL)
+    {
+      if (file->record) free (file->record);
+      free (file);
+    }
+  return NULL;
+}
+
+int sample_file_write (sample_file_t * file, const graph_t * graph, const graph_t * subgraph, \
+		       const unsigned long * in_subgraph)
+{
+  size_t i, j, s, eid = 0;
+  uint32_t counts[4];
+  uint64_t * words = file->record + RECORD_HEADER_WORDS;
+
+  counts[0] = (uint32_t) subgraph->nedges;
+  counts[1] = (uint32_t) subgraph->nvertices;
+  counts[2] = (uint32_t) subgraph->nbridges;
+  counts[3] = (uint32_t) subgraph->nadjacents;
+  memcpy (file->record, counts, sizeof (counts));
+  memset (words, 0, sizeof (uint64_t) * file->nwords);
+
+  /* The incremental engine keeps the same bitset in words of
+   * DYNAMIC_WORD_BITS (which divides 64) bits; otherwise, the
+   * subgraph's edges are matched against the target's row by row, as
+   * in accumulate_energies. */
+  for (eid = 0; in_subgraph != NULL && eid < graph->nedges; eid += DYNAMIC_WORD_BITS)
+    {
+      words[eid / 64] |= (uint64_t) in_subgraph[eid / DYNAMIC_WORD_BITS] << (eid % 64);
+    }
+  for (i = 0, eid = 0; in_subgraph == NULL && i < graph->max_nvertices; i++)
+    {
+      for (j = 0, s = 0; j < graph->nvedges[i]; j++)
+	{
+	  if (graph->edges[i][j] < i) continue;
+	  while (s < subgraph->nvedges[i] && subgraph->edges[i][s] < graph->edges[i][j]) s++;
+	  if (s < subgraph->nvedges[i] && subgraph->edges[i][s] == graph->edges[i][j])
+	    words[eid / 64] |= (uint64_t) 1 << (eid % 64);
+	  eid++;
+	}
+    }
+
+  if (fwrite (file->record, sizeof (uint64_t), RECORD_HEADER_WORDS + file->nwords, file->stream) \
+      != RECORD_HEADER_WORDS + file->nwords)
+    {
+      file->error = 1;
+      return -1;
+    }
+  file->nrecords++;
+  return 0;
+}
+
+int sample_file_close (sample_file_t * file)
+{
+  int error;
+  if (file == NULL) return 0;
+  error = file->error;
+  if (fclose (file->stream) != 0) error = 1;
+  free (file->record);
+  free (file);
+  return error ? -1 : 0;
+}
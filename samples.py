@@ -0,0 +1,197 @@
+# Copyright (C) 2014 William M. Jacobs
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or (at
+# your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import hashlib, json, os, shutil, struct, sys
+import numpy as np
+from pygtsa.histogram import EVHistogram, EVLayout
+
+# Sample files hold the fragments collected by the Monte Carlo samplers (see the samples
+# argument of cgraph.mc_simulate_dihedrals_adjacents_EV and mc_simulate_energies_EV), so that
+# averages of other observables can be calculated later without sampling again.  As in binary
+# histogram files, a JSON header identifies the target structure; it is followed by one
+# fixed-size record per sample (see record_dtype), which holds the edges of the fragment as a
+# bitset in the edge order of cgraph.energy_matrix().  Records are only ever appended.
+SAMPLES_EXTENSION = '.samples'
+SAMPLES_MAGIC = b'PYGTSAFS'
+SAMPLES_ALIGN = 64
+
+# Default size of the unpacked edges of a chunk of records (see SampleReader.chunks).
+CHUNK_BYTES = 1 << 25
+
+def record_dtype(nedges, byteorder=sys.byteorder):
+    '''Structured dtype of a record: E, V, the number of bridges B and the number of adjacent edges,
+    followed by the edges, with edge i in bit i % 64 of word i // 64'''
+    order = '<' if byteorder == 'little' else '>'
+    return np.dtype([('E', order + 'u4'), ('V', order + 'u4'), ('B', order + 'u4'), ('nadjacents', order + 'u4'), \
+                     ('edges', order + 'u8', ((nedges + 63) // 64,))])
+
+def edges_digest(edges):
+    return hashlib.sha1(np.ascontiguousarray(edges, dtype='<u4').tobytes()).hexdigest()
+
+def _read_header(f, path):
+    if f.read(len(SAMPLES_MAGIC)) != SAMPLES_MAGIC:
+        raise Exception("%s is not a sample file" % path)
+    length, = struct.unpack('<I', f.read(4))
+    header = json.loads(f.read(length).decode('utf-8'))
+    return header, len(SAMPLES_MAGIC) + 4 + length
+
+def prepare_sample_file(path, edges, nvertices):
+    '''Create a sample file for a target structure, or check that an existing file belongs to it
+
+    edges are the edges of the target in the order of cgraph.energy_matrix().  Any incomplete
+    record at the end of an existing file, left by an interrupted run, is removed, so that new
+    records can be appended to it.'''
+    edges = np.asarray(edges, dtype=np.uint32).reshape(-1, 2)
+    header = {'record' : 'E, V, B, nadjacents, edges', 'byteorder' : sys.byteorder, 'nedges' : len(edges), \
+              'nvertices' : int(nvertices), 'edges' : edges_digest(edges)}
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        with open(path, 'rb') as f:
+            existing, offset = _read_header(f, path)
+        if existing != header:
+            raise Exception("%s was recorded for a different structure" % path)
+        size = os.path.getsize(path)
+        os.truncate(path, size - (size - offset) % record_dtype(len(edges)).itemsize)
+        return
+    encoded = json.dumps(header).encode('utf-8')
+    offset = len(SAMPLES_MAGIC) + 4 + len(encoded)
+    encoded += b' ' * (-offset % SAMPLES_ALIGN)
+    with open(path, 'wb') as f:
+        f.write(SAMPLES_MAGIC)
+        f.write(struct.pack('<I', len(encoded)))
+        f.write(encoded)
+
+def append_sample_file(path, part):
+    '''Append the records of part, a file without a header written by a single chain, to path and remove part'''
+    with open(path, 'ab') as f, open(part, 'rb') as g:
+        shutil.copyfileobj(g, f)
+    os.remove(part)
+
+def _evhistogram(h, layout):
+    hist = EVHistogram(None)
+    hist.h, hist.layout = h, (layout if layout.banded() else None)
+    return hist
+
+class SampleReader(object):
+    '''Reader for the fragments stored in a sample file
+
+    chunks() reads the records in chunks, as structured arrays of record_dtype, and
+    unpack_edges() converts the edges of a chunk to a boolean array with one column per edge.
+    histogram() and average() sum and average an observable over the samples in each (E, V)
+    bin.  Since the samples are drawn with equal weight in every (E, V) bin, these averages
+    are those that the samplers would have calculated.'''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.header, self.offset = _read_header(f, path)
+        self.nedges, self.nvertices = self.header['nedges'], self.header['nvertices']
+        self.dtype = record_dtype(self.nedges, self.header['byteorder'])
+        self.nsamples = (os.path.getsize(path) - self.offset) // self.dtype.itemsize
+
+    def check(self, edges):
+        '''Raise an exception unless the samples were recorded for a target with these edges (see prepare_sample_file)'''
+        if edges_digest(np.asarray(edges, dtype=np.uint32).reshape(-1, 2)) != self.header['edges']:
+            raise Exception("%s was recorded for a different structure" % self.path)
+
+    def layout(self):
+        '''Dense layout of the histograms of the target'''
+        return EVLayout(self.nedges + 1, self.nedges - self.nvertices + 2, self.nvertices)
+
+    def chunks(self, chunksize=None):
+        '''Iterate over the records in chunks of chunksize records
+
+        By default, a chunk is small enough that its unpacked edges take about CHUNK_BYTES.'''
+        if chunksize == None:
+            chunksize = max(1, CHUNK_BYTES // max(1, self.nedges))
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset, 0)
+            for start in range(0, self.nsamples, chunksize):
+                yield np.fromfile(f, dtype=self.dtype, count=min(chunksize, self.nsamples - start))
+
+    def unpack_edges(self, records):
+        '''nrecords x nedges boolean array of the edges in each record'''
+        words = np.ascontiguousarray(records['edges'], dtype='<u8').reshape(len(records), -1)
+        bits = np.unpackbits(words.view(np.uint8), axis=1, bitorder='little')
+        return bits[:,:self.nedges].view(bool)
+
+    def histogram(self, observable, layout=None, chunksize=None):
+        '''Sum observable(records) over the samples in each (E, V) bin
+
+        observable is called with each chunk of records and returns an array with one row per
+        record.  Returns the sums, with the shape of the layout (by default, the dense layout
+        of the target) followed by the shape of a row, and the number of samples in each bin.'''
+        if layout == None:
+            layout = self.layout()
+        nbins = int(np.prod(layout.shape))
+        visits = np.zeros(nbins, dtype=int)
+        sums = None
+        for records in self.chunks(chunksize):
+            index = layout.flat_index(records['E'].astype(int), records['V'].astype(int))
+            visits += np.bincount(index, minlength=nbins)
+            values = np.asarray(observable(records), dtype=float)
+            if sums is None:
+                sums = np.zeros((nbins,) + values.shape[1:])
+            columns = values.reshape(len(records), -1)
+            for k in range(columns.shape[1]):
+                sums.reshape(nbins, -1)[:,k] += np.bincount(index, weights=columns[:,k], minlength=nbins)
+        if sums is None:
+            values = np.asarray(observable(np.zeros(0, dtype=self.dtype)), dtype=float)
+            sums = np.zeros((nbins,) + values.shape[1:])
+        return sums.reshape(layout.shape + sums.shape[1:]), visits.reshape(layout.shape)
+
+    def average(self, observable, layout=None, chunksize=None):
+        '''Average observable(records) over the samples in each (E, V) bin; see histogram()
+
+        Bins without samples are set to -1.  Returns the averages and the number of samples.'''
+        sums, visits = self.histogram(observable, layout=layout, chunksize=chunksize)
+        sampled = visits > 0
+        sums[sampled] /= visits[sampled].reshape((-1,) + (1,) * (sums.ndim - visits.ndim))
+        sums[~sampled] = -1.
+        return sums, visits
+
+    def dihedrals_adjacents(self, qdih, layout=None, chunksize=None):
+        '''The histograms of cgraph.mc_simulate_dihedrals_adjacents_EV: the average dihedral entropy
+        loss, the average number of adjacent edges and the number of samples in each (E, V) bin'''
+        if layout == None:
+            layout = self.layout()
+        qdih = float(qdih)
+        observable = lambda records: np.stack((qdih**(1. + records['B'].astype(float) - records['V']), \
+                                               records['nadjacents']), axis=1)
+        sums, visits = self.average(observable, layout=layout, chunksize=chunksize)
+        sampled = visits > 0
+        dihedrals = sums[...,0]
+        dihedrals[sampled] = -np.log(dihedrals[sampled])
+        return _evhistogram(dihedrals, layout), _evhistogram(sums[...,1].copy(), layout), \
+            _evhistogram(visits, layout)
+
+    def mean_energies(self, energies, layout=None, chunksize=None):
+        '''The histograms of cgraph.mc_simulate_energies_EV: the average bond energy of the samples in each
+        (E, V) bin for K independent realizations of the bond energies, and the number of samples
+
+        energies is a K x nedges array in the edge order of cgraph.energy_matrix().'''
+        if layout == None:
+            layout = self.layout()
+        energies = np.asarray(energies, dtype=float)
+        if energies.ndim != 2 or energies.shape[1] != self.nedges:
+            raise ValueError("expected energies for %d edges" % self.nedges)
+        energy_means = energies.mean(axis=1)
+        energy_diffs = np.ascontiguousarray((energies - energy_means[:,None]).T)
+        observable = lambda records: np.exp(self.unpack_edges(records) @ energy_diffs)
+        sums, visits = self.histogram(observable, layout=layout, chunksize=chunksize)
+        means = np.full(layout.shape, -1.)
+        sampled = visits > 0
+        means[sampled] = (np.log(sums[sampled] / visits[sampled][:,None]) / layout.E[sampled][:,None] \
+                          + energy_means[None,:]).mean(axis=1)
+        return _evhistogram(means, layout), _evhistogram(visits, layout)
@@ -14,14 +14,44 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
-import argparse
+import argparse, hashlib, itertools, os
+import numpy as np
 import networkx as nx
 import pygtsa.cgraph as cgraph
+from pygtsa.cache import default_cache_dir
+
+# Parsed edge lists are cached in the structures subdirectory of the cache
+# directory, in a NumPy .npz file named by a digest of the absolute path of the
+# structure file, which records the size and modification time of the source.
+CACHE_EXTENSION = '.npz'
+STRUCTURE_CACHE = 'structures'
+
+def structure_cache_path(path, cache_dir=None):
+    '''Path of the cached parsed structure for the structure file path'''
+    digest = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir if cache_dir != None else default_cache_dir(), STRUCTURE_CACHE, \
+                        digest + CACHE_EXTENSION)
 
 class Assembly(nx.Graph):
     def __init__(self, list_of_edges):
         super().__init__(list_of_edges)
 
+    @staticmethod
+    def from_edge_array(edges, nvertices=None):
+        '''Build an assembly from an (nedges, 2) array of vertex ids 0, ..., nvertices - 1'''
+        edges = np.asarray(edges, dtype=np.uint32).reshape(-1, 2)
+        if nvertices == None:
+            nvertices = int(edges.max()) + 1 if edges.size > 0 else 0
+        assembly = Assembly([])
+        assembly.add_nodes_from(range(nvertices))
+        assembly.add_edges_from(edges.tolist())
+        return assembly
+
+    def edge_array(self):
+        '''Return the edges as an (nedges, 2) array of vertex ids'''
+        return np.fromiter(itertools.chain.from_iterable(self.edges()), dtype=np.uint32, \
+                           count=2 * self.number_of_edges()).reshape(-1, 2)
+
     @staticmethod
     def sorted_edge(edge):
         return tuple(sorted(edge))
@@ -61,20 +91,46 @@ class Assembly(nx.Graph):
         for edge in self.edges():
             stream.write("%d %d\n" % edge)
 
+    @staticmethod
+    def parse_edges(stream):
+        '''Parse an edge list into an (nedges, 2) array of vertex ids
+
+        Vertices are numbered in order of first appearance, and repeated edges are dropped.'''
+        labels = [t[:2] for t in (line.split() for line in stream if line[0] != '#') if len(t) > 0]
+        if len(labels) == 0:
+            return np.zeros((0, 2), dtype=np.uint32)
+        for t in labels:
+            if len(t) < 2:
+                raise TypeError("ERROR: cannot interpret line in input structure file: %s" % ' '.join(t))
+        names, first, inverse = np.unique(np.array(labels), return_index=True, return_inverse=True)
+        ids = np.empty(len(names), dtype=np.uint32)
+        ids[np.argsort(first, kind='stable')] = np.arange(len(names), dtype=np.uint32)
+        edges = ids[inverse.reshape(-1)].reshape(-1, 2)
+        keys = np.minimum(edges[:,0], edges[:,1]).astype(np.uint64) * len(names) + np.maximum(edges[:,0], edges[:,1])
+        return edges[np.sort(np.unique(keys, return_index=True)[1])]
+
     @staticmethod
     def read_edges(stream):
-        G = nx.Graph()
-        for line in stream:
-            if line[0] == '#':
-                continue
-            t = line.split()
-            if len(t) == 0:
-                continue
-            try:
-                G.add_edge(t[0], t[1])
-            except (KeyError, TypeError):
-                raise TypeError("ERROR: cannot interpret line in input structure file:%d" % line)
-        return Assembly(nx.convert_node_labels_to_integers(G).edges())
+        return Assembly.from_edge_array(Assembly.parse_edges(stream))
+
+    def write_binary(self, path, source=None):
+        '''Write the edge array to an .npz file, recording the size and modification time of source'''
+        stat = os.stat(source) if source != None else None
+        tmp = '%s.tmp%d' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez(f, edges=self.edge_array(), nvertices=self.number_of_nodes(), \
+                     source=np.array([stat.st_size, stat.st_mtime_ns] if stat != None else [-1, -1], dtype=np.int64))
+        os.replace(tmp, path)
+
+    @staticmethod
+    def read_binary(path, source=None):
+        '''Read an assembly written by write_binary; if source is given, return None if the file is out of date'''
+        with np.load(path) as data:
+            if source != None:
+                stat = os.stat(source)
+                if list(data['source']) != [stat.st_size, stat.st_mtime_ns]:
+                    return None
+            return Assembly.from_edge_array(data['edges'], int(data['nvertices']))
 
     def write_dot(self, stream, circsize=0.6, edgelength=1., fontface='Arial', fillcolor='#cccccc'):
         stream.write("graph G {\n")
@@ -90,10 +146,32 @@ class Assembly(nx.Graph):
         return Assembly(nx.convert_node_labels_to_integers(nx.Graph(nx.read_dot(path))))
 
     @staticmethod
-    def read(path):
+    def read(path, cache=True, cache_dir=None):
+        '''Read a structure file: an edge list, a DOT file, or a binary file written by write_binary
+
+        If cache is True, a parsed edge list is stored in cache_dir (by default, the directory
+        of the result cache), and later calls read the cache instead of parsing the file again,
+        as long as it is unchanged.  Nothing is written next to the structure file.'''
+        if path.endswith(CACHE_EXTENSION):
+            return Assembly.read_binary(path)
+        cache_path = structure_cache_path(path, cache_dir)
+        if cache and os.path.exists(cache_path):
+            try:
+                assembly = Assembly.read_binary(cache_path, source=path)
+                if assembly != None:
+                    return assembly
+            except (OSError, KeyError, ValueError):
+                pass
         try:
             with open(path, 'r') as f:
-                return Assembly.read_edges(f)
+                assembly = Assembly.read_edges(f)
+            if cache:
+                try:
+                    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                    assembly.write_binary(cache_path, source=path)
+                except OSError:
+                    pass
+            return assembly
         except TypeError:
             pass
         try:
@@ -103,7 +181,10 @@ class Assembly(nx.Graph):
         raise TypeError("could not interpret assembly file %s" % path)
 
     def enumerate_subgraphs(self, Emax=None, verbose=False):
-        '''Find all connected subgraphs (with E <= Emax) of the assembly by direct enumeration'''
+        '''Find all connected subgraphs (with E <= Emax) of the assembly by direct enumeration
+
+        All of the subgraphs are held in memory, so this is only practical for small
+        assemblies.  To count the subgraphs, use cgraph.enumerate_EV instead.'''
         subgraphs = {1 : set((edge,) for edge in self.edges())}
         if Emax == None:
             Emax = self.number_of_edges()
@@ -127,6 +208,8 @@ if __name__ == '__main__':
     parser.add_argument('structure', type=str, help="path to input structure file")
     parser.add_argument('--output-dot', metavar='PATH', type=str, default=False, help="output structure in the DOT format to PATH [False]")
     parser.add_argument('--output-edges', metavar='PATH', type=str, default=False, help="output structure edges to PATH [False]")
+    parser.add_argument('--output-binary', metavar='PATH', type=str, default=False, \
+                        help="output structure edges in the binary (%s) format to PATH [False]" % CACHE_EXTENSION)
     clargs = parser.parse_args()
 
     target = Assembly.read(clargs.structure)
@@ -141,3 +224,6 @@ if __name__ == '__main__':
         print("Writing edges to %s" % clargs.output_edges)
         with open(clargs.output_edges, 'w') as f:
             target.write_edges(f)
+    if clargs.output_binary:
+        print("Writing binary structure to %s" % clargs.output_binary)
+        target.write_binary(clargs.output_binary)
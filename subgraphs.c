@@ -17,251 +17,682 @@
 
 #include "config.h"
 
+#include <stdio.h>
 #include <math.h>
 #include <float.h>
+#include <string.h>
+#include <time.h>
 #include "sample.h"
+#include "dynamic.h"
 #include "random.h"
 
-#define INIT_ADJACENTS_REMOVABLE_SWAP					\
-  size_t nremovable_old, nadjacents_old;				\
-  size_t nremovable_tmp, nadjacents_tmp;				\
-  edge_t * removable_old = (edge_t *)					\
-    malloc (sizeof (edge_t) * graph->max_nedges);			\
-  if (removable_old == NULL) goto fail;					\
-  edge_t * removable_tmp;						\
-  edge_t * adjacents_old = (edge_t *)					\
-    malloc (sizeof (edge_t) * graph->max_nedges);			\
-  if (adjacents_old == NULL) goto fail;					\
-  edge_t * adjacents_tmp;
-
-#define swap_adjacents_removable()		\
-  do {						\
-    nadjacents_tmp = nadjacents_old;		\
-    nadjacents_old = subgraph->nadjacents;	\
-    subgraph->nadjacents = nadjacents_tmp;	\
-    adjacents_tmp = adjacents_old;		\
-    adjacents_old = subgraph->adjacents;	\
-    subgraph->adjacents = adjacents_tmp;	\
-    nremovable_tmp = nremovable_old;		\
-    nremovable_old = subgraph->nremovable;	\
-    subgraph->nremovable = nremovable_tmp;	\
-    removable_tmp = removable_old;		\
-    removable_old = subgraph->removable;	\
-    subgraph->removable = removable_tmp;	\
-  } while (0)
-
-void wl_sample_subgraphs_EV (const graph_t * graph, graph_t * subgraph, histogramEV_t * lnhEV, double f, double flatness, unsigned long ncheck)
+/* Workspace for Monte Carlo moves.  With the full engine, the bridges
+ * and adjacents of the subgraph are recomputed after every proposed
+ * move, and the previous removable and adjacents lists are kept so that
+ * a rejected move can be undone by swapping them back.  With the
+ * incremental engine, these lists are updated locally instead.  The
+ * edges added or removed by a vertex or patch move are kept in moved,
+ * so that the move can be undone edge by edge. */
+
+typedef struct
+{
+  size_t nremovable_old, nadjacents_old;
+  edge_t * removable_old;
+  edge_t * adjacents_old;
+  dynamic_t * dynamic;
+  const move_set_t * moves;
+  edge_t * moved;
+}
+workspace_t;
+
+static void workspace_free (workspace_t * work)
+{
+  if (work)
+    {
+      if (work->removable_old) free (work->removable_old);
+      if (work->adjacents_old) free (work->adjacents_old);
+      if (work->dynamic) dynamic_free (work->dynamic);
+      if (work->moved) free (work->moved);
+      free (work);
+    }
+}
+
+static workspace_t * workspace_alloc (const graph_t * graph, graph_t * subgraph, int incremental, \
+				       const move_set_t * moves)
+{
+  size_t i, nmoved;
+  workspace_t * work = (workspace_t *) calloc (1, sizeof (workspace_t));
+  if (work == NULL) goto fail;
+  if (moves && moves->vertex + moves->patch > 0.)
+    {
+      /* Room for the edges of any vertex, or of the largest patch */
+      for (i = 0, nmoved = moves->max_patch; i < graph->max_nvertices; i++)
+	{
+	  if (graph->nvedges[i] > nmoved) nmoved = graph->nvedges[i];
+	}
+      work->moved = (edge_t *) malloc (sizeof (edge_t) * nmoved);
+      if (work->moved == NULL) goto fail;
+      work->moves = moves;
+    }
+  if (incremental)
+    {
+      work->dynamic = dynamic_alloc (graph);
+      if (work->dynamic == NULL) goto fail;
+      dynamic_init (work->dynamic, graph, subgraph);
+    }
+  else
+    {
+      work->removable_old = (edge_t *) malloc (sizeof (edge_t) * graph->max_nedges);
+      if (work->removable_old == NULL) goto fail;
+      work->adjacents_old = (edge_t *) malloc (sizeof (edge_t) * graph->max_nedges);
+      if (work->adjacents_old == NULL) goto fail;
+      graph_find_bridges (subgraph);
+      graph_find_adjacents (graph, subgraph);
+    }
+  return work;
+
+ fail:
+  workspace_free (work);
+  return NULL;
+}
+
+static void swap_adjacents_removable (workspace_t * work, graph_t * subgraph)
+{
+  size_t ntmp;
+  edge_t * tmp;
+
+  ntmp = work->nadjacents_old;
+  work->nadjacents_old = subgraph->nadjacents;
+  subgraph->nadjacents = ntmp;
+  tmp = work->adjacents_old;
+  work->adjacents_old = subgraph->adjacents;
+  subgraph->adjacents = tmp;
+  ntmp = work->nremovable_old;
+  work->nremovable_old = subgraph->nremovable;
+  subgraph->nremovable = ntmp;
+  tmp = work->removable_old;
+  work->removable_old = subgraph->removable;
+  subgraph->removable = tmp;
+}
+
+static void workspace_finish (workspace_t * work, graph_t * subgraph)
+{
+  /* After a rejected move, the full engine leaves the bridges of the
+   * proposed subgraph behind. */
+  if (work->dynamic == NULL) graph_find_bridges (subgraph);
+}
+
+static void apply_add_edge (workspace_t * work, const graph_t * graph, graph_t * subgraph, const edge_t edge)
+{
+  if (work->dynamic)
+    {
+      dynamic_add_edge (work->dynamic, graph, subgraph, edge.v1, edge.v2);
+    }
+  else
+    {
+      graph_add_edge (subgraph, edge.v1, edge.v2);
+      swap_adjacents_removable (work, subgraph);
+      graph_find_bridges (subgraph);
+      graph_find_adjacents (graph, subgraph);
+    }
+}
+
+static void apply_remove_edge (workspace_t * work, const graph_t * graph, graph_t * subgraph, const edge_t edge)
+{
+  if (work->dynamic)
+    {
+      dynamic_remove_edge (work->dynamic, graph, subgraph, edge.v1, edge.v2);
+    }
+  else
+    {
+      graph_remove_edge (subgraph, edge.v1, edge.v2);
+      swap_adjacents_removable (work, subgraph);
+      graph_find_bridges (subgraph);
+      graph_find_adjacents (graph, subgraph);
+    }
+}
+
+static void undo_add_edge (workspace_t * work, const graph_t * graph, graph_t * subgraph, const edge_t edge)
+{
+  if (work->dynamic)
+    {
+      dynamic_undo_add_edge (work->dynamic, graph, subgraph, edge.v1, edge.v2);
+    }
+  else
+    {
+      graph_remove_edge (subgraph, edge.v1, edge.v2);
+      swap_adjacents_removable (work, subgraph);
+    }
+}
+
+static void undo_remove_edge (workspace_t * work, const graph_t * graph, graph_t * subgraph, const edge_t edge)
 {
-  const size_t max_x = lnhEV->max_x;
-  const size_t max_y = lnhEV->max_y;
+  if (work->dynamic)
+    {
+      dynamic_undo_remove_edge (work->dynamic, graph, subgraph, edge.v1, edge.v2);
+    }
+  else
+    {
+      graph_add_edge (subgraph, edge.v1, edge.v2);
+      swap_adjacents_removable (work, subgraph);
+    }
+}
 
-  unsigned long * visits = (unsigned long *) malloc (sizeof (unsigned long) * max_x * max_y);
-  if (visits == NULL) goto fail;
+void sampler_stats_init (sampler_stats_t * stats)
+{
+  memset (stats, 0, sizeof (sampler_stats_t));
+}
+
+static double monotonic_time (void)
+{
+  struct timespec ts;
+  clock_gettime (CLOCK_MONOTONIC, &ts);
+  return (double) ts.tv_sec + 1.e-9 * (double) ts.tv_nsec;
+}
+
+static void stats_propose (sampler_stats_t * stats, int move, size_t E, size_t V)
+{
+  stats->nproposed[move]++;
+  if (stats->proposed[move]) histogramEV_inc (stats->proposed[move], E, V, 1.);
+}
+
+static void stats_accept (sampler_stats_t * stats, int move, size_t E, size_t V)
+{
+  stats->naccepted[move]++;
+  if (stats->accepted[move]) histogramEV_inc (stats->accepted[move], E, V, 1.);
+}
+
+static void stats_step (sampler_stats_t * stats, size_t E, size_t Emin, size_t Emax)
+{
+  stats->nsteps++;
+  if (E <= Emin && stats->end != -1)
+    {
+      if (stats->end == 1)
+	{
+	  stats->ntunnels[1]++;
+	  stats->tunnel_steps[1] += stats->nsteps - stats->end_step;
+	}
+      stats->end = -1;
+      stats->end_step = stats->nsteps;
+    }
+  else if (E >= Emax && stats->end != 1)
+    {
+      if (stats->end == -1)
+	{
+	  stats->ntunnels[0]++;
+	  stats->tunnel_steps[0] += stats->nsteps - stats->end_step;
+	}
+      stats->end = 1;
+      stats->end_step = stats->nsteps;
+    }
+}
+
+/* Accept a move with probability min(1, exp(arg)) */
+static int metropolis (double arg, gsl_rng * rng)
+{
+  return !(arg < 0. && random_uniform (rng) >= exp (arg));
+}
+
+/* Undo a vertex or patch move by removing (or adding back) the first
+ * nmoved edges in work->moved, in reverse order. */
+static void revert_moved (workspace_t * work, const graph_t * graph, graph_t * subgraph, size_t nmoved, int added)
+{
+  while (nmoved > 0)
+    {
+      nmoved--;
+      if (added)
+	apply_remove_edge (work, graph, subgraph, work->moved[nmoved]);
+      else
+	apply_add_edge (work, graph, subgraph, work->moved[nmoved]);
+    }
+}
+
+static int is_removable (const workspace_t * work, const graph_t * graph, const graph_t * subgraph, const edge_t edge)
+{
   size_t i;
-  for (i = 0; i < max_x * max_y; i++)
+  if (work->dynamic)
+    return work->dynamic->pos_removable[dynamic_eid (work->dynamic, graph, edge.v1, edge.v2)] != DYNAMIC_NONE;
+  for (i = 0; i < subgraph->nremovable; i++)
     {
-      visits[i] = 0;
+      if ((subgraph->removable[i].v1 == edge.v1 && subgraph->removable[i].v2 == edge.v2) || \
+	  (subgraph->removable[i].v1 == edge.v2 && subgraph->removable[i].v2 == edge.v1))
+	return 1;
     }
+  return 0;
+}
+
+/* Attempt a single edge addition or removal. */
+static void edge_step (const graph_t * graph, graph_t * subgraph, const histogramEV_t * lnhEV, \
+		       size_t Emin, size_t Emax, workspace_t * work, gsl_rng * rng, sampler_stats_t * stats)
+{
+  edge_t edge;
+  size_t edge_index, nproposals_old;
+  const size_t nedges_old = subgraph->nedges;
+  const size_t nvertices_old = subgraph->nvertices;
+  const int timing = (stats != NULL && stats->timing);
+  double arg, t = 0.;
 
-  INIT_ADJACENTS_REMOVABLE_SWAP;
-  graph_find_bridges (subgraph);
-  graph_find_adjacents (graph, subgraph);
+  if (random_uniform (rng) < 0.5)
+    { /* Attempt to add an edge. */
+      if (subgraph->nadjacents > 0 && nedges_old < Emax)
+	{
+	  edge_index = random_uniform (rng) * subgraph->nadjacents;
+	  set_edge (edge, subgraph->adjacents[edge_index].v1, subgraph->adjacents[edge_index].v2);
+	  nproposals_old = subgraph->nadjacents;
+	  if (stats) stats_propose (stats, MOVE_ADD, nedges_old, nvertices_old);
+	  if (timing) t = monotonic_time ();
+	  apply_add_edge (work, graph, subgraph, edge);
+	  if (timing) stats->update_time += monotonic_time () - t;
+	  arg = log ((double) nproposals_old / (double) subgraph->nremovable)
+	    + histogramEV_get (lnhEV, nedges_old, nvertices_old)
+	    - histogramEV_get (lnhEV, subgraph->nedges, subgraph->nvertices);
+	  if (!metropolis (arg, rng))
+	    { /* Reject move. */
+	      if (timing) t = monotonic_time ();
+	      undo_add_edge (work, graph, subgraph, edge);
+	      if (timing) stats->update_time += monotonic_time () - t;
+	    }
+	  else if (stats)
+	    {
+	      stats_accept (stats, MOVE_ADD, nedges_old, nvertices_old);
+	    }
+	}
+    }
+  else
+    { /* Attempt to remove an edge. */
+      if (subgraph->nremovable > 0 && nedges_old > Emin)
+	{
+	  edge_index = random_uniform (rng) * subgraph->nremovable;
+	  set_edge (edge, subgraph->removable[edge_index].v1, subgraph->removable[edge_index].v2);
+	  nproposals_old = subgraph->nremovable;
+	  if (stats) stats_propose (stats, MOVE_REMOVE, nedges_old, nvertices_old);
+	  if (timing) t = monotonic_time ();
+	  apply_remove_edge (work, graph, subgraph, edge);
+	  if (timing) stats->update_time += monotonic_time () - t;
+	  arg = log ((double) nproposals_old / (double) subgraph->nadjacents)
+	    + histogramEV_get (lnhEV, nedges_old, nvertices_old)
+	    - histogramEV_get (lnhEV, subgraph->nedges, subgraph->nvertices);
+	  if (!metropolis (arg, rng))
+	    { /* Reject move. */
+	      if (timing) t = monotonic_time ();
+	      undo_remove_edge (work, graph, subgraph, edge);
+	      if (timing) stats->update_time += monotonic_time () - t;
+	    }
+	  else if (stats)
+	    {
+	      stats_accept (stats, MOVE_REMOVE, nedges_old, nvertices_old);
+	    }
+	}
+    }
+}
 
+/* Attempt to add a vertex with all of its edges to the subgraph, or to
+ * remove a vertex with all of its edges.  The vertex to add is the far
+ * end of a random adjacent edge, and the vertex to remove is either end
+ * of a random removable edge, so that a vertex with d edges to the rest
+ * of the subgraph is proposed with probability d / nadjacents or
+ * d / (2 nremovable).  A removal is only possible if it is the reverse
+ * of an addition: every target edge from the vertex to the rest of the
+ * subgraph must be in the subgraph, and the rest of the subgraph must
+ * stay connected and keep all of its other vertices.  This is checked
+ * as the edges are removed, since each of them must then be removable,
+ * and must not leave its other end behind. */
+static void vertex_step (const graph_t * graph, graph_t * subgraph, const histogramEV_t * lnhEV, \
+			 size_t Emin, size_t Emax, workspace_t * work, gsl_rng * rng, sampler_stats_t * stats)
+{
   edge_t edge;
-  size_t edge_index, nedges_old, nvertices_old;
-  double arg;
+  vertex_t v, u;
+  size_t i, nmoved, nlinks, nproposals_old;
+  int accept;
+  const size_t nedges_old = subgraph->nedges;
+  const size_t nvertices_old = subgraph->nvertices;
+  const int timing = (stats != NULL && stats->timing);
+  double arg, t = 0.;
 
-  unsigned long step;
-  do {
-    for (step = 0; step < ncheck; step++)
-      {
-	nedges_old = subgraph->nedges;
-	nvertices_old = subgraph->nvertices;
-	if (random_uniform () < 0.5)
-	  { /* Attempt to add an edge. */
-	    if (subgraph->nadjacents > 0)
-	      {
-		edge_index = random_uniform () * subgraph->nadjacents;
-		set_edge (edge, subgraph->adjacents[edge_index].v1, subgraph->adjacents[edge_index].v2);
-		graph_add_edge (subgraph, edge.v1, edge.v2);
-		swap_adjacents_removable ();
-		graph_find_bridges (subgraph);
-		graph_find_adjacents (graph, subgraph);
-		arg = log ((double) nadjacents_old / (double) subgraph->nremovable)
-		  + histogramEV_get (lnhEV, nedges_old, nvertices_old)
-		  - histogramEV_get (lnhEV, subgraph->nedges, subgraph->nvertices);
-		if (arg < 0. && random_uniform () >= exp (arg))
-		  { /* Reject move. */
-		    /* printf ("reject add: %zu,%zu -> %zu,%zu [%g -> %g] %g\n", nedges_old, nvertices_old, subgraph->nedges, subgraph->nvertices, \ */
-		    /* 	    histogramEV_get (lnhEV, nedges_old, nvertices_old), histogramEV_get (lnhEV, subgraph->nedges, subgraph->nvertices), arg); */
-		    graph_remove_edge (subgraph, edge.v1, edge.v2);
-		    swap_adjacents_removable ();
-		  }
-		else
-		  {
-		    /* printf ("accept add: %zu,%zu -> %zu,%zu [%g -> %g] %g\n", nedges_old, nvertices_old, subgraph->nedges, subgraph->nvertices, \ */
-		    /* 	    histogramEV_get (lnhEV, nedges_old, nvertices_old), histogramEV_get (lnhEV, subgraph->nedges, subgraph->nvertices), arg); */
-		  }
-	      }
-	  }
-	else
-	  { /* Attempt to remove an edge. */
-	    if (subgraph->nremovable > 0 && subgraph->nedges > 1)
-	      {
-		edge_index = random_uniform () * subgraph->nremovable;
-		set_edge (edge, subgraph->removable[edge_index].v1, subgraph->removable[edge_index].v2);
-		graph_remove_edge (subgraph, edge.v1, edge.v2);
-		swap_adjacents_removable ();
-		graph_find_bridges (subgraph);
-		graph_find_adjacents (graph, subgraph);
-		arg = log ((double) nremovable_old / (double) subgraph->nadjacents)
-		  + histogramEV_get (lnhEV, nedges_old, nvertices_old)
-		  - histogramEV_get (lnhEV, subgraph->nedges, subgraph->nvertices);
-		if (arg < 0. && random_uniform () >= exp (arg))
-		  { /* Reject move. */
-		    /* printf ("reject rem: %zu,%zu -> %zu,%zu [%g -> %g] %g\n", nedges_old, nvertices_old, subgraph->nedges, subgraph->nvertices, \ */
-		    /* 	    histogramEV_get (lnhEV, nedges_old, nvertices_old), histogramEV_get (lnhEV, subgraph->nedges, subgraph->nvertices), arg); */
-		    graph_add_edge (subgraph, edge.v1, edge.v2);
-		    swap_adjacents_removable ();
-		  }
-		else
-		  {
-		    /* printf ("accept rem: %zu,%zu -> %zu,%zu [%g -> %g] %g\n", nedges_old, nvertices_old, subgraph->nedges, subgraph->nvertices, \ */
-		    /* 	    histogramEV_get (lnhEV, nedges_old, nvertices_old), histogramEV_get (lnhEV, subgraph->nedges, subgraph->nvertices), arg); */
-		  }
-	      }
-	  }
-	visits[(subgraph->nedges + 1) - subgraph->nvertices + max_y * subgraph->nedges]++;
-	histogramEV_inc (lnhEV, subgraph->nedges, subgraph->nvertices, f);
-      }
-
-    /* Check flatness condition. */
-    unsigned long n = 0;
-    unsigned long visits_sum = 0;
-    unsigned long visits_max = 0;
-    for (i = 0; i < max_x * max_y; i++)
-      {
-	if (visits[i] > 0)
-	  {
-	    n++;
-	    visits_sum += visits[i];
-	    visits_max = (visits[i] > visits_max) ? visits[i] : visits_max;
-	  }
-      }
-    if ((double) visits_sum / (double) n > flatness * visits_max) break;
-  } while (1);
-
-  /* Tare lnhEV. */
-  double lnhEV_min = DBL_MAX;
-  for (i = 0; i < max_x * max_y; i++)
-    {
-      lnhEV_min = (lnhEV->data[i] > 0 && lnhEV->data[i] < lnhEV_min) ? lnhEV->data[i] : lnhEV_min;
+  if (random_uniform (rng) < 0.5)
+    { /* Attempt to add a vertex. */
+      if (subgraph->nadjacents == 0) return;
+      edge = subgraph->adjacents[(size_t) (random_uniform (rng) * subgraph->nadjacents)];
+      if (subgraph->nvedges[edge.v1] > 0 && subgraph->nvedges[edge.v2] > 0) return;
+      v = (subgraph->nvedges[edge.v1] == 0) ? edge.v1 : edge.v2;
+      for (i = 0, nmoved = 0; i < graph->nvedges[v]; i++)
+	{
+	  u = graph->edges[v][i];
+	  if (subgraph->nvedges[u] == 0) continue;
+	  set_edge (work->moved[nmoved], v, u);
+	  nmoved++;
+	}
+      if (nedges_old + nmoved > Emax) return;
+      nproposals_old = subgraph->nadjacents;
+      if (stats) stats_propose (stats, MOVE_ADD_VERTEX, nedges_old, nvertices_old);
+      if (timing) t = monotonic_time ();
+      for (i = 0; i < nmoved; i++)
+	{
+	  apply_add_edge (work, graph, subgraph, work->moved[i]);
+	}
+      if (timing) stats->update_time += monotonic_time () - t;
+      arg = log ((double) nproposals_old / (2. * (double) subgraph->nremovable))
+	+ histogramEV_get (lnhEV, nedges_old, nvertices_old)
+	- histogramEV_get (lnhEV, subgraph->nedges, subgraph->nvertices);
+      if (!metropolis (arg, rng))
+	{ /* Reject move. */
+	  if (timing) t = monotonic_time ();
+	  revert_moved (work, graph, subgraph, nmoved, 1);
+	  if (timing) stats->update_time += monotonic_time () - t;
+	}
+      else if (stats)
+	{
+	  stats_accept (stats, MOVE_ADD_VERTEX, nedges_old, nvertices_old);
+	}
     }
-  for (i = 0; i < max_x * max_y; i++)
+  else
+    { /* Attempt to remove a vertex. */
+      if (subgraph->nremovable == 0) return;
+      edge = subgraph->removable[(size_t) (random_uniform (rng) * subgraph->nremovable)];
+      v = (random_uniform (rng) < 0.5) ? edge.v1 : edge.v2;
+      nmoved = subgraph->nvedges[v];
+      if (nedges_old < Emin + nmoved) return;
+      nproposals_old = subgraph->nremovable;
+      if (stats) stats_propose (stats, MOVE_REMOVE_VERTEX, nedges_old, nvertices_old);
+      for (i = 0, nlinks = 0; i < graph->nvedges[v]; i++)
+	{
+	  if (subgraph->nvedges[graph->edges[v][i]] > 0) nlinks++;
+	}
+      if (nlinks > nmoved) return;
+      for (i = 0; i < nmoved; i++)
+	{
+	  set_edge (work->moved[i], v, subgraph->edges[v][i]);
+	}
+      if (timing) t = monotonic_time ();
+      for (i = 0; i < nmoved; i++)
+	{
+	  if (subgraph->nvedges[work->moved[i].v2] < 2 || !is_removable (work, graph, subgraph, work->moved[i]))
+	    break;
+	  apply_remove_edge (work, graph, subgraph, work->moved[i]);
+	}
+      if (timing) stats->update_time += monotonic_time () - t;
+      accept = (i == nmoved) && metropolis (log (2. * (double) nproposals_old / (double) subgraph->nadjacents)
+					    + histogramEV_get (lnhEV, nedges_old, nvertices_old)
+					    - histogramEV_get (lnhEV, subgraph->nedges, subgraph->nvertices), rng);
+      if (!accept)
+	{ /* Reject move. */
+	  if (timing) t = monotonic_time ();
+	  revert_moved (work, graph, subgraph, i, 0);
+	  if (timing) stats->update_time += monotonic_time () - t;
+	}
+      else if (stats)
+	{
+	  stats_accept (stats, MOVE_REMOVE_VERTEX, nedges_old, nvertices_old);
+	}
+    }
+}
+
+/* Attempt to add, or remove, a patch of k edges one at a time.  The
+ * move is accepted with the ratio of the probabilities of choosing the
+ * same edges in the reverse order, and of choosing them in this order,
+ * which is the product of the numbers of adjacent (or removable) edges
+ * before each addition (or removal), divided by the product of the
+ * numbers of removable (or adjacent) edges after it. */
+static void patch_step (const graph_t * graph, graph_t * subgraph, const histogramEV_t * lnhEV, \
+			size_t Emin, size_t Emax, workspace_t * work, gsl_rng * rng, sampler_stats_t * stats)
+{
+  size_t i;
+  const size_t k = 2 + (size_t) (random_uniform (rng) * (double) (work->moves->max_patch - 1));
+  const size_t nedges_old = subgraph->nedges;
+  const size_t nvertices_old = subgraph->nvertices;
+  const int timing = (stats != NULL && stats->timing);
+  const int grow = (random_uniform (rng) < 0.5);
+  const int move = grow ? MOVE_GROW : MOVE_SHRINK;
+  double arg = 0., t = 0.;
+
+  if (grow ? (nedges_old + k > Emax) : (nedges_old < Emin + k)) return;
+  if (stats) stats_propose (stats, move, nedges_old, nvertices_old);
+  if (timing) t = monotonic_time ();
+  for (i = 0; i < k; i++)
     {
-      if (lnhEV->data[i] >= lnhEV_min)
+      if (grow)
 	{
-	  lnhEV->data[i] -= lnhEV_min;
+	  if (subgraph->nadjacents == 0) break;
+	  arg += log ((double) subgraph->nadjacents);
+	  work->moved[i] = subgraph->adjacents[(size_t) (random_uniform (rng) * subgraph->nadjacents)];
+	  apply_add_edge (work, graph, subgraph, work->moved[i]);
+	  arg -= log ((double) subgraph->nremovable);
 	}
       else
 	{
-	  lnhEV->data[i] = -1.;
+	  arg += log ((double) subgraph->nremovable);
+	  work->moved[i] = subgraph->removable[(size_t) (random_uniform (rng) * subgraph->nremovable)];
+	  apply_remove_edge (work, graph, subgraph, work->moved[i]);
+	  arg -= log ((double) subgraph->nadjacents);
 	}
     }
+  if (timing) stats->update_time += monotonic_time () - t;
+  arg += histogramEV_get (lnhEV, nedges_old, nvertices_old)
+    - histogramEV_get (lnhEV, subgraph->nedges, subgraph->nvertices);
+  if (i < k || !metropolis (arg, rng))
+    { /* Reject move. */
+      if (timing) t = monotonic_time ();
+      revert_moved (work, graph, subgraph, i, grow);
+      if (timing) stats->update_time += monotonic_time () - t;
+    }
+  else if (stats)
+    {
+      stats_accept (stats, move, nedges_old, nvertices_old);
+    }
+}
 
-  graph_find_bridges (subgraph);
+/* Attempt a move from the mixture in work->moves, weighted by
+ * exp(-lnhEV).  Moves that would take the number of edges outside
+ * [Emin, Emax] are rejected; Emin must be at least one.  stats may be
+ * NULL. */
+static void mc_step (const graph_t * graph, graph_t * subgraph, const histogramEV_t * lnhEV, \
+		     size_t Emin, size_t Emax, workspace_t * work, gsl_rng * rng, sampler_stats_t * stats)
+{
+  const double r = (work->moves) ? random_uniform (rng) : 1.;
 
- fail:
-  if (removable_old) free (removable_old);
-  if (adjacents_old) free (adjacents_old);
-  if (visits) free (visits);
+  if (work->moves && r < work->moves->vertex)
+    vertex_step (graph, subgraph, lnhEV, Emin, Emax, work, rng, stats);
+  else if (work->moves && r < work->moves->vertex + work->moves->patch)
+    patch_step (graph, subgraph, lnhEV, Emin, Emax, work, rng, stats);
+  else
+    edge_step (graph, subgraph, lnhEV, Emin, Emax, work, rng, stats);
+  if (stats) stats_step (stats, subgraph->nedges, Emin, Emax);
+}
+
+void wl_step_subgraphs_EV (const graph_t * graph, graph_t * subgraph, histogramEV_t * lnhEV, histogramEV_t * visits, \
+			   flatness_t * stats, double f, size_t Emin, size_t Emax, unsigned long nsteps, \
+			   int incremental, const move_set_t * moves, gsl_rng * rng, sampler_stats_t * sampler_stats)
+{
+  workspace_t * work = workspace_alloc (graph, subgraph, incremental, moves);
+  if (work == NULL) return;
+
+  if (Emin < 1) Emin = 1;
+  unsigned long step;
+  double * v;
+  for (step = 0; step < nsteps; step++)
+    {
+      mc_step (graph, subgraph, lnhEV, Emin, Emax, work, rng, sampler_stats);
+      v = &histogramEV_get (visits, subgraph->nedges, subgraph->nvertices);
+      if (*v <= 0.) stats->nvisited++;
+      *v += 1.;
+      stats->sum += 1.;
+      if (*v > stats->max) stats->max = *v;
+      histogramEV_inc (lnhEV, subgraph->nedges, subgraph->nvertices, f);
+    }
+
+  workspace_finish (work, subgraph);
+  workspace_free (work);
+}
+
+void wl_sample_subgraphs_EV (const graph_t * graph, graph_t * subgraph, histogramEV_t * lnhEV, double f, double flatness, unsigned long ncheck, int incremental, gsl_rng * rng)
+{
+  histogramEV_t * visits = histogramEV_alloc (graph);
+  if (visits == NULL) return;
+  histogramEV_fill (visits, 0.);
+  flatness_t stats;
+  flatness_init (&stats, visits);
+
+  do {
+    wl_step_subgraphs_EV (graph, subgraph, lnhEV, visits, &stats, f, 1, graph->nedges, ncheck, incremental, NULL, rng, NULL);
+  } while (!flatness_check (&stats, flatness));
+
+  histogramEV_tare (lnhEV);
+  histogramEV_free (visits);
 }
 
-void wl_simulate_subgraphs_EV (const graph_t * graph, graph_t * subgraph, histogramEV_t * lnhEV, double f_start, double f_target, double flatness, unsigned long ncheck)
+void wl_simulate_subgraphs_EV (const graph_t * graph, graph_t * subgraph, histogramEV_t * lnhEV, double f_start, double f_target, double flatness, unsigned long ncheck, int incremental, gsl_rng * rng)
 {
   double f = f_start;
   while (f >= f_target)
     {
       printf ("WL f = %g\n", f);
-      wl_sample_subgraphs_EV (graph, subgraph, lnhEV, f, flatness, ncheck);
+      wl_sample_subgraphs_EV (graph, subgraph, lnhEV, f, flatness, ncheck, incremental, rng);
       f *= 0.5;
     }
 }
 
-void mc_sample_subgraphs_EV (const graph_t * graph, graph_t * subgraph, const histogramEV_t * lnhEV, unsigned long nsteps)
+void mc_sample_subgraphs_EV (const graph_t * graph, graph_t * subgraph, const histogramEV_t * lnhEV, unsigned long nsteps, int incremental, const move_set_t * moves, gsl_rng * rng, sampler_stats_t * sampler_stats)
 {
-  INIT_ADJACENTS_REMOVABLE_SWAP;
-  graph_find_bridges (subgraph);
-  graph_find_adjacents (graph, subgraph);
-
-  edge_t edge;
-  size_t edge_index, nedges_old, nvertices_old;
-  double arg;
+  workspace_t * work = workspace_alloc (graph, subgraph, incremental, moves);
+  if (work == NULL) return;
 
   unsigned long step;
   for (step = 0; step < nsteps; step++)
     {
-      nedges_old = subgraph->nedges;
-      nvertices_old = subgraph->nvertices;
-      if (random_uniform () < 0.5)
-	{ /* Attempt to add an edge. */
-	  if (subgraph->nadjacents > 0)
+      mc_step (graph, subgraph, lnhEV, 1, graph->nedges, work, rng, sampler_stats);
+    }
+
+  workspace_finish (work, subgraph);
+  workspace_free (work);
+}
+
+/* Add exp(energy) of the subgraph's edges to energy_sums for each of
+ * the nenergies realizations.  The nenergies sums for each (E, V) bin
+ * are stored contiguously, with the bins in the order of layout.  If
+ * dyn is not NULL, the subgraph's edges are read from its bitset. */
+static void accumulate_energies (const graph_t * graph, const graph_t * subgraph, const dynamic_t * dyn, \
+				 const histogramEV_t * layout, size_t nenergies, const double * energies, \
+				 double * energy_sums, double * work)
+{
+  size_t i, j, k, s, eid = 0;
+  unsigned long bits;
+  const double * row;
+  double * sums = energy_sums + nenergies * histogramEV_index (layout, subgraph->nedges, subgraph->nvertices);
+
+  for (k = 0; k < nenergies; k++)
+    {
+      work[k] = 0.;
+    }
+  for (i = 0; dyn != NULL && i * DYNAMIC_WORD_BITS < dyn->nedges; i++)
+    {
+      for (bits = dyn->in_subgraph[i], eid = i * DYNAMIC_WORD_BITS; bits != 0; bits >>= 1, eid++)
+	{
+	  if (!(bits & 1UL)) continue;
+	  row = energies + nenergies * eid;
+	  for (k = 0; k < nenergies; k++)
 	    {
-	      edge_index = random_uniform () * subgraph->nadjacents;
-	      set_edge (edge, subgraph->adjacents[edge_index].v1, subgraph->adjacents[edge_index].v2);
-	      graph_add_edge (subgraph, edge.v1, edge.v2);
-	      swap_adjacents_removable ();
-	      graph_find_bridges (subgraph);
-	      graph_find_adjacents (graph, subgraph);
-	      arg = log ((double) nadjacents_old / (double) subgraph->nremovable)
-		+ histogramEV_get (lnhEV, nedges_old, nvertices_old)
-		- histogramEV_get (lnhEV, subgraph->nedges, subgraph->nvertices);
-	      if (arg < 0. && random_uniform () >= exp (arg))
-		{ /* Reject move. */
-		  /* printf ("reject add: %zu,%zu -> %zu,%zu [%g -> %g] %g\n", nedges_old, nvertices_old, subgraph->nedges, subgraph->nvertices, \ */
-		  /* 	    histogramEV_get (lnhEV, nedges_old, nvertices_old), histogramEV_get (lnhEV, subgraph->nedges, subgraph->nvertices), arg); */
-		  graph_remove_edge (subgraph, edge.v1, edge.v2);
-		  swap_adjacents_removable ();
-		}
-	      else
-		{
-		  /* printf ("accept add: %zu,%zu -> %zu,%zu [%g -> %g] %g\n", nedges_old, nvertices_old, subgraph->nedges, subgraph->nvertices, \ */
-		  /* 	    histogramEV_get (lnhEV, nedges_old, nvertices_old), histogramEV_get (lnhEV, subgraph->nedges, subgraph->nvertices), arg); */
-		}
+	      work[k] += row[k];
 	    }
 	}
-      else
-	{ /* Attempt to remove an edge. */
-	  if (subgraph->nremovable > 0 && subgraph->nedges > 1)
+    }
+  for (i = 0; dyn == NULL && i < graph->max_nvertices; i++)
+    {
+      /* Both rows are sorted, so the subgraph's edges can be matched
+       * against the target's in a single pass. */
+      for (j = 0, s = 0; j < graph->nvedges[i]; j++)
+	{
+	  if (graph->edges[i][j] < i) continue;
+	  while (s < subgraph->nvedges[i] && subgraph->edges[i][s] < graph->edges[i][j]) s++;
+	  if (s < subgraph->nvedges[i] && subgraph->edges[i][s] == graph->edges[i][j])
 	    {
-	      edge_index = random_uniform () * subgraph->nremovable;
-	      set_edge (edge, subgraph->removable[edge_index].v1, subgraph->removable[edge_index].v2);
-	      graph_remove_edge (subgraph, edge.v1, edge.v2);
-	      swap_adjacents_removable ();
-	      graph_find_bridges (subgraph);
-	      graph_find_adjacents (graph, subgraph);
-	      arg = log ((double) nremovable_old / (double) subgraph->nadjacents)
-		+ histogramEV_get (lnhEV, nedges_old, nvertices_old)
-		- histogramEV_get (lnhEV, subgraph->nedges, subgraph->nvertices);
-	      if (arg < 0. && random_uniform () >= exp (arg))
-		{ /* Reject move. */
-		  /* printf ("reject rem: %zu,%zu -> %zu,%zu [%g -> %g] %g\n", nedges_old, nvertices_old, subgraph->nedges, subgraph->nvertices, \ */
-		  /* 	    histogramEV_get (lnhEV, nedges_old, nvertices_old), histogramEV_get (lnhEV, subgraph->nedges, subgraph->nvertices), arg); */
-		  graph_add_edge (subgraph, edge.v1, edge.v2);
-		  swap_adjacents_removable ();
-		}
-	      else
+	      row = energies + nenergies * eid;
+	      for (k = 0; k < nenergies; k++)
 		{
-		  /* printf ("accept rem: %zu,%zu -> %zu,%zu [%g -> %g] %g\n", nedges_old, nvertices_old, subgraph->nedges, subgraph->nvertices, \ */
-		  /* 	    histogramEV_get (lnhEV, nedges_old, nvertices_old), histogramEV_get (lnhEV, subgraph->nedges, subgraph->nvertices), arg); */
+		  work[k] += row[k];
 		}
 	    }
+	  eid++;
 	}
     }
+  for (k = 0; k < nenergies; k++)
+    {
+      sums[k] += exp (work[k]);
+    }
+}
+
+void mc_collect_subgraphs_EV (const graph_t * graph, graph_t * subgraph, const histogramEV_t * lnhEV, \
+			      unsigned long nsteps, unsigned long nsamples, int incremental, const move_set_t * moves, \
+			      gsl_rng * rng, double qdih, histogramEV_t * visits, histogramEV_t * dihedrals, \
+			      histogramEVB_t * bridges, histogramEV_t * adjacents, size_t nenergies, \
+			      const double * energies, double * energy_sums, sample_file_t * samples, \
+			      ptrdiff_t * trace_bins, double * trace, sampler_stats_t * sampler_stats)
+{
+  workspace_t * work = workspace_alloc (graph, subgraph, incremental, moves);
+  if (work == NULL) return;
+  double * energy_work = NULL;
+  if (nenergies > 0 && visits != NULL)
+    {
+      energy_work = (double *) malloc (sizeof (double) * nenergies);
+      if (energy_work == NULL) goto done;
+    }
+
+  unsigned long sample, step;
+  for (sample = 0; sample < nsamples; sample++)
+    {
+      for (step = 0; step < nsteps; step++)
+	{
+	  mc_step (graph, subgraph, lnhEV, 1, graph->nedges, work, rng, sampler_stats);
+	}
+      workspace_finish (work, subgraph);
+
+      const size_t E = subgraph->nedges, V = subgraph->nvertices;
+      if (visits)
+	histogramEV_inc (visits, E, V, 1.);
+      if (dihedrals)
+	histogramEV_inc (dihedrals, E, V, pow (qdih, 1. + (double) subgraph->nbridges - (double) V));
+      if (bridges && histogramEVB_inc (bridges, E, V, subgraph->nbridges, 1.) < 0)
+	goto done;
+      if (adjacents)
+	histogramEV_inc (adjacents, E, V, (double) subgraph->nadjacents);
+      if (energy_work)
+	accumulate_energies (graph, subgraph, work->dynamic, visits, nenergies, energies, energy_sums, energy_work);
+      if (samples && sample_file_write (samples, graph, subgraph, \
+					 work->dynamic ? work->dynamic->in_subgraph : NULL) < 0)
+	goto done;
+      if (trace_bins && visits)
+	{
+	  trace_bins[sample] = histogramEV_index (visits, E, V);
+	  trace[sample] = (double) subgraph->nadjacents;
+	}
+    }
+
+ done:
+  if (energy_work) free (energy_work);
+  workspace_free (work);
+}
+
+void mc_enter_window_EV (const graph_t * graph, graph_t * subgraph, size_t Emin, size_t Emax, int incremental, gsl_rng * rng)
+{
+  workspace_t * work = workspace_alloc (graph, subgraph, incremental, NULL);
+  if (work == NULL) return;
 
-  graph_find_bridges (subgraph);
+  /* Unconditionally add or remove random edges until the subgraph lies
+   * within the window. */
+  edge_t edge;
+  size_t edge_index;
+  while (subgraph->nedges > Emax && subgraph->nedges > 1 && subgraph->nremovable > 0)
+    {
+      edge_index = random_uniform (rng) * subgraph->nremovable;
+      set_edge (edge, subgraph->removable[edge_index].v1, subgraph->removable[edge_index].v2);
+      apply_remove_edge (work, graph, subgraph, edge);
+    }
+  while (subgraph->nedges < Emin && subgraph->nadjacents > 0)
+    {
+      edge_index = random_uniform (rng) * subgraph->nadjacents;
+      set_edge (edge, subgraph->adjacents[edge_index].v1, subgraph->adjacents[edge_index].v2);
+      apply_add_edge (work, graph, subgraph, edge);
+    }
 
- fail:  
-  if (removable_old) free (removable_old);
-  if (adjacents_old) free (adjacents_old);
+  workspace_finish (work, subgraph);
+  workspace_free (work);
 }